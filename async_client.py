@@ -0,0 +1,405 @@
+import asyncio
+import os
+import socket
+import sys
+import client
+import compression
+import protocol
+import sync_state
+from client import (CREATE_COMMAND, DELETE_COMMAND, MODIFY_COMMAND, MOVE_COMMAND, UPDATES_COMMAND, SUBSCRIBE_COMMAND,
+                    DELTA_COMMAND, FETCH_COMMAND, SESSION_COMMAND, BATCH_COMMAND, RESYNC_COMMAND, CAPABILITIES_MESSAGE,
+                    COMMAND_NAMES, BATCH_MAX_SIZE, BATCH_FILE_SIZE, ClientDisconnectedException, Change)
+
+# Client that runs on one asyncio event loop instead of threads that share a blocking socket. After the initial sync
+# (the same as client.py does) one connection carries everything: the download task receives the replies and the
+# updates the server pushes, and the upload task sends the changes watchdog reports, at the same time, so a big
+# download doesn't hold the uploads back and a big upload doesn't hold the downloads. Both tasks send through the
+# multiplexer, which sends each frame whole. Reading, writing and hashing files runs in the executor, so the loop only
+# waits for the socket. What to send for each change and the packets themselves come from client.py, only the I/O is
+# different.
+
+
+# Receive buffer of the connection. Frames are parsed from it with protocol.FrameReader, like the server does: if the
+# frame is not fully received yet, we receive more and parse it again.
+class FrameReceiver:
+    def __init__(self, loop, s):
+        self.loop = loop
+        self.socket = s
+        self.buffer = bytearray()
+
+    async def receive(self):
+        data = await self.loop.sock_recv(self.socket, protocol.RECV_SIZE)
+        if not data:
+            raise ClientDisconnectedException()
+        self.buffer += data
+
+    # Return what parse returns for FrameReader of the buffer, once the whole frame it reads arrived
+    async def parse(self, parse):
+        while True:
+            reader = protocol.FrameReader(self.buffer)
+            try:
+                result = parse(reader)
+            except protocol.IncompleteFrameException:
+                await self.receive()
+                continue
+            del self.buffer[:reader.offset]
+            return result
+
+    # Yield the next size bytes in pieces as they arrive, file body is never buffered whole
+    async def iter_body(self, size):
+        while size:
+            if not self.buffer:
+                await self.receive()
+            piece = bytes(self.buffer[:size])
+            del self.buffer[:len(piece)]
+            size -= len(piece)
+            yield piece
+
+
+# Sending side of the connection, shared by the upload and the download tasks. Each frame (with its file body) is sent
+# under the send lock, so frames of the two tasks never mix. Small changes are collected into one batch frame, which is
+# sent before any other frame and when the upload task has no more changes.
+class Multiplexer:
+    def __init__(self, loop, s):
+        self.loop = loop
+        self.socket = s
+        self.send_lock = asyncio.Lock()
+        self.batch = bytearray()
+        # Requests that wait for their reply: {request_id: (read_reply, future)}
+        self.pending_requests = {}
+        # Sends that wait for the send lock, started by send_soon
+        self.waiting_sends = set()
+
+    async def send(self, packet):
+        async with self.send_lock:
+            await self.flush_locked()
+            await self.loop.sock_sendall(self.socket, packet)
+
+    # Send packet when the send lock is free, without waiting for it. The download task sends its frames like this, so
+    # it goes on receiving while the upload task sends a big file. The lock is fair, so the frames keep their order.
+    def send_soon(self, packet):
+        task = self.loop.create_task(self.send(packet))
+        self.waiting_sends.add(task)
+        task.add_done_callback(self.sent)
+
+    def sent(self, task):
+        self.waiting_sends.discard(task)
+        # If the server disconnected, the download task finds out
+        if not task.cancelled():
+            task.exception()
+
+    # Small packet of change goes into the batch, bigger one is sent alone
+    async def send_change(self, packet):
+        if len(packet) > BATCH_MAX_SIZE:
+            await self.send(packet)
+            return
+        self.batch += packet
+        if len(self.batch) >= BATCH_MAX_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        async with self.send_lock:
+            await self.flush_locked()
+
+    # Called with the send lock
+    async def flush_locked(self):
+        if not self.batch:
+            return
+        records = self.batch
+        self.batch = bytearray()
+        await self.loop.sock_sendall(self.socket, BATCH_COMMAND.to_bytes(1, 'little')
+                                     + len(records).to_bytes(4, 'little') + records)
+
+    # Send header and then size bytes of the body straight from file f. If the file got shorter while we send it, we
+    # fill the rest so the frame stays valid (the modify event of this change sends the right content).
+    async def send_file(self, header, f, size):
+        async with self.send_lock:
+            await self.flush_locked()
+            await self.loop.sock_sendall(self.socket, header)
+            sent = await self.loop.sock_sendfile(self.socket, f, 0, size) if size else 0
+            for padding in client.iter_padding(size - sent):
+                await self.loop.sock_sendall(self.socket, padding)
+
+    # Send request and return future of its reply. read_reply is coroutine function the download task reads the reply
+    # with, what it returns is the result of the future.
+    async def request(self, command, read_reply, fields=b''):
+        request_id = next(client.request_ids)
+        future = self.loop.create_future()
+        self.pending_requests[request_id] = (read_reply, future)
+        await self.send(command.to_bytes(1, 'little') + protocol.REQUEST_ID.pack(request_id) + fields)
+        return future
+
+
+# Watchdog handler whose change queue passes the merged changes to the upload task, instead of sending them itself
+class QueueHandler(client.Handler):
+    def __init__(self, base_path, identifier, loop, changes, quiet_window):
+        self.loop = loop
+        self.changes = changes
+        super(QueueHandler, self).__init__(base_path, None, identifier, quiet_window)
+
+    # Called in the thread of the change queue
+    def send_change(self, change):
+        try:
+            self.loop.call_soon_threadsafe(self.changes.put_nowait, change)
+        except RuntimeError:
+            # The event loop is closed, so is the connection
+            raise ClientDisconnectedException()
+
+
+class AsyncClient:
+    def __init__(self, s, identifier, base_path, quiet_window):
+        self.socket = s
+        self.identifier = identifier
+        self.base_path = base_path
+        self.quiet_window = quiet_window
+        self.codecs = 0
+
+    def in_executor(self, function, *args):
+        return self.loop.run_in_executor(None, function, *args)
+
+    async def run(self, address, push_updates, time_series):
+        self.loop = asyncio.get_running_loop()
+        self.receiver = FrameReceiver(self.loop, self.socket)
+        self.multiplexer = Multiplexer(self.loop, self.socket)
+        self.changes = asyncio.Queue()
+        # Changes from now on wait in the queue until we resumed the session, so the server doesn't send them back
+        client.start_watchdog(self.base_path, None, self.identifier,
+                              event_handler=QueueHandler(self.base_path, self.identifier, self.loop, self.changes,
+                                                         self.quiet_window))
+        await self.connect(address)
+        tasks = [self.loop.create_task(self.download())]
+        try:
+            if not await self.open_session():
+                # The server doesn't have all the changes we missed since the initial sync anymore
+                self.in_executor(self.resync)
+            tasks.append(self.loop.create_task(self.upload()))
+            if push_updates:
+                await self.multiplexer.send(SUBSCRIBE_COMMAND.to_bytes(1, 'little'))
+            else:
+                tasks.append(self.loop.create_task(self.poll(time_series)))
+            # The tasks run until the server disconnects
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            task.result()
+
+    # Agree on the codecs and bind the connection to identifier, like negotiate_compression and bind_connection
+    async def connect(self, address):
+        await self.loop.sock_connect(self.socket, address)
+        await self.multiplexer.send(CAPABILITIES_MESSAGE.to_bytes(1, 'little')
+                                    + compression.SUPPORTED_CODECS.to_bytes(1, 'little'))
+        self.codecs = await self.receiver.parse(lambda reader: reader.read_int(1))
+        client.socket_codecs[self.socket] = self.codecs
+        await self.multiplexer.send(int(1).to_bytes(1, 'little') + self.identifier.encode('utf-8'))
+
+    # Open the session of the initial sync on this connection, return True if the server still has all the changes we
+    # missed since then
+    async def open_session(self):
+        reply = await self.multiplexer.request(
+            SESSION_COMMAND, lambda: self.receiver.parse(lambda reader: reader.unpack(protocol.SESSION_REPLY)),
+            client.session.encode('utf-8') + client.session_cursor.to_bytes(8, 'little'))
+        resumed, client.session_cursor = await reply
+        return resumed == 1
+
+    # Ask for the updates every time_series seconds, the next pull is sent after the updates of the last one arrived
+    async def poll(self, time_series):
+        while True:
+            await asyncio.sleep(time_series)
+            await (await self.multiplexer.request(UPDATES_COMMAND, self.receive_updates))
+
+    # Download task: passes each reply to the request it answers, and applies the update batches the server pushes.
+    # When the server disconnects, the requests that wait for reply fail.
+    async def download(self):
+        try:
+            while True:
+                request_id = await self.receiver.parse(lambda reader: reader.unpack(protocol.REQUEST_ID)[0])
+                if request_id == protocol.PUSH_REQUEST_ID:
+                    await self.receive_updates()
+                    continue
+                read_reply, future = self.multiplexer.pending_requests.pop(request_id)
+                # Like receive_replies, the reply we could not read fails its request too
+                try:
+                    reply = await read_reply()
+                except BaseException as error:
+                    future.set_exception(error)
+                    raise
+                future.set_result(reply)
+        finally:
+            for _, future in self.multiplexer.pending_requests.values():
+                if not future.done():
+                    future.set_exception(ClientDisconnectedException())
+
+    # Receive packets count and journal cursor, apply each update packet and then save the cursor
+    async def receive_updates(self):
+        counts, cursor = await self.receiver.parse(lambda reader: reader.unpack(protocol.UPDATES_HEADER))
+        for _ in range(counts):
+            command, is_directory, path = await self.receiver.parse(protocol.FrameReader.read_update)
+            name = COMMAND_NAMES.get(command, 'unknown')
+            client.updates.inc(name)
+            with client.update_seconds.time(name):
+                await self.apply_update(command, is_directory, client.local_path(self.base_path, path))
+
+        if cursor != client.session_cursor:
+            client.session_cursor = cursor
+            await self.in_executor(sync_state.save_cursor, cursor)
+            self.multiplexer.send_soon(client.build_ack_packet(cursor))
+
+    # Like handle_command_from_server, with the disk work in the executor
+    async def apply_update(self, command, is_directory, path):
+        if command == CREATE_COMMAND and is_directory:
+            await self.in_executor(client.make_directories, path)
+        elif command in (CREATE_COMMAND, MODIFY_COMMAND):
+            version, codec, file_size = await self.receiver.parse(
+                lambda reader: client.read_file_header(reader, self.codecs))
+            await self.in_executor(client.keep_local_changes, path, command, version)
+            file_version = await self.receive_file(path, file_size, codec)
+            await self.in_executor(client.remember_synced_file, path, file_version, version)
+        elif command == DELETE_COMMAND:
+            await self.in_executor(client.delete_from_server, path)
+        elif command == DELTA_COMMAND:
+            version, delta = await self.receiver.parse(client.read_delta)
+            await self.in_executor(client.keep_local_changes, path, command, version)
+            # If our copy doesn't match the delta we ask for the whole file
+            if not await self.in_executor(client.apply_delta_to_file, path, version, delta):
+                self.multiplexer.send_soon(client.build_fetch_packet(self.base_path, path))
+        elif command == FETCH_COMMAND:
+            # Server couldn't apply our delta, the upload task sends the whole file
+            self.changes.put_nowait(Change(FETCH_COMMAND, path, False))
+        elif command == MOVE_COMMAND:
+            dst_path = client.local_path(self.base_path, await self.receiver.parse(protocol.FrameReader.read_path))
+            await self.in_executor(client.move_from_server, path, dst_path, is_directory)
+        elif command == RESYNC_COMMAND:
+            # The sync waits for its replies, so it runs in the executor and the download task goes on meanwhile
+            self.in_executor(self.resync)
+
+    # Receive file body with client.FileWriter, writing each piece in the executor as it arrives.
+    # Return version (stat, hash) of the file.
+    async def receive_file(self, path, file_size, codec):
+        writer = await self.in_executor(client.FileWriter, path, codec)
+        try:
+            async for piece in self.receiver.iter_body(file_size):
+                await self.in_executor(writer.write, piece)
+        except BaseException:
+            writer.abort()
+            raise
+        return await self.in_executor(writer.finish)
+
+    # Compare our files with the manifest of the server on a data connection of its own, its replies are received by
+    # its receive thread. Runs in the executor.
+    def resync(self):
+        try:
+            data_socket = client.open_data_connection(self.identifier, self.socket, self.base_path)
+        except (OSError, ClientDisconnectedException):
+            return
+        try:
+            client.resync_with_server(self.identifier, data_socket, self.base_path)
+        finally:
+            client.close_data_connection(data_socket)
+
+    # Upload task: sends the changes from watchdog in their order. The batch of small changes is sent when no more
+    # changes wait.
+    async def upload(self):
+        while True:
+            change = await self.changes.get()
+            if await self.in_executor(client.is_unsynced_change, change):
+                with client.upload_seconds.time(COMMAND_NAMES[change.command]):
+                    await self.upload_change(change)
+            if self.changes.empty():
+                await self.multiplexer.flush()
+
+    # Like Handler.send_change_message, with the decisions and packets of client.py
+    async def upload_change(self, change):
+        if change.command == CREATE_COMMAND and change.is_directory:
+            # Watchdog may miss what was created in new directory right away, so we send it with everything in it
+            for path, _ in await self.in_executor(client.list_created_directory, change.path):
+                await self.push_file(path)
+        elif change.command == CREATE_COMMAND:
+            await self.push_file(change.path)
+        elif change.command == DELETE_COMMAND:
+            await self.multiplexer.send_change(await self.in_executor(
+                client.build_delete_packet, self.base_path, change.path, change.is_directory))
+            await self.in_executor(client.forget_synced_path, change.path)
+        elif change.command in (MODIFY_COMMAND, FETCH_COMMAND):
+            await self.send_modified(change.path, use_delta=change.command == MODIFY_COMMAND)
+        elif change.command == MOVE_COMMAND:
+            await self.multiplexer.send_change(
+                client.build_move_packet(self.base_path, change.path, change.dst_path, change.is_directory))
+            await self.in_executor(client.move_synced_path, change.path, change.dst_path)
+
+    # Like push_file_to_server
+    async def push_file(self, file_path):
+        push = await self.in_executor(client.prepare_push, file_path, self.base_path)
+        if push is None:
+            return
+        action, value = push
+        if action == 'directory':
+            await self.multiplexer.send_change(value)
+        elif action == 'have':
+            if value:
+                await self.multiplexer.send_change(value[0])
+            await self.in_executor(client.remember_synced_file, file_path, value and value[1])
+        else:
+            await self.send_file(value, file_path)
+
+    # Like send_modify_message, with use_delta False the whole file is sent
+    async def send_modified(self, file_path, use_delta):
+        modify = await self.in_executor(client.prepare_modify, file_path, self.base_path, use_delta)
+        if modify is None:
+            return
+        action, value = modify
+        if action == 'delta':
+            packet, delta_stat, new_index = value
+            if packet:
+                await self.multiplexer.send_change(packet)
+                await self.in_executor(client.remember_delta, file_path, delta_stat, new_index)
+        else:
+            await self.send_file(value, file_path)
+
+    # Like send_file_packet: small file goes into the batch, file we may compress is compressed in memory and big file
+    # is sent straight from the file. Then we remember the version (stat, hash) we sent.
+    async def send_file(self, header, file_path):
+        try:
+            f = await self.in_executor(open, file_path, 'rb')
+        except (PermissionError, FileNotFoundError):
+            await self.in_executor(client.remember_synced_file, file_path, None)
+            return
+
+        with f:
+            file_stat = os.fstat(f.fileno())
+            file_size = file_stat.st_size
+            body = await self.in_executor(client.read_file_body, f, file_size, self.codecs, True)
+            if body:
+                codec, data = body
+                packet = header + client.build_body_header(self.socket, codec, len(data)) + data
+                if len(data) <= BATCH_FILE_SIZE:
+                    await self.multiplexer.send_change(packet)
+                else:
+                    await self.multiplexer.send(packet)
+            else:
+                await self.multiplexer.send_file(
+                    header + client.build_body_header(self.socket, compression.RAW, file_size), f, file_size)
+
+        file_version = await self.in_executor(client.get_sent_version, file_path, file_stat)
+        await self.in_executor(client.remember_synced_file, file_path, file_version)
+
+
+if __name__ == "__main__":
+    ip, port_num, path, time_series, identifier, push_updates, quiet_window = client.parse_arguments(sys.argv)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((ip, port_num))
+    client.negotiate_compression(s)
+
+    try:
+        identifier = client.first_connected_to_server(identifier, s, path)
+        # The initial sync runs on blocking socket with its receive thread, then the event loop gets a connection of
+        # its own
+        client.close_data_connection(s)
+        async_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        async_socket.setblocking(False)
+        asyncio.run(AsyncClient(async_socket, identifier, path, quiet_window).run((ip, port_num), push_updates,
+                                                                                   time_series))
+    except (KeyboardInterrupt, ClientDisconnectedException):
+        pass
+    client.stop_watchdog()
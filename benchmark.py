@@ -0,0 +1,519 @@
+import concurrent.futures
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import client
+import protocol
+import sync_state
+from client import (CREATE_COMMAND, DELETE_COMMAND, MODIFY_COMMAND, MOVE_COMMAND, PULL_COMMAND, UPDATES_COMMAND,
+                    SUBSCRIBE_COMMAND, DELTA_COMMAND, IDENTIFIER_SIZE, ClientDisconnectedException)
+
+# Load generator for the sync protocol. It starts server.py in a temp directory (or uses a running server) and drives
+# it with simulated clients that speak the wire protocol directly, without watchdog and without files on disk. One
+# client of each identifier writes the changes and the other clients subscribe and receive them, so we measure the
+# time from sending a change until each other client got it. Results are printed as JSON lines, one per scenario, and
+# can be compared with the results of another commit. The frames are built and read with protocol.py, like the client
+# does.
+
+# We wait for each reply before the next request, so all our requests have the same id
+SIM_REQUEST_ID = 1
+# Each file body starts with its version and the index of the file, so every content is different and the receiver
+# knows which version it got
+TAG_SIZE = 16
+
+SCENARIOS = ('push', 'pull', 'modify', 'move_delete', 'slow_consumer', 'startup')
+DEFAULT_OPTIONS = {
+    # Files of each identifier and size of each file
+    'files': 1000,
+    'size': 4096,
+    # Clients of each identifier, the first one writes and the others receive
+    'clients': 2,
+    # Identifiers that run the scenario at the same time, each in its own process
+    'identifiers': 1,
+    # Modifies of each file in the modify storm
+    'rounds': 5,
+    # Worker processes of the server we start
+    'workers': 1,
+    'port': 0,
+    'timeout': 120,
+    'scenarios': ','.join(SCENARIOS),
+    'output': None,
+    'compare': None,
+}
+
+
+# Read and drop file body of size bytes, return the first TAG_SIZE of them
+def skip_body(reader, size):
+    tag = reader.read(min(size, TAG_SIZE))
+    for _ in reader.iter_body(size - len(tag)):
+        pass
+    return tag
+
+
+def build_body(version, index, size):
+    tag = version.to_bytes(8, 'little') + index.to_bytes(8, 'little')
+    return (tag + bytes(max(size - TAG_SIZE, 0)))[:max(size, TAG_SIZE)]
+
+
+# Key of change that the receivers get, to match it with the time it was sent
+def content_key(path, body):
+    return 'content', path, bytes(body[:TAG_SIZE])
+
+
+def delete_key(path):
+    return 'delete', path
+
+
+def move_key(src_path, dst_path):
+    return 'move', src_path, dst_path
+
+
+# Client of the benchmark: one connection to the server, without compression
+class SimClient:
+    def __init__(self, port, identifier=None):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = protocol.SocketReader(self.socket)
+        if identifier is None:
+            self.socket.sendall(int(0).to_bytes(1, 'little'))
+            identifier = self.reader.read(IDENTIFIER_SIZE).decode('utf-8')
+        self.identifier = identifier
+        # The identifier is sent once, the frames after it are commands
+        self.socket.sendall(int(1).to_bytes(1, 'little') + identifier.encode('utf-8'))
+        # Time each change arrived, by its key
+        self.arrivals = {}
+        self.arrived = threading.Condition()
+        self.received_bytes = 0
+
+    # The writer is the only client that writes, so its writes are never stale and all are based on version 0
+    def send_file(self, command, path, body):
+        self.socket.sendall(protocol.build_path_frame(command, 0, path) + protocol.VERSION.pack(0)
+                            + protocol.UINT64.pack(len(body)) + body)
+
+    def send_delete(self, path):
+        self.socket.sendall(protocol.build_path_frame(DELETE_COMMAND, 0, path) + protocol.VERSION.pack(0))
+
+    def send_move(self, src_path, dst_path):
+        self.socket.sendall(protocol.build_path_frame(MOVE_COMMAND, 0, src_path) + protocol.build_path(dst_path))
+
+    # Ask for the updates once, so we know the server counts us as client of the identifier, and then subscribe
+    def subscribe(self):
+        self.socket.sendall(UPDATES_COMMAND.to_bytes(1, 'little') + protocol.REQUEST_ID.pack(SIM_REQUEST_ID))
+        self.receive_updates()
+        self.socket.sendall(SUBSCRIBE_COMMAND.to_bytes(1, 'little'))
+        threading.Thread(target=self.receive_forever, daemon=True).start()
+
+    # Subscribe and never receive, like a client on a link that stopped
+    def stall(self):
+        self.socket.sendall(SUBSCRIBE_COMMAND.to_bytes(1, 'little'))
+
+    def receive_forever(self):
+        try:
+            while True:
+                self.receive_updates()
+        except (ClientDisconnectedException, OSError):
+            pass
+
+    # Receive one batch of updates (reply to our request or pushed) and record when each change arrived
+    def receive_updates(self):
+        self.reader.unpack(protocol.REQUEST_ID)
+        count, _ = self.reader.unpack(protocol.UPDATES_HEADER)
+        for _ in range(count):
+            command, is_directory, path = self.reader.read_update()
+            if command in (CREATE_COMMAND, MODIFY_COMMAND) and not is_directory:
+                # Version of the content, and then its size
+                self.reader.unpack(protocol.VERSION)
+                size = self.reader.unpack(protocol.UINT64)[0]
+                self.received_bytes += size
+                key = content_key(path, skip_body(self.reader, size))
+            elif command == MOVE_COMMAND:
+                key = move_key(path, self.reader.read_path())
+            elif command == DELTA_COMMAND:
+                self.reader.unpack(protocol.VERSION)
+                self.reader.read(self.reader.unpack(protocol.UINT32)[0])
+                key = None
+            elif command == DELETE_COMMAND:
+                key = delete_key(path)
+            else:
+                key = None
+            self.record(key)
+
+    def record(self, key):
+        with self.arrived:
+            self.arrivals[key] = time.perf_counter()
+            self.arrived.notify_all()
+
+    # Wait until all keys arrived, return False on timeout
+    def wait_for(self, keys, deadline):
+        with self.arrived:
+            for key in keys:
+                while key not in self.arrivals:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0 or not self.arrived.wait(remaining):
+                        return False
+        return True
+
+    # Pull the whole directory, return (files, bytes) we got
+    def pull(self):
+        self.socket.sendall(PULL_COMMAND.to_bytes(1, 'little') + protocol.REQUEST_ID.pack(SIM_REQUEST_ID))
+        self.reader.unpack(protocol.REQUEST_ID)
+        files = 0
+        size = 0
+        while True:
+            command = self.reader.unpack(protocol.UINT8)[0]
+            if command == 0:
+                return files, size
+            is_directory, _ = self.reader.read_path_frame()
+            if not is_directory:
+                self.reader.unpack(protocol.VERSION)
+                file_size = self.reader.unpack(protocol.UINT64)[0]
+                skip_body(self.reader, file_size)
+                files += 1
+                size += file_size
+
+    def close(self):
+        self.socket.close()
+
+
+# Start the clients of one identifier, the first writes and the others are subscribed
+def connect_clients(port, count):
+    writer = SimClient(port)
+    receivers = [SimClient(port, writer.identifier) for _ in range(count - 1)]
+    for receiver in receivers:
+        receiver.subscribe()
+    return writer, receivers
+
+
+# Wait until every receiver got final_keys, and return the latencies of all the keys in sent that arrived
+def collect(receivers, sent, final_keys, deadline):
+    complete = all(receiver.wait_for(final_keys, deadline) for receiver in receivers)
+    latencies = []
+    for receiver in receivers:
+        with receiver.arrived:
+            latencies.extend(receiver.arrivals[key] - sent_time for key, sent_time in sent.items()
+                             if key in receiver.arrivals)
+    return complete, latencies
+
+
+def file_path(index):
+    return os.path.join('d%d' % (index % 32), 'f%d' % index)
+
+
+def push_files(writer, files, size, sent, version=0):
+    for index in range(files):
+        path = file_path(index)
+        body = build_body(version, index, size)
+        sent[content_key(path, body)] = time.perf_counter()
+        writer.send_file(CREATE_COMMAND if version == 0 else MODIFY_COMMAND, path, body)
+
+
+# Writer creates all files, the receivers get them pushed
+def scenario_push(port, options, deadline):
+    writer, receivers = connect_clients(port, options['clients'])
+    sent = {}
+    start = time.perf_counter()
+    push_files(writer, options['files'], options['size'], sent)
+    complete, latencies = collect(receivers, sent, list(sent), deadline)
+    return {'seconds': time.perf_counter() - start, 'operations': options['files'],
+            'bytes': options['files'] * options['size'], 'complete': complete, 'latencies': latencies,
+            'clients': [writer] + receivers}
+
+
+# Receivers pull the whole directory the writer created
+def scenario_pull(port, options, deadline):
+    writer, receivers = connect_clients(port, 2)
+    sent = {}
+    push_files(writer, options['files'], options['size'], sent)
+    complete, _ = collect(receivers, sent, list(sent), deadline)
+    pullers = [SimClient(port, writer.identifier) for _ in range(options['clients'] - 1)]
+    latencies = []
+    start = time.perf_counter()
+    results = []
+    for puller in pullers:
+        pull_start = time.perf_counter()
+        results.append(puller.pull())
+        latencies.append(time.perf_counter() - pull_start)
+    return {'seconds': time.perf_counter() - start, 'operations': sum(files for files, _ in results),
+            'bytes': sum(size for _, size in results),
+            'complete': complete and all(files == options['files'] for files, _ in results),
+            'latencies': latencies, 'clients': [writer] + receivers + pullers}
+
+
+# Writer rewrites every file rounds times as fast as it can, receivers must end with the last version of each file
+# (older versions that a newer one replaced before the receiver got them may be compacted away)
+def scenario_modify(port, options, deadline):
+    writer, receivers = connect_clients(port, options['clients'])
+    files = max(options['files'] // options['rounds'], 1)
+    push_files(writer, files, options['size'], {})
+    collect(receivers, {}, [content_key(file_path(index), build_body(0, index, options['size']))
+                            for index in range(files)], deadline)
+    sent = {}
+    start = time.perf_counter()
+    for version in range(1, options['rounds'] + 1):
+        push_files(writer, files, options['size'], sent, version)
+    final_keys = [content_key(file_path(index), build_body(options['rounds'], index, options['size']))
+                  for index in range(files)]
+    complete, latencies = collect(receivers, sent, final_keys, deadline)
+    return {'seconds': time.perf_counter() - start, 'operations': files * options['rounds'],
+            'bytes': files * options['rounds'] * options['size'], 'complete': complete, 'latencies': latencies,
+            'clients': [writer] + receivers}
+
+
+# Writer moves every file and then deletes it
+def scenario_move_delete(port, options, deadline):
+    writer, receivers = connect_clients(port, options['clients'])
+    files = options['files']
+    push_files(writer, files, options['size'], {})
+    collect(receivers, {}, [content_key(file_path(index), build_body(0, index, options['size']))
+                            for index in range(files)], deadline)
+    sent = {}
+    start = time.perf_counter()
+    for index in range(files):
+        key = move_key(file_path(index), file_path(index) + '.moved')
+        sent[key] = time.perf_counter()
+        writer.send_move(*key[1:])
+    for index in range(files):
+        key = delete_key(file_path(index) + '.moved')
+        sent[key] = time.perf_counter()
+        writer.send_delete(key[1])
+    complete, latencies = collect(receivers, sent, list(sent), deadline)
+    return {'seconds': time.perf_counter() - start, 'operations': 2 * files, 'bytes': 0, 'complete': complete,
+            'latencies': latencies, 'clients': [writer] + receivers}
+
+
+# Push while another subscribed client never receives: the server stops sending to it when its socket is full, and
+# the receivers must get the files as fast as in push
+def scenario_slow_consumer(port, options, deadline):
+    writer, receivers = connect_clients(port, options['clients'])
+    stalled = SimClient(port, writer.identifier)
+    stalled.stall()
+    sent = {}
+    start = time.perf_counter()
+    push_files(writer, options['files'], options['size'], sent)
+    complete, latencies = collect(receivers, sent, list(sent), deadline)
+    return {'seconds': time.perf_counter() - start, 'operations': options['files'],
+            'bytes': options['files'] * options['size'], 'complete': complete, 'latencies': latencies,
+            'clients': [writer, stalled] + receivers}
+
+
+# Restart of the client with unchanged files: the first scan saves the sync state, and we measure the scan that compares
+# the files with it (the client part of startup, without the server)
+def scenario_startup(port, options, deadline):
+    directory = tempfile.mkdtemp()
+    try:
+        base_path = os.path.join(directory, 'synced')
+        for index in range(options['files']):
+            path = os.path.join(base_path, file_path(index))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(build_body(0, index, options['size']))
+        sync_state.open_state(base_path)
+        files, _ = client.scan_local_manifest(base_path, {})
+        sync_state.replace_files({path: file + (0,) for path, file in files.items()})
+        start = time.perf_counter()
+        rescanned, _ = client.scan_local_manifest(base_path, sync_state.get_files())
+        seconds = time.perf_counter() - start
+        sync_state.state.close()
+    finally:
+        shutil.rmtree(directory)
+    return {'seconds': seconds, 'operations': options['files'], 'bytes': 0, 'complete': rescanned == files,
+            'latencies': [seconds], 'clients': []}
+
+
+SCENARIO_FUNCTIONS = {'push': scenario_push, 'pull': scenario_pull, 'modify': scenario_modify,
+                      'move_delete': scenario_move_delete, 'slow_consumer': scenario_slow_consumer,
+                      'startup': scenario_startup}
+
+
+# Run scenario on one identifier, in a process of its own
+def run_identifier(scenario, port, options):
+    result = SCENARIO_FUNCTIONS[scenario](port, options, time.perf_counter() + options['timeout'])
+    for sim_client in result.pop('clients'):
+        sim_client.close()
+    return result
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+# RSS in KiB of process and all its children (the worker processes of sharded server), or None if we can't read it
+def process_tree_rss(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(process_tree_rss(child) or 0 for child in children)
+
+
+# Samples the RSS of the server while the scenario runs, and keeps the highest
+class RssSampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.max_rss = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.max_rss = max(self.max_rss or 0, rss)
+            self.stopped.wait(0.1)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.max_rss
+
+
+def run_scenario(scenario, port, options, server):
+    sampler = RssSampler(server.pid) if server else None
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options['identifiers']) as pool:
+        results = list(pool.map(run_identifier, [scenario] * options['identifiers'],
+                                [port] * options['identifiers'], [options] * options['identifiers']))
+    wall_seconds = time.perf_counter() - start
+    latencies = [latency for result in results for latency in result['latencies']]
+    # Identifiers run at the same time, so the throughput is of the slowest one
+    seconds = max(result['seconds'] for result in results)
+    operations = sum(result['operations'] for result in results)
+    size = sum(result['bytes'] for result in results)
+    return {
+        'scenario': scenario,
+        'commit': git_commit(),
+        'files': options['files'],
+        'size': options['size'],
+        'clients': options['clients'],
+        'identifiers': options['identifiers'],
+        'workers': options['workers'],
+        'complete': all(result['complete'] for result in results),
+        'seconds': round(seconds, 4),
+        'wall_seconds': round(wall_seconds, 4),
+        'operations_per_second': round(operations / seconds, 1) if seconds else None,
+        'mb_per_second': round(size / seconds / (1024 * 1024), 2) if seconds else None,
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'server_rss_kb': sampler.stop() if sampler else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Start server.py in directory and wait until it accepts connections
+def start_server(directory, port, workers):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    server = subprocess.Popen([sys.executable, server_path, str(port), '--workers=%d' % workers], cwd=directory,
+                              stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+# Print how each scenario changed from the results in path (of another commit)
+def compare_results(results, path):
+    with open(path) as f:
+        old_results = {result['scenario']: result for result in map(json.loads, f) if result}
+    for result in results:
+        old = old_results.get(result['scenario'])
+        if not old:
+            continue
+        changes = []
+        for field in ('operations_per_second', 'mb_per_second', 'latency_p50_ms', 'latency_p99_ms', 'server_rss_kb'):
+            if old.get(field) and result.get(field) is not None:
+                changes.append('%s %+.1f%%' % (field, (result[field] / old[field] - 1) * 100))
+        print('%s vs %s: %s' % (result['scenario'], old.get('commit'), ', '.join(changes)), file=sys.stderr)
+
+
+def parse_options(argv):
+    options = dict(DEFAULT_OPTIONS)
+    for arg in argv[1:]:
+        if not arg.startswith('--') or '=' not in arg:
+            raise SystemExit('usage: python benchmark.py [--name=value ...], options: '
+                             + ', '.join(sorted(DEFAULT_OPTIONS)))
+        name, value = arg[2:].split('=', 1)
+        if name not in options:
+            raise SystemExit('unknown option --' + name)
+        options[name] = value if isinstance(DEFAULT_OPTIONS[name], str) or DEFAULT_OPTIONS[name] is None \
+            else type(DEFAULT_OPTIONS[name])(value)
+    return options
+
+
+def main():
+    options = parse_options(sys.argv)
+    scenarios = options['scenarios'].split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIO_FUNCTIONS:
+            raise SystemExit('unknown scenario ' + scenario)
+    if options['clients'] < 2:
+        raise SystemExit('--clients must be at least 2, one writer and one receiver')
+
+    # With --port we use the server that runs on it, otherwise we start one of our own
+    server = None
+    directory = None
+    port = options['port']
+    if not port:
+        directory = tempfile.mkdtemp(prefix='sync-benchmark-')
+        port = find_free_port()
+        server = start_server(directory, port, options['workers'])
+
+    results = []
+    try:
+        for scenario in scenarios:
+            result = run_scenario(scenario, port, options, server)
+            results.append(result)
+            print(json.dumps(result), flush=True)
+    finally:
+        if server:
+            stop_server(server)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if options['output']:
+        with open(options['output'], 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+    if options['compare']:
+        compare_results(results, options['compare'])
+
+
+if __name__ == "__main__":
+    main()
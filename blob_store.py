@@ -0,0 +1,307 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import compression
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Content addressed store of the server files. Each content is stored once as blob named by its sha256, and the files
+# in the identifier directories are hard links to the blobs, so identical files of different identifiers (or copies
+# in the same directory) take the space of one file. The index keeps size, mtime, digest and version (with the origin
+# of the client that wrote it) of every file, and blob
+# is removed when no file or journal change refers to it anymore. Content that a client uploaded compressed is kept
+# compressed next to its blob too, so it is sent compressed to the other clients without compressing it again.
+BLOBS_DIRECTORY = '.blobs'
+INDEX_PATH = '.index.db'
+READ_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+# Files we read from the index at once when we go over all files of identifier
+PAGE_SIZE = 1024
+# Lock file of the blob store, when worker processes share it
+LOCK_PATH = '.blobs.lock'
+
+
+# Blob is removed when nothing refers to it, so storing new reference to blob and removing unused blob are done one at
+# a time (the filesystem threads of the server store and release blobs of different identifiers at once). When worker
+# processes share the store, the lock is held on the lock file too.
+class BlobLock:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+
+    # Called in each worker process, the file lock belongs to the opened file so each process opens its own
+    def share_between_processes(self):
+        self.lock_file = open(LOCK_PATH, 'wb')
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1 and self.lock_file:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0 and self.lock_file:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+blob_lock = BlobLock()
+
+
+def blob_path(digest):
+    return os.path.join(BLOBS_DIRECTORY, digest[:2], digest)
+
+
+def has_blob(digest):
+    return os.path.isfile(blob_path(digest))
+
+
+# Path of the content of blob compressed with codec
+def encoded_blob_path(digest, codec):
+    return blob_path(digest) + '.' + compression.CODEC_NAMES[codec]
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+
+    return sha256.hexdigest()
+
+
+# Each thread has its own connection to the database in path, opened when it first uses it. With the write ahead log
+# the readers don't wait for the writer, and writers wait for each other.
+class Index(threading.local):
+    connection = None
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+
+    def execute(self, sql, parameters=()):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, isolation_level=None, timeout=60)
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        return self.connection.execute(sql, parameters)
+
+
+index = Index()
+# Functions that tell if something else than a file refers to blob (the journal changes, which are in the databases of
+# the worker processes), set by the modules that keep them
+blob_users = []
+
+
+# Close the connection of this thread to database (the index by default), before forking processes that open their own
+def close_index(database=None):
+    database = database or index
+    if database.connection:
+        database.connection.close()
+        database.connection = None
+
+
+def open_index():
+    # Write ahead log makes each commit one append instead of rewriting pages
+    index.execute('PRAGMA journal_mode=WAL')
+    index.execute('CREATE TABLE IF NOT EXISTS files (identifier TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL,'
+                  ' mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0, origin TEXT,'
+                  ' PRIMARY KEY (identifier, path))')
+    # Index of older version has no versions, they are 0 until the files are written again
+    if 'version' not in [column[1] for column in index.execute('PRAGMA table_info(files)')]:
+        index.execute('ALTER TABLE files ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        index.execute('ALTER TABLE files ADD COLUMN origin TEXT')
+    index.execute('CREATE INDEX IF NOT EXISTS files_digest ON files (digest)')
+    # Index of older version has the journals and sessions too, now they are in the journal databases
+    for table in ('journal', 'journal_state', 'sessions'):
+        index.execute('DROP TABLE IF EXISTS ' + table)
+
+
+# Each change of the database (the index by default) is one transaction, so it never has half of a command. The
+# transaction takes the write lock when it begins, so transactions of different threads don't fail on each other.
+class Transaction:
+    def __init__(self, database=None):
+        self.database = database or index
+
+    def __enter__(self):
+        self.database.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.database.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+# Return (size, mtime_ns, digest) of the file, or None if the index doesn't have it
+def get_file_entry(identifier, relative_path):
+    return index.execute('SELECT size, mtime_ns, digest FROM files WHERE identifier = ? AND path = ?',
+                         (identifier, relative_path)).fetchone()
+
+
+# Return (version, origin) of the file, or None if the index doesn't have it
+def get_file_version(identifier, relative_path):
+    return index.execute('SELECT version, origin FROM files WHERE identifier = ? AND path = ?',
+                         (identifier, relative_path)).fetchone()
+
+
+def get_file_digest(identifier, relative_path):
+    entry = get_file_entry(identifier, relative_path)
+    return entry[2] if entry else None
+
+
+# Answer from the index only, without reading the file content
+def is_identical(identifier, relative_path, size, digest):
+    entry = get_file_entry(identifier, relative_path)
+    return entry is not None and entry[0] == size and entry[2] == digest
+
+
+# Yield pages of (path, size, mtime_ns, version, digest) of all files of identifier, sorted by path. Each page is a
+# new query from the last path, so changes of the index between pages don't break the iteration.
+def iter_file_pages(identifier):
+    last_path = ''
+    while True:
+        rows = index.execute('SELECT path, size, mtime_ns, version, digest FROM files WHERE identifier = ? AND path > ?'
+                             ' ORDER BY path LIMIT ?', (identifier, last_path, PAGE_SIZE)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_path = rows[-1][0]
+
+
+# Condition of relative_path and everything under it, as ranges of the (identifier, path) indexes: every path that
+# starts with relative_path + separator is between it and relative_path + the character after the separator. Each side
+# of the OR has the identifier, so SQLite searches both ranges of the index instead of all paths of the identifier.
+UNDER_CONDITION = '(identifier = ? AND path = ? OR identifier = ? AND path >= ? AND path < ?)'
+
+
+def under_parameters(identifier, relative_path):
+    return identifier, relative_path, identifier, relative_path + os.sep, relative_path + chr(ord(os.sep) + 1)
+
+
+def select_under(identifier, relative_path, columns):
+    return index.execute('SELECT ' + columns + ' FROM files WHERE ' + UNDER_CONDITION,
+                         under_parameters(identifier, relative_path)).fetchall()
+
+
+def is_blob_used(digest):
+    return bool(index.execute('SELECT 1 FROM files WHERE digest = ? LIMIT 1', (digest,)).fetchone()) \
+        or any(is_used(digest) for is_used in blob_users)
+
+
+# Blob that no file or change refers to anymore is removed, with its compressed copies
+def release_blob(digest):
+    with blob_lock:
+        if not is_blob_used(digest) and has_blob(digest):
+            os.remove(blob_path(digest))
+            for codec in compression.CODEC_NAMES:
+                if os.path.isfile(encoded_blob_path(digest, codec)):
+                    os.remove(encoded_blob_path(digest, codec))
+
+
+# Put file in temp_path into the store, if we already have its content the temp file is just removed. Called with
+# blob_lock until the blob is linked, so it is not released before that.
+def store_blob(temp_path, digest):
+    if has_blob(digest):
+        os.remove(temp_path)
+        return
+    os.makedirs(os.path.dirname(blob_path(digest)), exist_ok=True)
+    os.replace(temp_path, blob_path(digest))
+
+
+# Keep the compressed content in temp_path next to the blob, if we don't have it already
+def store_encoded_blob(temp_path, digest, codec):
+    with blob_lock:
+        if not has_blob(digest) or os.path.isfile(encoded_blob_path(digest, codec)):
+            os.remove(temp_path)
+            return
+        os.replace(temp_path, encoded_blob_path(digest, codec))
+
+
+# Make file of identifier in relative_path to be the blob, replace the file if it exists. version and origin are of
+# the change that wrote it.
+def link_file(identifier, relative_path, digest, version=0, origin=None):
+    path = os.path.join(identifier, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.link-tmp'
+    os.link(blob_path(digest), temp_path)
+    os.replace(temp_path, path)
+    stat = os.stat(path)
+
+    old_digest = get_file_digest(identifier, relative_path)
+    with Transaction():
+        index.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (identifier, relative_path, stat.st_size, stat.st_mtime_ns, digest, version, origin))
+    if old_digest and old_digest != digest:
+        release_blob(old_digest)
+
+
+# File or directory relative_path of identifier removed
+def remove_path(identifier, relative_path):
+    digests = {digest for digest, in select_under(identifier, relative_path, 'digest')}
+    with Transaction():
+        index.execute('DELETE FROM files WHERE ' + UNDER_CONDITION, under_parameters(identifier, relative_path))
+    for digest in digests:
+        release_blob(digest)
+
+
+# File or directory of identifier moved from src_path to dst_path
+def move_path(identifier, src_path, dst_path):
+    moved = select_under(identifier, src_path, 'path, size, mtime_ns, digest, version, origin')
+    replaced = {digest for digest, in select_under(identifier, dst_path, 'digest')}
+    # Only the index rows move, the blobs stay as they are however big the directory is
+    with Transaction():
+        index.execute('DELETE FROM files WHERE ' + UNDER_CONDITION, under_parameters(identifier, src_path))
+        for row in moved:
+            index.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (identifier, dst_path + row[0][len(src_path):]) + row[1:])
+    for digest in replaced:
+        release_blob(digest)
+
+
+# Bring the index of identifier up to date with its directory: files that are not in the index (created before the
+# store existed) or that changed since indexed are hashed again, and files that no longer exist are removed from it
+def import_directory(identifier):
+    indexed_paths = set()
+    for root, _, files in os.walk(identifier):
+        for file in files:
+            path = os.path.join(root, file)
+            relative_path = os.path.relpath(path, identifier)
+            indexed_paths.add(relative_path)
+            stat = os.stat(path)
+            entry = get_file_entry(identifier, relative_path)
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns) and has_blob(entry[2]):
+                continue
+            digest = hash_file(path)
+            if not has_blob(digest):
+                os.makedirs(os.path.dirname(blob_path(digest)), exist_ok=True)
+                os.link(path, blob_path(digest))
+            link_file(identifier, relative_path, digest)
+
+    with Transaction():
+        for relative_path, in index.execute('SELECT path FROM files WHERE identifier = ?', (identifier,)).fetchall():
+            if relative_path not in indexed_paths:
+                index.execute('DELETE FROM files WHERE identifier = ? AND path = ?', (identifier, relative_path))
+
+
+# Open the index, check it against the identifier directories and remove the blobs nothing refers to (the journals
+# are loaded before, so the blobs of their changes are kept)
+def load_store(identifiers):
+    os.makedirs(BLOBS_DIRECTORY, exist_ok=True)
+    open_index()
+    with Transaction():
+        for identifier, in index.execute('SELECT DISTINCT identifier FROM files').fetchall():
+            if identifier not in identifiers:
+                index.execute('DELETE FROM files WHERE identifier = ?', (identifier,))
+    for identifier in identifiers:
+        import_directory(identifier)
+
+    for root, _, files in os.walk(BLOBS_DIRECTORY):
+        for file in files:
+            # Compressed copy is named by the digest of its blob and the codec
+            if not is_blob_used(file.split('.')[0]):
+                os.remove(os.path.join(root, file))
@@ -0,0 +1,140 @@
+import hashlib
+import zlib
+
+# Content defined chunking: chunk boundaries depend only on the bytes around them, so an insert or delete in the
+# middle of a file changes only the chunks around the edit and the rest of the chunks keep their hashes.
+# A boundary is placed after two anchor bytes in a row, if the crc of the window that ends there matches the mask.
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+WINDOW_SIZE = 48
+BOUNDARY_MASK = (1 << 5) - 1
+READ_SIZE = 1024 * 1024
+
+# Files smaller than this are always sent whole
+DELTA_MIN_FILE_SIZE = 64 * 1024
+# Delta is kept in memory, so if it gets bigger than this the whole file is sent instead
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+
+# Delta operations
+COPY_CHUNK = 0
+LITERAL_CHUNK = 1
+
+DIGEST_SIZE = 32
+
+# Maps 1/16 of byte values to 1 (anchor bytes) and the others to 0, the same on every machine
+ANCHOR_TABLE = bytes.maketrans(bytes(range(256)),
+                               bytes(1 if hashlib.sha256(bytes([i])).digest()[0] < 16 else 0 for i in range(256)))
+ANCHOR_PAIR = b'\x01\x01'
+
+
+# Find where the chunk that starts at start ends, marks is data translated with ANCHOR_TABLE
+def find_chunk_end(data, marks, start):
+    end = min(start + MAX_CHUNK_SIZE, len(data))
+    position = start + MIN_CHUNK_SIZE
+    while position < end:
+        anchor = marks.find(ANCHOR_PAIR, position - 1, end)
+        if anchor == -1:
+            break
+        anchor += 1
+        if not zlib.crc32(data[anchor - WINDOW_SIZE + 1:anchor + 1]) & BOUNDARY_MASK:
+            return anchor + 1
+        position = anchor + 1
+
+    return end
+
+
+# Yield the chunks of file object f, reading it READ_SIZE bytes at a time
+def iter_chunks(f):
+    data = b''
+    eof = False
+    while not eof or data:
+        if not eof:
+            read_data = f.read(READ_SIZE)
+            eof = not read_data
+            data = data + read_data if data else read_data
+
+        marks = data.translate(ANCHOR_TABLE)
+        start = 0
+        # Last chunk of the buffer may be cut short by the buffer end, so keep it until we read more
+        while start < len(data) and (eof or len(data) - start >= MAX_CHUNK_SIZE):
+            end = find_chunk_end(data, marks, start)
+            yield data[start:end]
+            start = end
+        data = data[start:]
+
+
+# Chunk index is list of (digest, offset, length) of each chunk
+def index_chunks(f):
+    chunk_index = []
+    offset = 0
+    for chunk in iter_chunks(f):
+        chunk_index.append((hashlib.sha256(chunk).digest(), offset, len(chunk)))
+        offset += len(chunk)
+
+    return chunk_index
+
+
+def chunk_file(path):
+    with open(path, 'rb') as f:
+        return index_chunks(f)
+
+
+def index_digests(chunk_index):
+    return [digest for digest, _, _ in chunk_index]
+
+
+# Build delta of file in path against old chunk index: chunks that old content already has are sent as their digest,
+# and only the new chunks are sent as literal data. Return the delta and the chunk index of the new content,
+# or (None, None) if the delta gets bigger than DELTA_MAX_SIZE.
+def make_delta(path, old_index):
+    old_digests = set(index_digests(old_index))
+    delta = bytearray()
+    new_index = []
+    offset = 0
+    with open(path, 'rb') as f:
+        for chunk in iter_chunks(f):
+            digest = hashlib.sha256(chunk).digest()
+            if digest in old_digests:
+                delta += COPY_CHUNK.to_bytes(1, 'little') + digest
+            else:
+                delta += LITERAL_CHUNK.to_bytes(1, 'little') + len(chunk).to_bytes(4, 'little') + chunk
+                if len(delta) > DELTA_MAX_SIZE:
+                    return None, None
+            new_index.append((digest, offset, len(chunk)))
+            offset += len(chunk)
+
+    return bytes(delta), new_index
+
+
+# Rebuild the new content from delta and the old file in old_path into new_path.
+# Return the chunk index of the new content, or None if the old file doesn't have one of the copied chunks.
+def apply_delta(old_path, old_index, delta, new_path):
+    old_chunks = {digest: (offset, length) for digest, offset, length in old_index}
+    new_index = []
+    offset = 0
+    position = 0
+    with open(old_path, 'rb') as old_file, open(new_path, 'wb') as new_file:
+        while position < len(delta):
+            operation = delta[position]
+            position += 1
+            if operation == COPY_CHUNK:
+                digest = delta[position:position + DIGEST_SIZE]
+                position += DIGEST_SIZE
+                if digest not in old_chunks:
+                    return None
+                old_file.seek(old_chunks[digest][0])
+                chunk = old_file.read(old_chunks[digest][1])
+                # Old file can be changed since it was indexed, so verify the chunk before using it
+                if hashlib.sha256(chunk).digest() != digest:
+                    return None
+            else:
+                chunk_size = int.from_bytes(delta[position:position + 4], 'little')
+                position += 4
+                chunk = delta[position:position + chunk_size]
+                position += chunk_size
+                digest = hashlib.sha256(chunk).digest()
+            new_file.write(chunk)
+            new_index.append((digest, offset, len(chunk)))
+            offset += len(chunk)
+
+    return new_index
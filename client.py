@@ -1,9 +1,22 @@
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import os
+import shutil
 import socket
 import sys
+import threading
 import time
+import uuid
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
+import chunking
+import compression
+import metrics
+import protocol
+import sync_state
 
 # Client commands
 CREATE_COMMAND = 1
@@ -12,17 +25,108 @@ MODIFY_COMMAND = 3
 MOVE_COMMAND = 4
 PULL_COMMAND = 5
 UPDATES_COMMAND = 6
+SUBSCRIBE_COMMAND = 7
+DELTA_COMMAND = 8
+FETCH_COMMAND = 9
+HAVE_COMMAND = 10
+SESSION_COMMAND = 11
+ACK_COMMAND = 12
+MANIFEST_COMMAND = 13
+JOIN_COMMAND = 14
+BULK_FETCH_COMMAND = 15
+BATCH_COMMAND = 16
+# Server dropped the changes we didn't get yet, since we were too far behind, we compare with its manifest again
+RESYNC_COMMAND = 17
+
+# Command names in the metrics
+COMMAND_NAMES = {CREATE_COMMAND: 'create', DELETE_COMMAND: 'delete', MODIFY_COMMAND: 'modify', MOVE_COMMAND: 'move',
+                 DELTA_COMMAND: 'delta', FETCH_COMMAND: 'fetch', RESYNC_COMMAND: 'resync'}
+
+# Instead of is_identifier, we send this and then the codecs we have, before our other frames
+CAPABILITIES_MESSAGE = 2
+
+# We build files we got from server in temp file with the ignored pattern, so watchdog doesn't send it back
+TEMP_FILE_SUFFIX = '.goutputstream-sync'
+# Size of the pieces we read file data in
+FILE_CHUNK_SIZE = 64 * 1024
+IDENTIFIER_SIZE = 128
+# For files from this size we first send only the hash, the server may already have the content
+HAVE_MIN_FILE_SIZE = 1024 * 1024
+# Cursor the server never has, to open the session from the current server state
+FRESH_CURSOR = 2 ** 64 - 1
+# Files we ask from the server before we receive them, so the server doesn't keep too many open files for us
+FETCH_BATCH_SIZE = 256
+# If initial sync transfers at least this many files, they are split between BULK_STREAMS extra connections that
+# transfer in parallel, so one slow file or the round trips of one connection don't hold all the others
+BULK_MIN_FILES = 64
+BULK_STREAMS = 4
+# Small changes are collected into one batch frame, which is sent BATCH_DELAY seconds after its first change or when
+# it gets to BATCH_MAX_SIZE bytes. Files up to BATCH_FILE_SIZE are sent in the batch with their content.
+BATCH_DELAY = 0.005
+BATCH_MAX_SIZE = 256 * 1024
+BATCH_FILE_SIZE = 64 * 1024
+# Watchdog events wait until there were no events for QUIET_WINDOW seconds (or the oldest waits MAX_CHANGE_DELAY
+# seconds), and are merged before we send them, so a file saved with several events is sent once
+QUIET_WINDOW = 0.1
+MAX_CHANGE_DELAY = 2
+# Seconds we wait for watchdog to report the changes we made ourselves when we applied update from the server
+ECHO_WINDOW = 5
 
 observer = None
-
-
-# Start watchdog observer on base_path parameter
-def start_watchdog(base_path, s, identifier):
+# Watchdog thread and the thread that handles updates both send to the socket, so only one sends at a time. Each
+# socket has its own lock, so the bulk transfer connections send in parallel.
+send_locks = {}
+# Chunk index of the last synced content of files, by path
+chunk_indexes = {}
+# Buffered reader of each socket, everything we receive goes through it
+socket_readers = {}
+# Requests that wait for their reply on each socket bound to identifier: {socket: {request_id: (read_reply, future)}}
+pending_requests = {}
+pending_requests_lock = threading.Lock()
+# Thread that receives the replies and the pushed updates of each bound socket
+receive_threads = {}
+request_ids = itertools.count(protocol.PUSH_REQUEST_ID + 1)
+# Batch of small changes of each socket that batches its changes
+batchers = {}
+# Bit mask of the codecs we agreed on with the server on each socket, if it is not 0 each file body starts with its
+# codec
+socket_codecs = {}
+# Our session with the server and the last journal change of the server we applied, saved in the sync state so
+# after reconnect we get only the changes we missed
+session = None
+session_cursor = 0
+# Events we cause when we apply updates from the server, that watchdog reports back to us: [(command, path, dst_path,
+# expire time)]
+expected_events = []
+expected_events_lock = threading.Lock()
+# Held while we compare with the manifest after RESYNC_COMMAND, so another one waits until the first finished
+resync_lock = threading.Lock()
+# Thread that sends the frames of the receive threads (acks, fetch requests and the files the server asks for). The
+# server stops reading from us while too much waits to be sent to us, so a receive thread never waits for the socket.
+reply_sender = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+# Metrics of the client, served with --metrics-port or written with --metrics-file
+watchdog_events = metrics.Counter('sync_client_watchdog_events_total', 'File events from watchdog, by event',
+                                  ('event',))
+upload_seconds = metrics.Histogram('sync_client_upload_seconds', 'Time to send one local change, by command',
+                                   ('command',))
+change_delay_seconds = metrics.Histogram('sync_client_change_delay_seconds',
+                                         'Time from the first file event of the waiting changes until they were sent')
+updates = metrics.Counter('sync_client_updates_total', 'Updates received from the server, by command', ('command',))
+update_seconds = metrics.Histogram('sync_client_update_seconds', 'Time to apply one update from the server, by command',
+                                   ('command',))
+conflicts = metrics.Counter('sync_client_conflicts_total',
+                            'Updates from the server that met local changes the server does not have yet, by command',
+                            ('command',))
+
+
+# Start watchdog observer on base_path parameter, event_handler replaces the Handler that sends the changes on s
+def start_watchdog(base_path, s, identifier, quiet_window=QUIET_WINDOW, event_handler=None):
     global observer
     if observer:
         return
     # Initialize logging event handler
-    event_handler = Handler(base_path, s, identifier)
+    event_handler = event_handler or Handler(base_path, s, identifier, quiet_window)
 
     # Initialize Observer
     observer = Observer()
@@ -48,54 +152,413 @@ def wait_observer():
         observer.join()
 
 
-class ClientDisconnectedException(BaseException):
-    def __init__(self):
-        super().__init__(self, "Client Disconnected")
+ClientDisconnectedException = protocol.ClientDisconnectedException
 
 
-def recv(client_socket, recv_size):
-    recv_data = b''
-    while len(recv_data) < recv_size:
-        recv_data += client_socket.recv(recv_size - len(recv_data))
+# Return the reader of socket. Only one thread receives on a socket at a time, and it never reads the socket itself,
+# since the reader may already hold the bytes that come next.
+def get_reader(s):
+    reader = socket_readers.get(s)
+    if reader is None:
+        reader = socket_readers[s] = protocol.SocketReader(s)
+    return reader
 
-    return recv_data
 
+# Agree with the server on the codecs we compress file bodies with on socket
+def negotiate_compression(s):
+    send_packet(s, CAPABILITIES_MESSAGE.to_bytes(1, 'little') + compression.SUPPORTED_CODECS.to_bytes(1, 'little'))
+    socket_codecs[s] = get_reader(s).read_int(1)
 
-# First connection to server with identifier, we receive all directory
-def pull_all_from_server(identifier, s, base_path):
-    is_identifier = 1
-    is_identifier = is_identifier.to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    updates = PULL_COMMAND.to_bytes(1, 'little')
-    data = is_identifier + identifier + updates
-    s.sendall(data)
-
-    while True:
-        command = s.recv(1)
-        # If empty array it means the server exit
-        if not command:
-            raise ClientDisconnectedException()
-        command = int.from_bytes(command, 'little', signed=True)
-        # If command == -1 it means we send invalid identifier
-        if command == -1:
+
+# Size of file body, after the codec of the body if we use compression on socket
+def build_body_header(s, codec, size):
+    header = codec.to_bytes(1, 'little') if socket_codecs.get(s) else b''
+    return header + size.to_bytes(8, 'little')
+
+
+# Return (version, codec, size) of file body the server sends, after its path. The codec is there only if the
+# connection uses compression (codecs is not 0).
+def read_file_header(reader, codecs):
+    version = reader.unpack(protocol.VERSION)[0]
+    codec = reader.read_int(1) if codecs else compression.RAW
+    return version, codec, reader.unpack(protocol.UINT64)[0]
+
+
+# Return (version, delta) of DELTA the server sends, after its path
+def read_delta(reader):
+    version = reader.unpack(protocol.VERSION)[0]
+    return version, reader.read(reader.unpack(protocol.UINT32)[0])
+
+
+# Path in our directory of path the server sent
+def local_path(base_path, sent_path):
+    path = os.path.join(base_path, sent_path)
+    path = path.replace("/", os.sep)
+    return path.replace('\\', os.sep)
+
+
+# Bind socket to identifier: the identifier is sent once, and then only commands. From now on everything we receive on
+# the socket is received by its receive thread.
+def bind_connection(s, identifier, base_path):
+    with pending_requests_lock:
+        pending_requests[s] = {}
+    send_packet(s, int(1).to_bytes(1, 'little') + identifier.encode('utf-8'))
+    receive_threads[s] = threading.Thread(target=receive_replies, args=(identifier, s, base_path), daemon=True)
+    receive_threads[s].start()
+
+
+# Send request and return future of its reply, so we can send more frames before the reply arrives. read_reply reads
+# the reply in the receive thread, and what it returns is the result of the future.
+def send_request(s, command, read_reply, fields=b''):
+    request_id = next(request_ids)
+    future = concurrent.futures.Future()
+    with pending_requests_lock:
+        requests = pending_requests.get(s)
+        # The receive thread already stopped
+        if requests is None:
             raise ClientDisconnectedException()
-        # If we got the special packet that indicates there is no more files
-        if command != CREATE_COMMAND:
-            break
-        is_directory = int.from_bytes(s.recv(1), 'little')
-        path_size = int.from_bytes(s.recv(4), 'little')
-        path = os.path.join(base_path, s.recv(path_size).decode('utf-8'))
-        path = path.replace("/", os.sep)
-        path = path.replace('\\', os.sep)
-        if is_directory:
-            os.makedirs(path, exist_ok=True)
-            continue
-        file_size = int.from_bytes(s.recv(4), 'little')
-        file_data = recv(s, file_size)
+        requests[request_id] = (read_reply, future)
+    send_packet(s, command.to_bytes(1, 'little') + protocol.REQUEST_ID.pack(request_id) + fields)
+    return future
+
+
+# Receive thread of bound socket: each reply goes to the request it answers, and the update batches the server pushes
+# are applied. When the socket disconnects, the requests that wait for reply fail.
+def receive_replies(identifier, s, base_path):
+    reader = get_reader(s)
+    try:
+        while True:
+            request_id = reader.unpack(protocol.REQUEST_ID)[0]
+            if request_id == protocol.PUSH_REQUEST_ID:
+                receive_updates_from_server(identifier, s, base_path)
+                continue
+            with pending_requests_lock:
+                read_reply, future = pending_requests[s].pop(request_id)
+            # The reply we could not read fails its request too, not only the requests still waiting
+            try:
+                reply = read_reply()
+            except BaseException as error:
+                future.set_exception(error)
+                raise
+            future.set_result(reply)
+    except (ClientDisconnectedException, OSError):
+        pass
+    finally:
+        with pending_requests_lock:
+            requests = pending_requests.pop(s)
+        for _, future in requests.values():
+            future.set_exception(ClientDisconnectedException())
+
+
+def get_send_lock(s):
+    return send_locks.setdefault(s, threading.Lock())
+
+
+def send_packet(s, packet):
+    with get_send_lock(s):
+        flush_batch(s)
+        s.sendall(packet)
+
+
+# Called from receive thread, function sends from the reply sender thread in the order of the calls. If the server
+# disconnected, the receive thread finds out.
+def send_from_reply_sender(function, *args, **kwargs):
+    reply_sender.submit(function, *args, **kwargs)
+
+
+# Collects small change packets of socket into one batch frame, and sends it from its own thread when the batch is
+# BATCH_DELAY seconds old. It uses the send lock of the socket, so the batch and the other packets keep their order.
+class PacketBatcher:
+    def __init__(self, s):
+        self.socket = s
+        self.records = bytearray()
+        self.deadline = None
+        self.closed = False
+        self.condition = threading.Condition(get_send_lock(s))
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Called with the send lock
+    def add(self, packet):
+        self.records += packet
+        if len(self.records) >= BATCH_MAX_SIZE:
+            self.flush()
+        elif self.deadline is None:
+            self.deadline = time.monotonic() + BATCH_DELAY
+            self.condition.notify()
+
+    # Called with the send lock
+    def flush(self):
+        self.deadline = None
+        if not self.records:
+            return
+        records = self.records
+        self.records = bytearray()
+        self.socket.sendall(BATCH_COMMAND.to_bytes(1, 'little') + len(records).to_bytes(4, 'little') + records)
+
+    def run(self):
+        with self.condition:
+            while not self.closed:
+                if self.deadline is None:
+                    self.condition.wait()
+                elif self.deadline > time.monotonic():
+                    self.condition.wait(self.deadline - time.monotonic())
+                else:
+                    try:
+                        self.flush()
+                    except OSError:
+                        # The thread that receives from the socket finds out that the server disconnected
+                        self.closed = True
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+# From now on the small changes we send on socket are batched
+def start_batching(s):
+    batchers[s] = PacketBatcher(s)
+
+
+# Send the batch of socket and stop batching its changes
+def stop_batching(s):
+    batcher = batchers.pop(s, None)
+    if batcher:
+        with get_send_lock(s):
+            batcher.flush()
+        batcher.close()
+
+
+# Called with the send lock, the batch is sent before the packet we send now
+def flush_batch(s):
+    batcher = batchers.get(s)
+    if batcher:
+        batcher.flush()
+
+
+# Send packet of a change, small packet goes into the batch of the socket if it batches its changes
+def send_change_packet(s, packet):
+    batcher = batchers.get(s)
+    if not batcher or len(packet) > BATCH_MAX_SIZE:
+        send_packet(s, packet)
+        return
+    with get_send_lock(s):
+        batcher.add(packet)
+
+
+# Send header with the file size and then the file body straight from the file.
+# Return version (stat, hash) of the file we sent, or None if can't read the file.
+def send_file_packet(s, header, file_path):
+    try:
+        f = open(file_path, 'rb')
+    except (PermissionError, FileNotFoundError):
+        return None
+
+    with f:
+        file_stat = os.fstat(f.fileno())
+        file_size = file_stat.st_size
+        body = read_file_body(f, file_size, socket_codecs.get(s), s in batchers)
+        if body:
+            codec, data = body
+            if s in batchers and len(data) <= BATCH_FILE_SIZE:
+                send_change_packet(s, header + build_body_header(s, codec, len(data)) + data)
+            else:
+                send_packet(s, header + build_body_header(s, codec, len(data)) + data)
+        else:
+            with get_send_lock(s):
+                flush_batch(s)
+                s.sendall(header + build_body_header(s, compression.RAW, file_size))
+                sent = s.sendfile(f, 0, file_size) if file_size else 0
+                for padding in iter_padding(file_size - sent):
+                    s.sendall(padding)
+
+    return get_sent_version(file_path, file_stat)
+
+
+# Return (codec, data) of file body we send from memory: small file that goes into the batch of the connection (if it
+# is batching), and file we may compress. Return None if the body is sent straight from the file.
+def read_file_body(f, file_size, codecs, batching):
+    if (batching and file_size <= BATCH_FILE_SIZE) \
+            or (codecs and compression.MIN_SIZE <= file_size <= compression.MAX_SIZE):
+        return compression.encode(f.read(file_size), codecs or 0)
+    return None
+
+
+# If the file got shorter while we send it, we fill the rest of the body so the frame stays valid (the modify event of
+# this change sends the right content)
+def iter_padding(size):
+    while size > 0:
+        padding_size = min(FILE_CHUNK_SIZE, size)
+        yield bytes(padding_size)
+        size -= padding_size
+
+
+# Return version (stat, hash) of the file we sent, file_stat is of when we opened it. If the file changed since we sent
+# it, we don't know the hash of what we sent and return None.
+def get_sent_version(file_path, file_stat):
+    file_version = read_file_version(file_path)
+    if file_version and is_same_file_version(file_version[0], file_stat):
+        return file_version
+    return None
+
+
+# Return (stat, hash) of the current content of file, or None if the file changed while we hashed it
+def read_file_version(path):
+    try:
+        stat = os.stat(path)
+        digest = hash_file(path)
+        if is_same_file_version(os.stat(path), stat):
+            return stat, digest.hex()
+    except (PermissionError, FileNotFoundError):
+        pass
+    return None
+
+
+# Receive file body into temp file and replace the file with it only when the whole body arrived.
+# Return version (stat, hash) of the file.
+# Compressed body is decompressed as it arrives, file_size is the size of the body on the wire.
+def receive_file(s, path, file_size, codec=compression.RAW):
+    writer = FileWriter(path, codec)
+    try:
+        for piece in get_reader(s).iter_body(file_size):
+            writer.write(piece)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+
+# Writes file body we receive into temp file, decompressing and hashing it as the pieces arrive. The file is replaced
+# only by finish, after the whole body.
+class FileWriter:
+    def __init__(self, path, codec=compression.RAW):
+        make_directories(os.path.dirname(path))
+        self.path = path
+        self.temp_path = path + TEMP_FILE_SUFFIX
+        self.sha256 = hashlib.sha256()
+        self.decompressor = compression.Decompressor(codec) if codec != compression.RAW else None
+        self.file = open(self.temp_path, 'wb')
+
+    def write(self, piece):
+        self.write_content(self.decompressor.decompress(piece) if self.decompressor else piece)
+
+    def write_content(self, content):
+        self.file.write(content)
+        self.sha256.update(content)
+
+    # Replace the file, return version (stat, hash) of it
+    def finish(self):
+        if self.decompressor:
+            self.write_content(self.decompressor.flush())
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        return os.stat(self.path), self.sha256.hexdigest()
+
+    def abort(self):
+        self.file.close()
+        if os.path.isfile(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def is_same_file_version(stat, other_stat):
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (other_stat.st_ino, other_stat.st_size,
+                                                             other_stat.st_mtime_ns)
+
+
+# Save the version (stat, hash) of the content we synced in the sync state, and its chunk index (only big files are sent
+# as delta). If the file changed since then, we don't know which version the other side has, so we forget the index.
+# server_version is of content we got from the server, content we sent keeps the server version it was based on.
+def remember_synced_file(path, synced_version, server_version=None):
+    if synced_version:
+        sync_state.set_file(path, *synced_version, server_version)
+    try:
+        synced_stat = synced_version and synced_version[0]
+        if synced_stat and synced_stat.st_size >= chunking.DELTA_MIN_FILE_SIZE:
+            chunk_index = chunking.chunk_file(path)
+            if is_same_file_version(os.stat(path), synced_stat):
+                chunk_indexes[path] = chunk_index
+                return
+    except OSError:
+        pass
+    chunk_indexes.pop(path, None)
+
+
+def forget_synced_path(path):
+    sync_state.remove_path(path)
+    for indexed_path in list(chunk_indexes):
+        if indexed_path == path or indexed_path.startswith(path + os.sep):
+            del chunk_indexes[indexed_path]
+
+
+def move_synced_path(src_path, dst_path):
+    sync_state.move_path(src_path, dst_path)
+    for indexed_path in list(chunk_indexes):
+        if indexed_path == src_path or indexed_path.startswith(src_path + os.sep):
+            chunk_indexes[dst_path + indexed_path[len(src_path):]] = chunk_indexes.pop(indexed_path)
+
+
+# We are about to change path for update from the server, so watchdog event of the change isn't a change of the user
+def expect_event(command, path, dst_path=None):
+    with expected_events_lock:
+        expected_events.append((command, path, dst_path, time.monotonic() + ECHO_WINDOW))
+
+
+# Return True if the event is one we caused ourselves. Delete and move of directory come with events of everything under
+# it, so they match too.
+def is_expected_event(command, path, dst_path=None):
+    now = time.monotonic()
+    with expected_events_lock:
+        expected_events[:] = [event for event in expected_events if event[3] > now]
+        for expected_command, expected_path, expected_dst_path, _ in expected_events:
+            if expected_command != command:
+                continue
+            if command == CREATE_COMMAND and path == expected_path:
+                return True
+            if command == DELETE_COMMAND and is_under(path, expected_path):
+                return True
+            if command == MOVE_COMMAND and is_under(path, expected_path) \
+                    and dst_path == expected_dst_path + path[len(expected_path):]:
+                return True
+    return False
+
+
+# Create directory and the missing directories above it, the events of all of them are ours
+def make_directories(path):
+    missing_path = path
+    while missing_path and not os.path.isdir(missing_path):
+        expect_event(CREATE_COMMAND, missing_path)
+        missing_path = os.path.dirname(missing_path)
+    os.makedirs(path, exist_ok=True)
+
+
+# Return True if the file is the same as we synced it (at synced_path, if it moved since then), so the server has it
+def is_synced_file(path, synced_path=None):
+    synced_file = sync_state.get_file(synced_path or path)
+    if not synced_file:
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    size, mtime_ns, _, inode = synced_file
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino) == (size, mtime_ns, inode)
 
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb+') as f:
-            f.write(file_data)
+
+# Update from the server would overwrite changes of our copy of path that the server doesn't have yet (the file is not
+# as we synced it), so we keep them in a conflict copy. Watchdog sends the copy to the server as a new file, and the
+# change of path that waits is not sent, since path is then as we synced it.
+def keep_local_changes(path, command, version):
+    if os.path.isfile(path) and not is_synced_file(path):
+        save_local_copy(path, COMMAND_NAMES[command], version)
+
+
+# Copy our path to its conflict copy before version of the server replaces it, return the path of the copy
+def save_local_copy(path, reason, version):
+    conflicts.inc(reason)
+    copy_path = protocol.conflict_path(path, 'local %d' % version)
+    expect_event(CREATE_COMMAND, copy_path)
+    shutil.copy2(path, copy_path)
+    return copy_path
 
 
 def delete_recursive(path):
@@ -108,129 +571,508 @@ def delete_recursive(path):
         os.rmdir(path)
 
 
-def handle_command_from_server(command, is_directory, path, base_path, s):
+# Apply delta from server on our copy of the file, if our copy doesn't match the delta we ask for the whole file
+def apply_delta_from_server(identifier, s, path, base_path, version, delta):
+    if not apply_delta_to_file(path, version, delta):
+        send_from_reply_sender(send_fetch_message, s, identifier, base_path, path)
+
+
+# Return False if our copy of the file doesn't match the delta
+def apply_delta_to_file(path, version, delta):
+    new_index = None
+    temp_path = path + TEMP_FILE_SUFFIX
+    if os.path.isfile(path):
+        old_index = chunk_indexes.get(path) or chunking.chunk_file(path)
+        new_index = chunking.apply_delta(path, old_index, delta, temp_path)
+
+    if new_index is None:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        return False
+
+    os.replace(temp_path, path)
+    file_version = read_file_version(path)
+    if file_version:
+        sync_state.set_file(path, *file_version, version)
+    chunk_indexes[path] = new_index
+    return True
+
+
+def handle_command_from_server(identifier, command, is_directory, path, base_path, s):
     if command == CREATE_COMMAND:
         if is_directory:
-            os.makedirs(path, exist_ok=True)
+            make_directories(path)
             return
-        file_size = int.from_bytes(s.recv(4), 'little')
-        file_data = recv(s, file_size)
-
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb+') as f:
-            f.write(file_data)
+        version, codec, file_size = read_file_header(get_reader(s), socket_codecs.get(s))
+        keep_local_changes(path, command, version)
+        remember_synced_file(path, receive_file(s, path, file_size, codec), version)
     elif command == DELETE_COMMAND:
-        if not os.path.isdir(path):
-            if os.path.isfile(path):
-                # If it file
-                os.remove(path)
-        else:
-            delete_recursive(path)
+        delete_from_server(path)
     elif command == MODIFY_COMMAND:
-        file_size = int.from_bytes(s.recv(4), 'little')
-        file_data = recv(s, file_size)
-
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb+') as f:
-            f.write(file_data)
+        version, codec, file_size = read_file_header(get_reader(s), socket_codecs.get(s))
+        keep_local_changes(path, command, version)
+        remember_synced_file(path, receive_file(s, path, file_size, codec), version)
+    elif command == DELTA_COMMAND:
+        version, delta = read_delta(get_reader(s))
+        keep_local_changes(path, command, version)
+        apply_delta_from_server(identifier, s, path, base_path, version, delta)
+    elif command == FETCH_COMMAND:
+        # Server couldn't apply our delta, so we send the whole file
+        send_from_reply_sender(send_modify_message, s, identifier, base_path, path, False, use_delta=False)
     elif command == MOVE_COMMAND:
-        dst_path_size = int.from_bytes(s.recv(4), 'little')
-        dst_path = os.path.join(base_path, s.recv(dst_path_size).decode('utf-8'))
-        dst_path = dst_path.replace("/", os.sep)
-        dst_path = dst_path.replace('\\', os.sep)
+        move_from_server(path, local_path(base_path, get_reader(s).read_path()), is_directory)
+    elif command == RESYNC_COMMAND:
+        # The receive thread receives the replies of the sync, so it runs in a thread of its own
+        threading.Thread(target=resync_with_server, args=(identifier, s, base_path), daemon=True).start()
+
+
+def delete_from_server(path):
+    # Changes of the file the server doesn't have yet are kept, the change that waits sends the file again
+    if os.path.isfile(path) and not is_synced_file(path):
+        conflicts.inc(COMMAND_NAMES[DELETE_COMMAND])
+        forget_synced_path(path)
+        return
+    # The path is forgotten before it is deleted, so the delete events find it already deleted on the server
+    expect_event(DELETE_COMMAND, path)
+    forget_synced_path(path)
+    if not os.path.isdir(path):
+        if os.path.isfile(path):
+            # If it file
+            os.remove(path)
+    else:
+        delete_recursive(path)
 
-        # If is file and destination path exists we delete it
-        if not is_directory and os.path.isfile(dst_path):
-            os.remove(dst_path)
 
-        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+def move_from_server(path, dst_path, is_directory):
+    # Rename of directory is one event (and the events of what is under it), however big the directory is
+    expect_event(MOVE_COMMAND, path, dst_path)
+
+    # If is file and destination path exists we delete it
+    if not is_directory and os.path.isfile(dst_path):
+        expect_event(DELETE_COMMAND, dst_path)
+        forget_synced_path(dst_path)
+        os.remove(dst_path)
+
+    make_directories(os.path.dirname(dst_path))
+
+    # If path is dir and the source dir is empty dir, we delete it, otherwise rename the file
+    if is_directory and os.path.isdir(dst_path):
+        if not os.listdir(path):
+            expect_event(DELETE_COMMAND, path)
+            os.rmdir(path)
+    else:
+        os.rename(path, dst_path)
+    move_synced_path(path, dst_path)
 
-        # If path is dir and the source dir is empty dir, we delete it, otherwise rename the file
-        if is_directory and os.path.isdir(dst_path):
-            if not os.listdir(path):
-                os.rmdir(path)
-        else:
-            os.rename(path, dst_path)
 
+# Compare our files with the manifest of the server and transfer the files that differ, like at startup when the
+# session can't resume. The files as we synced them are what we got from the server so far.
+def resync_with_server(identifier, s, base_path):
+    with resync_lock:
+        try:
+            synced_files = sync_state.get_files()
+            local_files, local_directories = scan_local_manifest(base_path, synced_files)
+            server_files, server_directories = get_server_manifest(identifier, s)
+            sync_state.replace_files(sync_with_server(identifier, s, base_path, local_files, local_directories,
+                                                      server_files, server_directories, synced_files))
+        except (OSError, ClientDisconnectedException):
+            pass
 
+
+# Ask the server for the updates, they are applied by the receive thread. Return future of the reply.
 def pull_updates_from_server(identifier, s, base_path):
-    is_identifier = 1
-    is_identifier = is_identifier.to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    updates = UPDATES_COMMAND.to_bytes(1, 'little')
-    data = is_identifier + identifier + updates
-    s.sendall(data)
+    return send_request(s, UPDATES_COMMAND, functools.partial(receive_updates_from_server, identifier, s, base_path))
 
-    counts = s.recv(4)
-    if not counts:
-        raise ClientDisconnectedException()
 
-    counts = int.from_bytes(counts, 'little')
+# Ask the server to push updates as soon as they happen instead of waiting for UPDATES_COMMAND
+def subscribe_to_server_updates(identifier, s):
+    send_packet(s, SUBSCRIBE_COMMAND.to_bytes(1, 'little'))
+
+
+# Receive packets count and journal cursor, apply each update packet and then save the cursor
+def receive_updates_from_server(identifier, s, base_path):
+    global session_cursor
+    reader = get_reader(s)
+    counts, cursor = reader.unpack(protocol.UPDATES_HEADER)
     for _ in range(counts):
-        command = int.from_bytes(s.recv(1), 'little')
-        is_directory = int.from_bytes(s.recv(1), 'little')
-        path_size = int.from_bytes(s.recv(4), 'little')
-        path = os.path.join(base_path, s.recv(path_size).decode('utf-8'))
-        path = path.replace("/", os.sep)
-        path = path.replace('\\', os.sep)
-        handle_command_from_server(command, is_directory, path, base_path, s)
+        command, is_directory, path = reader.read_update()
+        name = COMMAND_NAMES.get(command, 'unknown')
+        updates.inc(name)
+        with update_seconds.time(name):
+            handle_command_from_server(identifier, command, is_directory, local_path(base_path, path), base_path, s)
+
+    if cursor != session_cursor:
+        session_cursor = cursor
+        sync_state.save_cursor(session_cursor)
+        send_from_reply_sender(send_ack_message, s, identifier)
+
+
+# Open our session with the server, return True if the server still has all the changes we missed.
+# With fresh the session starts from the current server state.
+def open_session(identifier, s, fresh=False):
+    global session, session_cursor
+    if not session:
+        session = uuid.uuid4().hex
+    cursor = FRESH_CURSOR if fresh else session_cursor
+    reply = send_request(s, SESSION_COMMAND, functools.partial(get_reader(s).unpack, protocol.SESSION_REPLY),
+                         session.encode('utf-8') + cursor.to_bytes(8, 'little'))
+
+    resumed, session_cursor = reply.result()
+    return resumed == 1
+
+
+# Tell the server we applied the changes up to our cursor
+def send_ack_message(s, identifier):
+    send_packet(s, build_ack_packet(session_cursor))
 
 
-def push_file_to_server(identifier, s, file_path, base_path):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    create = CREATE_COMMAND.to_bytes(1, 'little')
+def build_ack_packet(cursor):
+    return ACK_COMMAND.to_bytes(1, 'little') + cursor.to_bytes(8, 'little')
+
+
+# With use_have False big files are sent whole too, on bulk transfer connections nobody reads the server answer to HAVE
+def push_file_to_server(identifier, s, file_path, base_path, use_have=True):
+    push = prepare_push(file_path, base_path, use_have)
+    if push is None:
+        return
+    action, value = push
+    if action == 'directory':
+        send_change_packet(s, value)
+    elif action == 'have':
+        if value:
+            send_change_packet(s, value[0])
+        remember_synced_file(file_path, value and value[1])
+    else:
+        remember_synced_file(file_path, send_file_packet(s, value, file_path))
+
+
+# Decide how file is pushed, return (action, value): 'directory' with the packet of directory, 'have' with
+# (packet, version (stat, hash)) of HAVE (None if we can't read the file), or 'file' with the header of the file we
+# send the body of. Return None if the file doesn't exist anymore.
+def prepare_push(file_path, base_path, use_have=True):
     # Append listening directory name with file path
     sent_file_path = os.path.relpath(file_path, base_path)
-    path_size = len(sent_file_path).to_bytes(4, 'little')
-    is_directory = os.path.isdir(file_path).to_bytes(1, 'little')
     if os.path.isdir(file_path):
-        packet_to_send = is_identifier + identifier + create + is_directory + path_size + sent_file_path.encode('utf-8')
-    else:
-        # If the file is not exists we return
-        if not os.path.isfile(file_path):
-            return
+        return 'directory', protocol.build_path_frame(CREATE_COMMAND, 1, sent_file_path)
+    try:
+        file_size = os.path.getsize(file_path) if os.path.isfile(file_path) else None
+    except OSError:
+        file_size = None
+    if file_size is None:
+        return None
+
+    # Big file may be copy of file the server already has, so we send its hash and the server asks for the content
+    # only if it doesn't have it
+    if use_have and file_size >= HAVE_MIN_FILE_SIZE:
+        return 'have', build_have_packet(sent_file_path, file_path)
+    return 'file', protocol.build_path_frame(CREATE_COMMAND, 0, sent_file_path) \
+        + protocol.VERSION.pack(sync_state.get_version(file_path))
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(FILE_CHUNK_SIZE * 16)
+            if not data:
+                break
+            sha256.update(data)
 
-        try:
-            with open(file_path, 'rb') as f:
-                data = f.read()
-        except PermissionError:
-            return
+    return sha256.digest()
 
-        file_size = len(data).to_bytes(4, 'little')
-        packet_to_send = is_identifier + identifier + create + is_directory + path_size + sent_file_path.encode(
-            'utf-8') + file_size + data
-    s.sendall(packet_to_send)
 
+# Return (packet, version (stat, hash)) of HAVE_COMMAND of the file, or None if can't read the file
+def build_have_packet(sent_file_path, file_path):
+    file_version = read_file_version(file_path)
+    if not file_version:
+        return None
+    digest = bytes.fromhex(file_version[1])
 
-def push_all_to_server(identifier, s, path):
-    for root, subdirs, files in os.walk(path):
-        for file in files:
-            push_file_to_server(identifier, s, os.path.join(root, file), path)
-        for subdir in subdirs:
-            if not os.listdir(os.path.join(root, subdir)):
-                push_file_to_server(identifier, s, os.path.join(root, subdir), path)
+    packet = protocol.build_path_frame(HAVE_COMMAND, 0, sent_file_path) \
+        + protocol.VERSION.pack(sync_state.get_version(file_path)) + digest
+    return packet, file_version
 
 
 def first_connected_to_server(identifier, s, path):
-    if identifier:
-        # If we accept identifier from command line, we remove the local path directory and get all files from server
-        delete_recursive(path)
-        pull_all_from_server(identifier, s, path)
-        return identifier
-    else:
-        # If we dont accepted identifier from command line, we got one from the server and push all files to server
+    global session, session_cursor
+    os.makedirs(path, exist_ok=True)
+    sync_state.open_state(path)
+    saved_session = sync_state.get_session()
+    # Manifest of our files as we synced them last time, it is also the hash cache of the local manifest
+    cached_files = sync_state.get_files()
+    local_files, local_directories = scan_local_manifest(path, cached_files)
+    if not identifier:
+        # If we dont accepted identifier from command line, we got one from the server
         identifier = get_identifier_from_server(s)
-        push_all_to_server(identifier, s, path)
-        return identifier
+    bind_connection(s, identifier, path)
+    # If we never synced this directory with the identifier (or stopped in the middle), we have nothing to compare with
+    synced_files = None
+    if saved_session and saved_session[0] == identifier:
+        synced_files = cached_files
+        _, session, session_cursor = saved_session
+        # If nothing changed here since we synced, we get only the changes we missed. State of older version has no
+        # server versions, we get them from the manifest.
+        if synced_files == local_files and not sync_state.versions_missing and open_session(identifier, s):
+            return identifier
+
+    # Otherwise we compare our files with the manifest of the server and transfer only the files that differ.
+    # The session is saved only when we finished, so if we stop in the middle we compare again.
+    sync_state.clear_session()
+    open_session(identifier, s, fresh=True)
+    server_files, server_directories = get_server_manifest(identifier, s)
+    synced_files = sync_with_server(identifier, s, path, local_files, local_directories, server_files,
+                                    server_directories, synced_files)
+    sync_state.replace_files(synced_files)
+    sync_state.save_session(identifier, session, session_cursor)
+    return identifier
+
+
+# Return manifest of our files {path: (size, mtime_ns, hash, inode)} and set of our empty directories. Each entry is
+# only stat'ed (os.scandir), and files that have the same size, mtime and inode as in cached_files are not read and
+# hashed again. A directory is empty if its scan found nothing in it.
+def scan_local_manifest(base_path, cached_files):
+    files = {}
+    directories = set()
+    # (path, relative path) of directories to scan
+    pending = [(base_path, '')]
+    while pending:
+        directory, relative_directory = pending.pop()
+        try:
+            with os.scandir(directory) as scanned:
+                entries = list(scanned)
+        except (PermissionError, FileNotFoundError):
+            continue
+        if not entries and relative_directory:
+            directories.add(relative_directory)
+        for entry in entries:
+            relative_path = os.path.join(relative_directory, entry.name)
+            if entry.is_dir():
+                # Like os.walk, we don't go into symbolic links to directories
+                if not entry.is_symlink():
+                    pending.append((entry.path, relative_path))
+                continue
+            if Handler.IGNORE_PATTERN in entry.name:
+                continue
+            try:
+                stat = entry.stat()
+                cached = cached_files.get(relative_path)
+                # Inode 0 is of state saved by older version, which didn't keep inodes
+                if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns) and cached[3] in (0, stat.st_ino):
+                    files[relative_path] = cached[:3] + (stat.st_ino,)
+                else:
+                    files[relative_path] = (stat.st_size, stat.st_mtime_ns, hash_file(entry.path).hex(), stat.st_ino)
+            except (PermissionError, FileNotFoundError):
+                continue
+
+    return files, directories
+
+
+# Receive the manifest of the server: {path: (size, mtime_ns, hash, version)} of files and set of empty directories
+def get_server_manifest(identifier, s):
+    return send_request(s, MANIFEST_COMMAND, functools.partial(receive_manifest, s)).result()
+
+
+def receive_manifest(s):
+    reader = get_reader(s)
+    files = {}
+    directories = set()
+    # Until we got the special packet that indicates there are no more entries
+    for entry in iter(reader.read_manifest_entry, None):
+        path = entry.path.replace("/", os.sep)
+        path = path.replace('\\', os.sep)
+        if entry.is_directory:
+            directories.add(path)
+        else:
+            files[path] = (entry.size, entry.mtime_ns, entry.digest, entry.version)
+
+    return files, directories
+
+
+# Decide what to do with path that differs: 'push', 'pull', 'conflict', 'delete local', 'delete server' or None if it
+# is the same. If we synced before (synced_files is not None), the side that changed since then wins, and if both
+# changed (or we never synced and both have the file) it is 'conflict': we keep our copy in a conflict copy and pull the
+# version of the server. Deleted file loses to the other side's change, and if we never synced nothing is deleted.
+# Our write that the server failed to store is sent again: the server has no newer version of the file than the one
+# the write was based on (or doesn't have our new file, which never got a version from it), by synced_versions
+# {path: version} if we know them.
+def choose_sync_action(path, local_files, server_files, synced_files, synced_versions=None):
+    local_digest = local_files[path][2] if path in local_files else None
+    server_digest = server_files[path][2] if path in server_files else None
+    if local_digest == server_digest:
+        return None
+
+    if synced_files is not None:
+        synced_digest = synced_files[path][2] if path in synced_files else None
+        if server_digest == synced_digest:
+            return 'push' if local_digest else 'delete server'
+        if local_digest == synced_digest:
+            if local_digest and synced_versions is not None \
+                    and is_lost_write(server_files.get(path), synced_versions.get(path, 0)):
+                return 'push'
+            return 'pull' if server_digest else 'delete local'
+
+    if local_digest and server_digest:
+        return 'conflict'
+    return 'pull' if server_digest else 'push'
+
+
+# Server file (size, mtime_ns, hash, version) or None didn't get our synced write based on synced_version
+def is_lost_write(server_file, synced_version):
+    if server_file is None:
+        return synced_version == 0
+    return server_file[3] <= synced_version
+
+
+# Ask the server for files (relative paths), the requests of all batches are sent before we wait for the answers so
+# the server never waits for us between batches. Return {path: version (stat, hash)} of the files we got.
+def pull_files(identifier, s, base_path, paths):
+    replies = []
+    for i in range(0, len(paths), FETCH_BATCH_SIZE):
+        batch = paths[i:i + FETCH_BATCH_SIZE]
+        replies.append(send_request(s, BULK_FETCH_COMMAND, functools.partial(receive_fetched_files, s, base_path),
+                                    len(batch).to_bytes(4, 'little')
+                                    + b''.join(protocol.build_path(path) for path in batch)))
+
+    versions = {}
+    for reply in replies:
+        versions.update(reply.result())
+
+    return versions
+
+
+# Receive the files of one bulk fetch that the server has, and then empty message. Return {path: version (stat, hash)}
+# of the files.
+def receive_fetched_files(s, base_path):
+    reader = get_reader(s)
+    versions = {}
+    while reader.read_int(1):
+        path = reader.read_path_frame().path
+        path = path.replace("/", os.sep)
+        path = path.replace('\\', os.sep)
+        server_version, codec, file_size = read_file_header(reader, socket_codecs.get(s))
+        file_path = os.path.join(base_path, path)
+        versions[path] = receive_file(s, file_path, file_size, codec)
+        remember_synced_file(file_path, versions[path], server_version)
+
+    return versions
+
+
+# Open another connection to the server for bulk transfer, it joins our session so the server doesn't send back the
+# files we push on it
+def open_data_connection(identifier, s, base_path):
+    data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    data_socket.connect(s.getpeername())
+    negotiate_compression(data_socket)
+    bind_connection(data_socket, identifier, base_path)
+    send_packet(data_socket, JOIN_COMMAND.to_bytes(1, 'little') + session.encode('utf-8'))
+    return data_socket
+
+
+def close_data_connection(data_socket):
+    stop_batching(data_socket)
+    send_locks.pop(data_socket, None)
+    socket_codecs.pop(data_socket, None)
+    # Wakes the receive thread, which forgets the socket
+    try:
+        data_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    receive_threads.pop(data_socket).join()
+    socket_readers.pop(data_socket, None)
+    data_socket.close()
+
+
+# Push and pull files (relative paths) on BULK_STREAMS connections in parallel, each connection transfers its share of
+# the files. Return {path: version (stat, hash)} of the files we pulled.
+def transfer_in_streams(identifier, s, base_path, to_push, to_fetch):
+    def transfer(stream):
+        data_socket = open_data_connection(identifier, s, base_path)
+        start_batching(data_socket)
+        try:
+            for path in to_push[stream::BULK_STREAMS]:
+                push_file_to_server(identifier, data_socket, os.path.join(base_path, path), base_path, use_have=False)
+            return pull_files(identifier, data_socket, base_path, to_fetch[stream::BULK_STREAMS])
+        finally:
+            close_data_connection(data_socket)
+
+    versions = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BULK_STREAMS) as executor:
+        for stream_versions in executor.map(transfer, range(BULK_STREAMS)):
+            versions.update(stream_versions)
+
+    return versions
+
+
+# Transfer the files that differ between us and the server in both directions, return the manifest after the sync
+# {path: (size, mtime_ns, hash, inode, version)}
+def sync_with_server(identifier, s, base_path, local_files, local_directories, server_files, server_directories,
+                     synced_files):
+    to_push = []
+    to_fetch = []
+    # Conflict copies of our changes that the server version replaces, {relative path of copy: hash}
+    copies = {}
+    manifest = dict(local_files)
+    # State of older version has no versions, so we can't tell what writes the server lost
+    synced_versions = sync_state.get_versions() \
+        if synced_files is not None and not sync_state.versions_missing else None
+    for path in sorted(set(local_files) | set(server_files)):
+        action = choose_sync_action(path, local_files, server_files, synced_files, synced_versions)
+        file_path = os.path.join(base_path, path)
+        # The server didn't change the file since we synced it, so our write is based on the version it has
+        if action in ('push', 'delete server') and path in server_files:
+            sync_state.set_version(file_path, server_files[path][3])
+        if action == 'push':
+            to_push.append(path)
+        elif action == 'delete server':
+            send_delete_message(s, identifier, base_path, file_path, False)
+        elif action == 'delete local':
+            if os.path.isfile(file_path):
+                expect_event(DELETE_COMMAND, file_path)
+                os.remove(file_path)
+            forget_synced_path(file_path)
+            manifest.pop(path)
+        elif action == 'pull':
+            to_fetch.append(path)
+        elif action == 'conflict':
+            copy_path = save_local_copy(file_path, 'sync', server_files[path][3])
+            copies[os.path.relpath(copy_path, base_path)] = local_files[path][2]
+            to_fetch.append(path)
+    # Watchdog may not run yet, so the copies are pushed with the other files
+    to_push.extend(copies)
+
+    # Empty directories are only added, never deleted
+    for path in sorted(local_directories - server_directories):
+        push_file_to_server(identifier, s, os.path.join(base_path, path), base_path)
+    for path in server_directories - local_directories:
+        make_directories(os.path.join(base_path, path))
+
+    if len(to_push) + len(to_fetch) >= BULK_MIN_FILES:
+        versions = transfer_in_streams(identifier, s, base_path, to_push, to_fetch)
+    else:
+        for path in to_push:
+            push_file_to_server(identifier, s, os.path.join(base_path, path), base_path)
+        versions = pull_files(identifier, s, base_path, to_fetch)
+
+    for path in to_fetch:
+        manifest.pop(path, None)
+        # If the file changed while we received it, we don't know its hash and it is hashed next time
+        if versions.get(path):
+            stat, digest = versions[path]
+            manifest[path] = (stat.st_size, stat.st_mtime_ns, digest, stat.st_ino)
+    for path, digest in copies.items():
+        stat = os.stat(os.path.join(base_path, path))
+        manifest[path] = (stat.st_size, stat.st_mtime_ns, digest, stat.st_ino)
+
+    # Our next writes are based on the versions the server has now, files it doesn't have yet are version 0
+    return {path: file + (server_files[path][3] if path in server_files else 0,) for path, file in manifest.items()}
 
 
 def get_identifier_from_server(s):
     is_identifier = 0
     is_identifier = is_identifier.to_bytes(1, 'little')
     data = is_identifier
-    s.sendall(data)
-    return s.recv(128).decode('utf-8')
+    send_packet(s, data)
+    return get_reader(s).read(IDENTIFIER_SIZE).decode('utf-8')
 
 
 # Send create message for update
@@ -240,96 +1082,358 @@ def send_create_message(client_socket, identifier, base_path, src_path, is_direc
 
 # Send delete message for update
 def send_delete_message(client_socket, identifier, base_path, file_path, is_directory):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    delete = DELETE_COMMAND.to_bytes(1, 'little')
+    send_change_packet(client_socket, build_delete_packet(base_path, file_path, is_directory))
+    forget_synced_path(file_path)
+
+
+def build_delete_packet(base_path, file_path, is_directory):
     # Append listening directory name with file path
     sent_file_path = os.path.relpath(file_path, base_path)
-    path_size = len(sent_file_path).to_bytes(4, 'little')
-    is_directory = is_directory.to_bytes(1, 'little')
+    return protocol.build_path_frame(DELETE_COMMAND, is_directory, sent_file_path) \
+        + protocol.VERSION.pack(sync_state.get_version(file_path))
 
-    packet = is_identifier + identifier + delete + is_directory + path_size + sent_file_path.encode('utf-8')
-    client_socket.sendall(packet)
+
+def send_modify_message(client_socket, identifier, base_path, file_path, is_directory, use_delta=True):
+    modify = prepare_modify(file_path, base_path, use_delta)
+    if modify is None:
+        return
+    action, value = modify
+    if action == 'delta':
+        packet, delta_stat, new_index = value
+        if packet:
+            send_change_packet(client_socket, packet)
+            remember_delta(file_path, delta_stat, new_index)
+    else:
+        remember_synced_file(file_path, send_file_packet(client_socket, value, file_path))
 
 
-def send_modify_message(client_socket, identifier, base_path, file_path, is_directory):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    modify = MODIFY_COMMAND.to_bytes(1, 'little')
+# Decide how modified file is sent, return (action, value): 'delta' with what build_delta_packet returns, or 'file'
+# with the header of the file we send the whole body of. Return None if it is not a file anymore.
+def prepare_modify(file_path, base_path, use_delta=True):
     # Append listening directory name with file path
     sent_file_path = os.path.relpath(file_path, base_path)
-    path_size = len(sent_file_path).to_bytes(4, 'little')
-    is_directory = is_directory.to_bytes(1, 'little')
 
     # If file doesn't exists, return
     if not os.path.isfile(file_path):
-        return
+        return None
 
-    try:
-        with open(file_path, 'rb') as f:
-            data = f.read()
-    except PermissionError:
-        return
+    # If we know what the server has and the file is big, we send only the chunks that changed
+    if use_delta:
+        delta = build_delta_packet(file_path, sent_file_path)
+        if delta:
+            return 'delta', delta
+
+    return 'file', protocol.build_path_frame(MODIFY_COMMAND, 0, sent_file_path) \
+        + protocol.VERSION.pack(sync_state.get_version(file_path))
 
-    data_size = len(data).to_bytes(4, 'little')
-    packet = is_identifier + identifier + modify + is_directory + path_size + sent_file_path.encode('utf-8') \
-             + data_size + data
 
-    client_socket.sendall(packet)
+# Return (packet, stat, chunk index) of the delta of big file from the content we synced, with packet None if there is
+# nothing to send. Return None if we send the whole file instead (no chunk index, small file or too big delta).
+def build_delta_packet(file_path, sent_file_path):
+    old_index = chunk_indexes.get(file_path)
+    try:
+        if not old_index or os.path.getsize(file_path) < chunking.DELTA_MIN_FILE_SIZE:
+            return None
+        delta_stat = os.stat(file_path)
+        delta, new_index = chunking.make_delta(file_path, old_index)
+    except (PermissionError, FileNotFoundError):
+        return None, None, None
+    # If no chunk changed it is our own write of server update (or save without change), nothing to send
+    if new_index and chunking.index_digests(new_index) == chunking.index_digests(old_index):
+        return None, None, None
+    if delta is None:
+        return None
+    packet = protocol.build_path_frame(DELTA_COMMAND, 0, sent_file_path) \
+        + protocol.VERSION.pack(sync_state.get_version(file_path)) + protocol.UINT32.pack(len(delta)) + delta
+    return packet, delta_stat, new_index
+
+
+# The server has the content we sent the delta of, if the file didn't change since
+def remember_delta(file_path, delta_stat, new_index):
+    file_version = read_file_version(file_path)
+    if file_version and is_same_file_version(file_version[0], delta_stat):
+        sync_state.set_file(file_path, *file_version)
+    chunk_indexes[file_path] = new_index
 
 
 def send_move_message(client_socket, identifier, base_path, src_path, dest_path, is_directory):
-    is_identifier = int(1).to_bytes(1, 'little')
-    identifier = identifier.encode('utf-8')
-    move = MOVE_COMMAND.to_bytes(1, 'little')
+    send_change_packet(client_socket, build_move_packet(base_path, src_path, dest_path, is_directory))
+    move_synced_path(src_path, dest_path)
+
+
+def build_move_packet(base_path, src_path, dest_path, is_directory):
     # Append listening directory name with file path
     sent_src_file_path = os.path.relpath(src_path, base_path)
-    src_path_size = len(sent_src_file_path).to_bytes(4, 'little')
     sent_dest_file_path = os.path.relpath(dest_path, base_path)
-    dest_path_size = len(sent_dest_file_path).to_bytes(4, 'little')
-    is_directory = is_directory.to_bytes(1, 'little')
+    return protocol.build_path_frame(MOVE_COMMAND, is_directory, sent_src_file_path) \
+        + protocol.build_path(sent_dest_file_path)
+
+
+# Ask the server for the whole file, when we can't apply delta it sent
+def send_fetch_message(client_socket, identifier, base_path, file_path):
+    send_packet(client_socket, build_fetch_packet(base_path, file_path))
+
+
+def build_fetch_packet(base_path, file_path):
+    return protocol.build_path_frame(FETCH_COMMAND, 0, os.path.relpath(file_path, base_path))
+
+
+# Change from watchdog that waits in the change queue, dst_path is only of move
+Change = collections.namedtuple('Change', ['command', 'path', 'is_directory', 'dst_path'], defaults=(None,))
+# Changes that send the content of the file as it is when they are sent
+CONTENT_COMMANDS = (CREATE_COMMAND, MODIFY_COMMAND)
+# Files of new directory we compare with the deleted one, to know if the directory was moved
+MOVED_DIRECTORY_SAMPLE = 16
+
+
+def is_under(path, parent):
+    return path == parent or path.startswith(parent + os.sep)
+
+
+# Change touches path if it changes path, something under it or a directory path is in
+def touches(change, path):
+    return any(is_under(change_path, path) or is_under(path, change_path)
+               for change_path in (change.path, change.dst_path) if change_path)
+
+
+# Some platforms report directory moved as deleted and created again. Return True if the files in new_path are the files
+# we synced in old_path: same size, mtime and inode.
+def is_same_directory(old_path, new_path):
+    sampled = 0
+    for root, _, files in os.walk(new_path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not is_synced_file(file_path, old_path + file_path[len(new_path):]):
+                return False
+            sampled += 1
+            if sampled == MOVED_DIRECTORY_SAMPLE:
+                return True
+    return sampled > 0
+
+
+# Staging queue between the watchdog events and the socket. Each event is merged with the changes already waiting:
+# create and then modify is one create, create and then delete is nothing, and moves of the same file are one move.
+# Changes are sent in their order, in one go when the events stopped for quiet_window seconds.
+class ChangeQueue:
+    def __init__(self, send_change, quiet_window):
+        self.send_change = send_change
+        self.quiet_window = quiet_window
+        self.changes = []
+        self.first_event_time = None
+        self.last_event_time = None
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Index of the last change that touches path, or None if no change touches it
+    def last_change_index(self, path):
+        for i in range(len(self.changes) - 1, -1, -1):
+            if touches(self.changes[i], path):
+                return i
+        return None
+
+    def is_last_change(self, path, commands):
+        i = self.last_change_index(path)
+        return i is not None and self.changes[i].path == path and self.changes[i].command in commands
+
+    # Remove the content changes of path and everything under it, return them
+    def take_content_changes(self, path):
+        taken = [change for change in self.changes
+                 if change.command in CONTENT_COMMANDS and is_under(change.path, path)]
+        self.changes = [change for change in self.changes
+                        if change.command not in CONTENT_COMMANDS or not is_under(change.path, path)]
+        return taken
+
+    def add(self, merge, *args):
+        with self.condition:
+            merge(*args)
+            self.last_event_time = time.monotonic()
+            if self.first_event_time is None:
+                self.first_event_time = self.last_event_time
+            self.condition.notify()
+
+    # Create of directory sends everything in the directory, so it already sends the changes in it
+    def is_in_created_directory(self, path):
+        return any(change.command == CREATE_COMMAND and change.is_directory and is_under(path, change.path)
+                   and path != change.path for change in self.changes)
+
+    # Queued move of directory that path was moved in with, or None
+    def get_moved_directory(self, path):
+        for change in self.changes:
+            if change.command == MOVE_COMMAND and change.is_directory and is_under(path, change.dst_path) \
+                    and path != change.dst_path:
+                return change
+        return None
+
+    # Content is read when the change is sent, so create or modify that waits already sends this modify too
+    def merge_created(self, path, is_directory):
+        if self.is_last_change(path, CONTENT_COMMANDS) or self.is_in_created_directory(path):
+            return
+        # Created again what was in directory that was moved, the move already sends it
+        moved_directory = self.get_moved_directory(path)
+        if moved_directory:
+            synced_path = moved_directory.path + path[len(moved_directory.dst_path):]
+            if sync_state.has_path(synced_path) if is_directory else is_synced_file(path, synced_path):
+                return
+        if is_directory:
+            # Directory deleted and created with the same files is a move, the server moves it without the files
+            i = len(self.changes) - 1
+            while i >= 0 and not (self.changes[i].command == DELETE_COMMAND and self.changes[i].is_directory):
+                i -= 1
+            if i >= 0 and self.last_change_index(self.changes[i].path) == i and self.last_change_index(path) is None \
+                    and is_same_directory(self.changes[i].path, path):
+                self.changes.append(Change(MOVE_COMMAND, self.changes.pop(i).path, True, path))
+                return
+        self.changes.append(Change(CREATE_COMMAND, path, is_directory))
+
+    def merge_modified(self, path):
+        if not self.is_last_change(path, CONTENT_COMMANDS) and not self.is_in_created_directory(path):
+            self.changes.append(Change(MODIFY_COMMAND, path, False))
+
+    def merge_deleted(self, path, is_directory):
+        taken = self.take_content_changes(path)
+        if self.is_last_change(path, (DELETE_COMMAND,)):
+            return
+        # Delete of directory deletes everything under it, so the deletes under it that wait are not needed
+        if is_directory:
+            self.changes = [change for change in self.changes
+                            if change.command != DELETE_COMMAND or not is_under(change.path, path)]
+        # If path was created after the changes we sent and nothing else refers to it, the server never had it
+        if any(change.command == CREATE_COMMAND and change.path == path for change in taken) \
+                and self.last_change_index(path) is None:
+            return
+        self.changes.append(Change(DELETE_COMMAND, path, is_directory))
 
-    packet = is_identifier + identifier + move + is_directory + src_path_size + sent_src_file_path.encode('utf-8') \
-             + dest_path_size + sent_dest_file_path.encode('utf-8')
+    def merge_moved(self, src_path, dst_path, is_directory):
+        # Watchdog reports the move of everything under moved directory too, the move of the directory already moves it
+        moved_directory = self.get_moved_directory(dst_path)
+        if moved_directory and src_path == moved_directory.path + dst_path[len(moved_directory.dst_path):]:
+            return
+        # Content changes of src_path (and under it) send the files from their new path, after the move
+        taken = self.take_content_changes(src_path)
+        moved = [change._replace(path=dst_path + change.path[len(src_path):]) for change in taken]
+        i = self.last_change_index(src_path)
+        if any(change.command == CREATE_COMMAND and change.path == src_path for change in taken) and i is None:
+            # The server never had src_path, so creating dst_path is enough
+            pass
+        elif i is not None and self.changes[i].command == MOVE_COMMAND and self.changes[i].dst_path == src_path \
+                and self.last_change_index(self.changes[i].path) == i \
+                and (self.last_change_index(dst_path) or 0) <= i:
+            # Moved from first_path to src_path and now to dst_path, the server moves it from first_path to dst_path
+            first_path = self.changes.pop(i).path
+            if first_path != dst_path:
+                self.changes.append(Change(MOVE_COMMAND, first_path, is_directory, dst_path))
+        else:
+            self.changes.append(Change(MOVE_COMMAND, src_path, is_directory, dst_path))
+        self.changes += moved
 
-    client_socket.sendall(packet)
+    # Send the changes when the events stopped for quiet_window seconds, or the oldest waits MAX_CHANGE_DELAY seconds
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.changes:
+                    self.first_event_time = None
+                    self.condition.wait()
+                send_time = min(self.last_event_time + self.quiet_window, self.first_event_time + MAX_CHANGE_DELAY)
+                if send_time > time.monotonic():
+                    self.condition.wait(send_time - time.monotonic())
+                    continue
+                changes = self.changes
+                self.changes = []
+                first_event_time = self.first_event_time
+                self.first_event_time = None
+
+            try:
+                for change in changes:
+                    self.send_change(change)
+            except (OSError, ClientDisconnectedException):
+                # The thread that receives from the socket finds out that the server disconnected
+                return
+            change_delay_seconds.observe(time.monotonic() - first_event_time)
+
+
+# Content we got from the server (or already sent) is not a change, the server has it
+def is_unsynced_change(change):
+    return change.command not in CONTENT_COMMANDS or change.is_directory or not is_synced_file(change.path)
+
+
+# Return [(path, is_directory)] of new directory and everything in it, in the order we send them
+def list_created_directory(path):
+    paths = [(path, True)]
+    for root, subdirs, files in os.walk(path):
+        paths += [(os.path.join(root, file), False) for file in files if Handler.IGNORE_PATTERN not in file]
+        paths += [(os.path.join(root, subdir), True) for subdir in subdirs]
+    return paths
 
 
 class Handler(PatternMatchingEventHandler):
     # Linux OS create temp file with this name when modify file, so we ignore events with this file name
     IGNORE_PATTERN = ".goutputstream"
 
-    def __init__(self, base_path, client_socket, identifier):
+    def __init__(self, base_path, client_socket, identifier, quiet_window=QUIET_WINDOW):
         super(Handler, self).__init__(ignore_patterns=[f'*{Handler.IGNORE_PATTERN}*'])
         self.base_path = base_path
         self.client_socket = client_socket
         self.identifier = identifier
+        self.queue = ChangeQueue(self.send_change, quiet_window)
 
+    def send_change(self, change):
+        if not is_unsynced_change(change):
+            return
+        with upload_seconds.time(COMMAND_NAMES[change.command]):
+            self.send_change_message(change)
+
+    def send_change_message(self, change):
+        if change.command == CREATE_COMMAND and change.is_directory:
+            self.send_created_directory(change.path)
+        elif change.command == CREATE_COMMAND:
+            send_create_message(self.client_socket, self.identifier, self.base_path, change.path, change.is_directory)
+        elif change.command == DELETE_COMMAND:
+            send_delete_message(self.client_socket, self.identifier, self.base_path, change.path, change.is_directory)
+        elif change.command == MODIFY_COMMAND:
+            send_modify_message(self.client_socket, self.identifier, self.base_path, change.path, False)
+        elif change.command == MOVE_COMMAND:
+            send_move_message(self.client_socket, self.identifier, self.base_path, change.path, change.dst_path,
+                              change.is_directory)
+
+    # Watchdog watches new directory only after it is created, so it may miss what was created in it right away. We
+    # send the directory with everything in it.
+    def send_created_directory(self, path):
+        for created_path, is_directory in list_created_directory(path):
+            send_create_message(self.client_socket, self.identifier, self.base_path, created_path, is_directory)
+
+    # Events of what we changed ourselves, when we applied update from the server, are not sent back to it. Files we
+    # got from the server are skipped when they are sent, because their content is in the sync state.
     def on_created(self, event):
-        send_create_message(self.client_socket, self.identifier, self.base_path, event.src_path,
-                            os.path.isdir(event.src_path))
+        watchdog_events.inc('created')
+        if event.is_directory and is_expected_event(CREATE_COMMAND, event.src_path):
+            return
+        self.queue.add(self.queue.merge_created, event.src_path, event.is_directory)
 
     def on_deleted(self, event):
-        send_delete_message(self.client_socket, self.identifier, self.base_path, event.src_path,
-                            os.path.isdir(event.src_path))
+        watchdog_events.inc('deleted')
+        if is_expected_event(DELETE_COMMAND, event.src_path) and not sync_state.has_path(event.src_path):
+            return
+        self.queue.add(self.queue.merge_deleted, event.src_path, event.is_directory)
 
     def on_modified(self, event):
+        watchdog_events.inc('modified')
         # If we got modified event on directory we ignore (Windows OS)
-        if os.path.isdir(event.src_path):
+        if event.is_directory:
             return
 
-        send_modify_message(self.client_socket, self.identifier, self.base_path, event.src_path,
-                            os.path.isdir(event.src_path))
+        self.queue.add(self.queue.merge_modified, event.src_path)
 
     def on_moved(self, event):
+        watchdog_events.inc('moved')
         # If src_path is IGNORE_PATTERN it means that the file event.dest_path is just modified, so we send modify event
         # And we ignore the src_path because this is temp file
         if Handler.IGNORE_PATTERN in event.src_path:
-            send_modify_message(self.client_socket, self.identifier, self.base_path, event.dest_path,
-                                os.path.isdir(event.dest_path))
-        else:
-            send_move_message(self.client_socket, self.identifier, self.base_path, event.src_path, event.dest_path,
-                              os.path.isdir(event.dest_path))
+            self.queue.add(self.queue.merge_modified, event.dest_path)
+        # File moved to temp file name is going to be replaced or removed, for the server it is deleted
+        elif Handler.IGNORE_PATTERN in event.dest_path:
+            self.queue.add(self.queue.merge_deleted, event.src_path, event.is_directory)
+        elif not is_expected_event(MOVE_COMMAND, event.src_path, event.dest_path):
+            self.queue.add(self.queue.merge_moved, event.src_path, event.dest_path, event.is_directory)
 
 
 def check_port(n):
@@ -355,13 +1459,30 @@ def check_ip(n):
     return 1
 
 
-if __name__ == "__main__":
-    ip = sys.argv[1]
-    port_num = sys.argv[2]
-    path = os.path.abspath(sys.argv[3])
-    time_series = int(sys.argv[4])
-    if len(sys.argv) == 6:
-        identifier = sys.argv[5]
+# Parse the command line of the client (also of async_client.py), start the metrics it asks for and return (ip, port,
+# path, time_series, identifier, push_updates, quiet_window). Exit if the arguments are not valid.
+def parse_arguments(argv):
+    # Updates are pushed by the server, unless --poll flag given and then we pull them every time_series seconds
+    push_updates = '--poll' not in argv
+    # --quiet-window=SECONDS sets how long local changes wait for more events of the same files before we send them
+    quiet_window = QUIET_WINDOW
+    # --metrics-port=PORT serves the metrics on http://127.0.0.1:PORT/metrics and --metrics-file=PATH writes them to
+    # file every few seconds
+    for arg in argv:
+        if arg.startswith('--quiet-window='):
+            quiet_window = float(arg[len('--quiet-window='):])
+        elif arg.startswith('--metrics-port='):
+            metrics.start_http_server(int(arg[len('--metrics-port='):]))
+        elif arg.startswith('--metrics-file='):
+            metrics.start_dump(arg[len('--metrics-file='):])
+    args = [arg for arg in argv if arg != '--poll'
+            and not arg.startswith(('--quiet-window=', '--metrics-port=', '--metrics-file='))]
+    ip = args[1]
+    port_num = args[2]
+    path = os.path.abspath(args[3])
+    time_series = int(args[4])
+    if len(args) == 6:
+        identifier = args[5]
     else:
         identifier = None
 
@@ -372,17 +1493,35 @@ if __name__ == "__main__":
     if check_ip(ip) == 0 or check_port(port_num) == 0:
         exit()
 
-    port_num = int(port_num)
+    return ip, int(port_num), path, time_series, identifier, push_updates, quiet_window
+
+
+if __name__ == "__main__":
+    ip, port_num, path, time_series, identifier, push_updates, quiet_window = parse_arguments(sys.argv)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((ip, port_num))
+    negotiate_compression(s)
 
     try:
         identifier = first_connected_to_server(identifier, s, path)
-        start_watchdog(path, s, identifier)
-        while True:
-            # Set the thread sleep time
-            time.sleep(time_series)
-            pull_updates_from_server(identifier, s, path)
+        start_batching(s)
+        start_watchdog(path, s, identifier, quiet_window)
+        if push_updates:
+            subscribe_to_server_updates(identifier, s)
+            # The receive thread applies the updates the server pushes, until the server disconnects
+            receive_threads[s].join()
+        else:
+            pull = None
+            while True:
+                # Set the thread sleep time
+                time.sleep(time_series)
+                # We don't wait for the updates, but the next pull is sent only after they arrived, so pulls don't
+                # pile up at a slow server
+                if pull is None or pull.done():
+                    if pull:
+                        pull.result()
+                    pull = pull_updates_from_server(identifier, s, path)
     except (KeyboardInterrupt, ClientDisconnectedException):
-        stop_watchdog()
+        pass
+    stop_watchdog()
     wait_observer()
@@ -0,0 +1,93 @@
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression of file bodies on the wire. Client and server agree on the codecs both sides have when the client
+# connects, and each file body is sent with the codec it is compressed with (RAW if it is not). Content that doesn't
+# get smaller, like files that are already compressed, is sent as is.
+RAW = 0
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+
+CODEC_NAMES = {ZLIB: 'zlib', LZMA: 'xz', ZSTD: 'zst'}
+# Codecs we compress with, the first one both sides have is used
+CODEC_PREFERENCE = (ZSTD, ZLIB, LZMA)
+
+# Files smaller than this are not worth compressing, and bigger ones are compressed in memory only up to MAX_SIZE
+MIN_SIZE = 512
+MAX_SIZE = 16 * 1024 * 1024
+# We first compress this much of the content, and if it doesn't get smaller than SAMPLE_RATIO we send it as is
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.9
+
+
+def codec_bit(codec):
+    return 1 << codec
+
+
+# Bit mask of the codecs we have
+SUPPORTED_CODECS = codec_bit(ZLIB) | codec_bit(LZMA) | (codec_bit(ZSTD) if zstandard else 0)
+
+# Errors of decompressing body that is not valid compressed data of its codec
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError, EOFError) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def choose_codec(codecs):
+    for codec in CODEC_PREFERENCE:
+        if codecs & codec_bit(codec):
+            return codec
+    return RAW
+
+
+def compress(data, codec):
+    if codec == ZLIB:
+        return zlib.compress(data, 6)
+    if codec == LZMA:
+        return lzma.compress(data, preset=1)
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+# Return (codec, data) to send of content, with the best codec of the codecs mask if the content gets smaller with it
+def encode(data, codecs):
+    codec = choose_codec(codecs)
+    if codec == RAW or len(data) < MIN_SIZE:
+        return RAW, data
+    sample = data[:SAMPLE_SIZE]
+    if len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO:
+        return RAW, data
+    compressed = compress(data, codec)
+    if len(compressed) >= len(data):
+        return RAW, data
+    return codec, compressed
+
+
+# Decompresses body that arrives piece by piece
+class Decompressor:
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == ZLIB:
+            self.decompressor = zlib.decompressobj()
+        elif codec == LZMA:
+            self.decompressor = lzma.LZMADecompressor()
+        elif codec == ZSTD and zstandard:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif codec != RAW:
+            raise ValueError('Unknown codec %d' % codec)
+
+    def decompress(self, data):
+        if self.codec == RAW:
+            return bytes(data)
+        return self.decompressor.decompress(data)
+
+    # Rest of the content, after all the body arrived
+    def flush(self):
+        if self.codec in (ZLIB, LZMA) and not self.decompressor.eof:
+            raise EOFError('Compressed body ended before its end of stream')
+        if self.codec in (ZLIB, ZSTD):
+            return self.decompressor.flush()
+        return b''
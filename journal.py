@@ -0,0 +1,229 @@
+import collections
+import glob
+import os
+import time
+import blob_store
+
+# Journal of the changes of each identifier, kept in a database so it survives server restart.
+# Every change gets the next sequence number of its identifier, and each client reads the journal from its own cursor
+# (the sequence number of the last change it got). Changes that all clients already got are removed, and a change
+# that a newer change of the same path makes useless is compacted away, so a slow client doesn't make the journal
+# grow with every save of the same file. File bodies are not in the journal, only the digest of their blob.
+# Each client session saves the last change it applied, so it can reconnect and get only the changes after it.
+# Each worker process keeps the journals and sessions of its identifiers in its own database, so the workers don't wait
+# for each other's writes. Only the files, which tell what blobs are used, are in the index all workers share.
+CREATE_COMMAND = 1
+DELETE_COMMAND = 2
+MODIFY_COMMAND = 3
+MOVE_COMMAND = 4
+DELTA_COMMAND = 8
+
+# Changes of path that a newer full content or delete of the path replaces
+CONTENT_COMMANDS = (CREATE_COMMAND, MODIFY_COMMAND, DELTA_COMMAND)
+
+# Max changes and max delta bytes we read for one batch, so memory of each client is bounded and the rest of its
+# changes wait on disk until it reads the batch
+BATCH_SIZE = 256
+BATCH_BYTES = 4 * 1024 * 1024
+
+# One change, path and dst_path are relative to the identifier directory. digest is the blob of the new content of
+# CREATE/MODIFY/DELTA of file and payload is the delta of DELTA. version is the sequence number of the change, which is
+# the version of the content it wrote.
+Entry = collections.namedtuple('Entry', ['command', 'is_directory', 'path', 'dst_path', 'digest', 'payload', 'version'],
+                               defaults=(None, None, None, None))
+
+# Session that didn't connect for this long is removed, and its changes are not kept for it anymore
+SESSION_EXPIRE_SECONDS = 30 * 24 * 60 * 60
+# Database of worker (index, count). Identifiers are split between the workers by their count, so the databases of
+# another count have identifiers of other workers and are removed when the server starts.
+JOURNAL_PATH = '.journal-%d-of-%d.db'
+JOURNAL_PATTERN = '.journal-*.db'
+
+# Database of the journals of this process
+index = None
+# Connections to the databases of all workers, to know if a change of another worker refers to blob. The workers are
+# known when the server starts, so the list is made once by load_journals.
+readers = []
+
+
+def open_journal(shard_index=0, shard_count=1):
+    global index
+    index = blob_store.Index(JOURNAL_PATH % (shard_index, shard_count))
+    # Write ahead log makes each commit one append instead of rewriting pages
+    index.execute('PRAGMA journal_mode=WAL')
+    # Changes of each identifier by sequence number
+    index.execute('CREATE TABLE IF NOT EXISTS journal (identifier TEXT NOT NULL, seq INTEGER NOT NULL, origin TEXT,'
+                  ' command INTEGER NOT NULL, is_directory INTEGER NOT NULL, path TEXT NOT NULL, dst_path TEXT,'
+                  ' digest TEXT, payload BLOB, PRIMARY KEY (identifier, seq))')
+    index.execute('CREATE INDEX IF NOT EXISTS journal_path ON journal (identifier, path)')
+    # Last move of identifier, which compaction doesn't cross
+    index.execute('CREATE INDEX IF NOT EXISTS journal_command ON journal (identifier, command, seq)')
+    index.execute('CREATE INDEX IF NOT EXISTS journal_digest ON journal (digest)')
+    # Last sequence number of each identifier and up to which sequence number its journal was truncated
+    index.execute('CREATE TABLE IF NOT EXISTS journal_state (identifier TEXT PRIMARY KEY, last_seq INTEGER NOT NULL,'
+                  ' truncated_seq INTEGER NOT NULL)')
+    # Last journal change each client session applied
+    index.execute('CREATE TABLE IF NOT EXISTS sessions (identifier TEXT NOT NULL, session TEXT NOT NULL,'
+                  ' cursor INTEGER NOT NULL, last_seen REAL NOT NULL, PRIMARY KEY (identifier, session))')
+
+
+# Close the connections of this thread, before forking processes that open their own
+def close_journals():
+    if index:
+        blob_store.close_index(index)
+    for reader in readers:
+        blob_store.close_index(reader)
+
+
+# Create the databases of shard_count workers and remove the others, the changes and sessions of identifiers that
+# don't exist anymore and the expired sessions. Called once when the server starts, before the blob store is loaded.
+def load_journals(shard_count, identifiers):
+    global readers
+    paths = {JOURNAL_PATH % (shard_index, shard_count) for shard_index in range(shard_count)}
+    for path in glob.glob(JOURNAL_PATTERN):
+        if path not in paths:
+            for database_path in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(database_path):
+                    os.remove(database_path)
+
+    for shard_index in range(shard_count):
+        open_journal(shard_index, shard_count)
+        with blob_store.Transaction(index):
+            for identifier, in index.execute('SELECT identifier FROM journal_state'
+                                             ' UNION SELECT identifier FROM sessions').fetchall():
+                if identifier not in identifiers:
+                    index.execute('DELETE FROM journal WHERE identifier = ?', (identifier,))
+                    index.execute('DELETE FROM sessions WHERE identifier = ?', (identifier,))
+                    index.execute('DELETE FROM journal_state WHERE identifier = ?', (identifier,))
+        expire_sessions()
+        close_journals()
+    readers = [blob_store.Index(path) for path in sorted(paths)]
+
+
+# Blob is used if a change in the journal of any worker refers to it
+def is_blob_used(digest):
+    return any(reader.execute('SELECT 1 FROM journal WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+               for reader in readers)
+
+
+blob_store.blob_users.append(is_blob_used)
+
+
+# Return (last sequence number, sequence number the journal was truncated up to) of identifier
+def get_state(identifier):
+    row = index.execute('SELECT last_seq, truncated_seq FROM journal_state WHERE identifier = ?',
+                        (identifier,)).fetchone()
+    return row or (0, 0)
+
+
+def last_seq(identifier):
+    return get_state(identifier)[0]
+
+
+def delete_entries(condition, parameters):
+    digests = {digest for digest, in index.execute(
+        'SELECT digest FROM journal WHERE digest IS NOT NULL AND ' + condition, parameters).fetchall()}
+    index.execute('DELETE FROM journal WHERE ' + condition, parameters)
+    return digests
+
+
+# Remove the changes of path that entry makes useless. Changes that all clients got (seq <= floor) are removed by
+# truncate anyway, and we never compact across a move, since the path of the older changes may be another file.
+# Return the blob digests the removed changes referred to.
+# Compaction runs on every append, so it only searches the indexes: the last move in journal_command, and the changes
+# of the path in journal_path (+seq keeps SQLite from choosing the range of all the newer changes of the identifier).
+def compact(identifier, entry, floor):
+    row = index.execute('SELECT MAX(seq) FROM journal WHERE identifier = ? AND command = ?',
+                        (identifier, MOVE_COMMAND)).fetchone()
+    floor = max(floor, row[0] or 0)
+
+    if entry.command == DELETE_COMMAND:
+        # Delete of directory makes useless all the changes under it too
+        return delete_entries(blob_store.UNDER_CONDITION + ' AND +seq > ? AND command != ?',
+                              blob_store.under_parameters(identifier, entry.path) + (floor, MOVE_COMMAND))
+    if entry.command in CONTENT_COMMANDS and not entry.is_directory:
+        return delete_entries('identifier = ? AND path = ? AND +seq > ? AND command IN (?, ?, ?)',
+                              (identifier, entry.path, floor) + CONTENT_COMMANDS)
+    return set()
+
+
+# Add change of the client origin to the journal of identifier, floor is the smallest cursor of the clients.
+# Return the sequence number of the change.
+def append(identifier, origin, entry, floor):
+    with blob_store.Transaction(index):
+        released = compact(identifier, entry, floor)
+        # Delta is based on the previous content, if we removed the change with it the delta is useless to the clients
+        # that didn't get it, so they get the whole new content instead
+        if entry.command == DELTA_COMMAND and released:
+            entry = entry._replace(command=MODIFY_COMMAND, payload=None)
+        seq = last_seq(identifier) + 1
+        index.execute('INSERT INTO journal VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                      (identifier, seq, origin, entry.command, entry.is_directory, entry.path,
+                       entry.dst_path, entry.digest, entry.payload))
+        index.execute('INSERT INTO journal_state VALUES (?, ?, 0) ON CONFLICT (identifier)'
+                      ' DO UPDATE SET last_seq = excluded.last_seq', (identifier, seq))
+    for digest in released:
+        blob_store.release_blob(digest)
+
+    return seq
+
+
+# Return batch of the changes after cursor that other clients than origin made, and the sequence number of the last
+# change we read (the changes of origin itself are skipped, but the cursor moves over them)
+def read_entries(identifier, cursor, origin):
+    entries = []
+    batch_bytes = 0
+    rows = index.execute('SELECT seq, origin, command, is_directory, path, dst_path, digest, payload'
+                         ' FROM journal WHERE identifier = ? AND seq > ? ORDER BY seq LIMIT ?',
+                         (identifier, cursor, BATCH_SIZE))
+    for seq, entry_origin, command, is_directory, path, dst_path, digest, payload in rows:
+        cursor = seq
+        if entry_origin != origin:
+            entries.append(Entry(command, is_directory, path, dst_path, digest, payload, seq))
+        batch_bytes += len(payload or b'')
+        if batch_bytes >= BATCH_BYTES:
+            break
+
+    return entries, cursor
+
+
+# Return the last change session applied, or None if we don't know the session
+def get_session_cursor(identifier, session):
+    row = index.execute('SELECT cursor FROM sessions WHERE identifier = ? AND session = ?',
+                        (identifier, session)).fetchone()
+    return row[0] if row else None
+
+
+def save_session(identifier, session, cursor):
+    with blob_store.Transaction(index):
+        index.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                      (identifier, session, cursor, time.time()))
+
+
+# Smallest cursor of the sessions of identifier that are at least min_cursor, or None
+def sessions_floor(identifier, min_cursor=0):
+    return index.execute('SELECT MIN(cursor) FROM sessions WHERE identifier = ? AND cursor >= ?',
+                         (identifier, min_cursor)).fetchone()[0]
+
+
+# Session can resume from cursor if the journal still has all the changes after it (compacted changes are not
+# needed, the newer changes that replaced them are there)
+def can_resume(identifier, cursor):
+    last, truncated = get_state(identifier)
+    return truncated <= cursor <= last
+
+
+def expire_sessions():
+    with blob_store.Transaction(index):
+        index.execute('DELETE FROM sessions WHERE last_seen < ?', (time.time() - SESSION_EXPIRE_SECONDS,))
+
+
+# Remove the changes that all clients already got
+def truncate(identifier, floor):
+    if floor <= get_state(identifier)[1]:
+        return
+    with blob_store.Transaction(index):
+        released = delete_entries('identifier = ? AND seq <= ?', (identifier, floor))
+        index.execute('UPDATE journal_state SET truncated_seq = ? WHERE identifier = ?', (floor, identifier))
+    for digest in released:
+        blob_store.release_blob(digest)
@@ -0,0 +1,156 @@
+import http.server
+import os
+import threading
+import time
+
+# Counters and latency histograms of the server and the client, in the Prometheus text format. They are served on a
+# local HTTP port (GET /metrics) or written to a file every few seconds, so we can see where the time goes without a
+# profiler. Updating a metric takes one lock, so it is cheap enough for the hot paths.
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DUMP_INTERVAL = 10
+
+# All metrics in the order they were created, and the lock of their values
+registry = []
+lock = threading.Lock()
+
+
+def format_labels(label_names, labels, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        # {labels: value}
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s counter' % self.name]
+        for labels, value in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+# Value read when the metrics are rendered: function returns {labels: value}
+class Gauge:
+    def __init__(self, name, help_text, label_names, function):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.function = function
+        registry.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s gauge' % self.name]
+        for labels, value in sorted(self.function().items()):
+            lines.append('%s%s %s' % (self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # {labels: [count of each bucket (not cumulative), sum, count]}
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        with lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    # Context manager that observes the time its block took
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        for labels, (bucket_counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.label_names, labels, 'le="%s"' % bound),
+                                                 cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(self.label_names, labels, 'le="+Inf"'), count))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.label_names, labels), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.label_names, labels), count))
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def render():
+    with lock:
+        lines = [line for metric in registry for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the metrics on localhost port, from a thread of its own
+def start_http_server(port):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Write the metrics to path every interval seconds, replacing the file so readers never see half of it
+def start_dump(path, interval=DUMP_INTERVAL):
+    threading.Thread(target=dump_forever, args=(path, interval), daemon=True).start()
+
+
+def dump_forever(path, interval):
+    while True:
+        time.sleep(interval)
+        with open(path + '.tmp', 'w') as f:
+            f.write(render())
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,176 @@
+import collections
+import os
+import struct
+
+# Framing of the wire protocol, shared by the client and the server. Fixed size fields are little-endian and decoded
+# with struct, paths are utf-8 with their size in bytes before them. Frames are read from a buffer: the server parses
+# its connection receive buffer without blocking (FrameReader), and the client reads each socket through its own
+# buffer (SocketReader), so the number of recv calls depends on the bytes received and not on the fields.
+UINT8 = struct.Struct('<B')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+# Command, is_directory and path size, in front of the path of each change
+PATH_HEADER = struct.Struct('<BBI')
+# is_directory and path size, after a command that was read alone
+ENTRY_HEADER = struct.Struct('<BI')
+# Count of the update packets and journal cursor after them
+UPDATES_HEADER = struct.Struct('<IQ')
+# Request id and count of the paths of bulk fetch
+BULK_FETCH_HEADER = struct.Struct('<II')
+# Size, mtime and version of manifest entry, after its path
+MANIFEST_SIZES = struct.Struct('<QQQ')
+# Version of file content, the sequence number of the journal change that wrote it. Files the server sends have their
+# version after the path, and the writes of clients have the version they are based on, so the server knows when the
+# client didn't see a newer write of another client.
+VERSION = struct.Struct('<Q')
+# Answer to session: resumed and cursor
+SESSION_REPLY = struct.Struct('<BQ')
+# Requests that get a reply (updates, manifest, pull, bulk fetch and session) have an id after their command, and the
+# reply starts with it, so the client can send requests without waiting for the replies of the previous ones. Update
+# batches the server pushes to subscribed client start with PUSH_REQUEST_ID.
+REQUEST_ID = struct.Struct('<I')
+PUSH_REQUEST_ID = 0
+
+DIGEST_SIZE = 32
+RECV_SIZE = 64 * 1024
+
+# Frame parsed after its command: path of file or directory
+PathFrame = collections.namedtuple('PathFrame', ['is_directory', 'path'])
+# Change the server sends to client, followed by its own fields (body, delta or destination path) by command
+Update = collections.namedtuple('Update', ['command', 'is_directory', 'path'])
+# File or empty directory in the manifest of the server, digest is hex
+ManifestEntry = collections.namedtuple('ManifestEntry', ['is_directory', 'path', 'size', 'mtime_ns', 'version',
+                                                         'digest'])
+
+
+class ClientDisconnectedException(BaseException):
+    def __init__(self):
+        super().__init__(self, "Client Disconnected")
+
+
+# Raised by FrameReader when the frame is not fully received yet
+class IncompleteFrameException(Exception):
+    pass
+
+
+def build_path(path):
+    path = path.encode('utf-8')
+    return UINT32.pack(len(path)) + path
+
+
+def build_entry(is_directory, path):
+    path = path.encode('utf-8')
+    return ENTRY_HEADER.pack(int(is_directory), len(path)) + path
+
+
+def build_path_frame(command, is_directory, path):
+    return UINT8.pack(command) + build_entry(is_directory, path)
+
+
+# Path of the copy that keeps the content of a conflicting write, next to path. tag tells the copies apart.
+def conflict_path(path, tag):
+    root, extension = os.path.splitext(path)
+    return '%s (conflict %s)%s' % (root, tag, extension)
+
+
+# Fields and messages on top of read(size) and unpack(struct) of the readers
+class Reader:
+    def read_int(self, size):
+        return int.from_bytes(self.read(size), 'little')
+
+    def read_path(self):
+        return self.read(self.unpack(UINT32)[0]).decode('utf-8')
+
+    def read_path_frame(self):
+        is_directory, path_size = self.unpack(ENTRY_HEADER)
+        return PathFrame(is_directory, self.read(path_size).decode('utf-8'))
+
+    def read_update(self):
+        command, is_directory, path_size = self.unpack(PATH_HEADER)
+        return Update(command, is_directory, self.read(path_size).decode('utf-8'))
+
+    # Return the next entry of the manifest, or None after the last one
+    def read_manifest_entry(self):
+        if not self.unpack(UINT8)[0]:
+            return None
+        is_directory, path = self.read_path_frame()
+        size, mtime_ns, version = self.unpack(MANIFEST_SIZES)
+        return ManifestEntry(is_directory, path, size, mtime_ns, version, self.read(DIGEST_SIZE).hex())
+
+
+# Reads frame fields from connection receive buffer, without blocking on the socket
+class FrameReader(Reader):
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.buffer):
+            raise IncompleteFrameException()
+        data = bytes(self.buffer[self.offset:self.offset + size])
+        self.offset += size
+        return data
+
+    def unpack(self, fields):
+        if self.offset + fields.size > len(self.buffer):
+            raise IncompleteFrameException()
+        values = fields.unpack_from(self.buffer, self.offset)
+        self.offset += fields.size
+        return values
+
+
+# Reads from blocking socket through a buffer: each recv fills as much of the buffer as the socket has, and the fields
+# are read from the buffer
+class SocketReader(Reader):
+    def __init__(self, s, size=RECV_SIZE):
+        self.socket = s
+        self.buffer = bytearray(size)
+        # Unread bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def receive(self):
+        received = self.socket.recv_into(memoryview(self.buffer)[self.end:])
+        if not received:
+            raise ClientDisconnectedException()
+        self.end += received
+
+    # Receive until size bytes are in the buffer
+    def fill(self, size):
+        if self.end - self.start >= size:
+            return
+        if self.start + size > len(self.buffer):
+            # Move the unread bytes to the beginning, in bigger buffer if the field doesn't fit
+            unread = self.buffer[self.start:self.end]
+            if size > len(self.buffer):
+                self.buffer = bytearray(size)
+            self.buffer[:len(unread)] = unread
+            self.start = 0
+            self.end = len(unread)
+        while self.end - self.start < size:
+            self.receive()
+
+    def read(self, size):
+        self.fill(size)
+        data = bytes(self.buffer[self.start:self.start + size])
+        self.start += size
+        return data
+
+    def unpack(self, fields):
+        self.fill(fields.size)
+        values = fields.unpack_from(self.buffer, self.start)
+        self.start += fields.size
+        return values
+
+    # Yield the next size bytes in pieces, each piece is valid only until the next one. The body goes straight from
+    # the socket into the buffer and from there to the caller, without copying it.
+    def iter_body(self, size):
+        while size:
+            if self.start == self.end:
+                self.start = self.end = 0
+                self.receive()
+            piece_size = min(size, self.end - self.start)
+            with memoryview(self.buffer) as view:
+                yield view[self.start:self.start + piece_size]
+            self.start += piece_size
+            size -= piece_size
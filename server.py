@@ -1,8 +1,26 @@
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import os
+import queue
+import selectors
 import socket
 import string
 import sys
+import threading
 import random
+import tempfile
+import time
+import weakref
+import zlib
+import blob_store
+import chunking
+import compression
+import journal
+import metrics
+import protocol
 
 CREATE_COMMAND = 1
 DELETE_COMMAND = 2
@@ -10,112 +28,864 @@ MODIFY_COMMAND = 3
 MOVE_COMMAND = 4
 PULL_COMMAND = 5
 UPDATES_COMMAND = 6
+SUBSCRIBE_COMMAND = 7
+DELTA_COMMAND = 8
+FETCH_COMMAND = 9
+HAVE_COMMAND = 10
+SESSION_COMMAND = 11
+ACK_COMMAND = 12
+MANIFEST_COMMAND = 13
+JOIN_COMMAND = 14
+BULK_FETCH_COMMAND = 15
+BATCH_COMMAND = 16
+# Tells client that fell too far behind that it doesn't get the changes it missed, it compares with the manifest again
+RESYNC_COMMAND = 17
+
+# Command names in the metrics
+COMMAND_NAMES = {CREATE_COMMAND: 'create', DELETE_COMMAND: 'delete', MODIFY_COMMAND: 'modify', MOVE_COMMAND: 'move',
+                 PULL_COMMAND: 'pull', UPDATES_COMMAND: 'updates', SUBSCRIBE_COMMAND: 'subscribe',
+                 DELTA_COMMAND: 'delta', FETCH_COMMAND: 'fetch', HAVE_COMMAND: 'have', SESSION_COMMAND: 'session',
+                 ACK_COMMAND: 'ack', MANIFEST_COMMAND: 'manifest', JOIN_COMMAND: 'join',
+                 BULK_FETCH_COMMAND: 'bulk_fetch', BATCH_COMMAND: 'batch'}
+
+# Instead of is_identifier, client sends this and then the codecs it has, before its other frames
+CAPABILITIES_MESSAGE = 2
+
+IDENTIFIER_SIZE = 128
+SESSION_ID_SIZE = 32
+
+# Suffix of the file we build the new version in, before replacing the old one
+TEMP_FILE_SUFFIX = '.sync-tmp'
+
+# Max bytes to read from client socket on each read event
+RECV_SIZE = 64 * 1024
+# Size of the pieces we read from a file and send to client, when the kernel can't send from the file itself
+SEND_CHUNK_SIZE = 64 * 1024
+# Max queued buffers we send with one system call
+SEND_GATHER_COUNT = 64
+# In bulk fetch, files up to this size are read ahead by the prefetch threads, up to PREFETCH_WINDOW files for each
+# stream, so the event loop sends them from memory instead of waiting for the disk
+PREFETCH_FILE_SIZE = 256 * 1024
+PREFETCH_WINDOW = 32
+PREFETCH_THREADS = 8
+# We stop reading from client while more than SEND_WINDOW bytes wait to be sent to it, or more than WAITING_COMMANDS
+# of its commands wait for the filesystem threads, so a client that doesn't receive (or sends faster than we apply)
+# can't make us queue without limit. Its next commands wait in the socket until it received the previous replies.
+SEND_WINDOW = 4 * 1024 * 1024
+WAITING_COMMANDS = 1024
+# Connected client that didn't get this many changes of the journal yet gets RESYNC_COMMAND instead of them, and
+# session that didn't ack them doesn't keep them in the journal anymore (it compares with the manifest when it resumes)
+MAX_CLIENT_LAG = 10000
+# Threads that change the files of the identifiers and walk their directories, so the event loop never waits for the
+# disk. Commands of the same identifier are applied one after the other in the order they arrived.
+FS_THREADS = 4
+# Chunk indexes of file contents we keep for the next deltas, the least recently used are dropped
+CHUNK_INDEX_CACHE_SIZE = 256
+# Mode of new files by the umask of the process, stored files get it and not the private mode of tempfile
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+# Connected clients of each identifier: {identifier: {client address: connection}}
+identifier_clients = {}
+# Connections of clients that subscribed to push updates, by client address
+push_clients = {}
+# Chunk index of file contents, by blob digest, in order of use. The filesystem threads use it under
+# chunk_indexes_lock.
+chunk_indexes = collections.OrderedDict()
+chunk_indexes_lock = threading.Lock()
+# Selector that wait for read/write events on the server socket and all client sockets, each process creates its own
+selector = None
+# Reused buffer for file data we send, we handle one socket at a time so all clients can share it
+send_buffer = bytearray(SEND_CHUNK_SIZE)
+# Reused buffer we receive into, shared the same way. The frames are handled straight from it, and only the rest of a
+# partial frame is copied to the receive buffer of its connection.
+receive_buffer = bytearray(RECV_SIZE)
+# Opened blobs, shared by all the queued packets that send the same blob to different clients (blobs never change)
+blob_bodies = weakref.WeakValueDictionary()
+# Threads that read small files ahead for bulk fetch
+prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_THREADS)
+# Threads that apply the commands on the filesystem
+fs_pool = concurrent.futures.ThreadPoolExecutor(max_workers=FS_THREADS)
+# Commands of each identifier that wait to be applied: {identifier: deque of (work, done)}, the first ones run now
+identifier_tasks = {}
+# Identifiers whose journal truncation waits in their commands, so we queue only one at a time
+truncating_identifiers = set()
+# Functions the filesystem threads ask the event loop to call, the loop wakes up when a byte arrives to wake_receiver
+loop_calls = queue.SimpleQueue()
+wake_receiver = None
+wake_sender = None
+# In sharded mode, the number of worker processes and the index of this one. Each identifier belongs to one worker,
+# which owns its directory and journal.
+shard_count = 1
+shard_index = 0
+# Local port we serve the metrics on (each worker process on the next port) and file we write them to, if given
+metrics_port = None
+metrics_file = None
+
+
+# Number of commands that wait for the filesystem threads, of all identifiers together (the identifier is the secret
+# of its clients, so it is not a label)
+def count_queued_commands():
+    return {(): sum(len(tasks) for tasks in list(identifier_tasks.values()))}
+
+
+def count_connected_clients():
+    return {(): sum(len(clients) for clients in list(identifier_clients.values()))}
+
+
+def count_queued_bytes():
+    return {(): sum(connection.queued_bytes for clients in list(identifier_clients.values())
+                    for connection in list(clients.values()))}
+
+
+received_bytes = metrics.Counter('sync_server_received_bytes_total', 'Bytes received from clients')
+sent_bytes = metrics.Counter('sync_server_sent_bytes_total', 'Bytes sent to clients')
+frames = metrics.Counter('sync_server_frames_total', 'Commands received, by command', ('command',))
+command_seconds = metrics.Histogram('sync_server_command_seconds',
+                                    'Event loop time of parsing and dispatching each command', ('command',))
+disk_seconds = metrics.Histogram('sync_server_disk_seconds', 'Time of filesystem work, by operation', ('operation',))
+network_seconds = metrics.Histogram('sync_server_network_seconds', 'Time of socket reads and writes', ('direction',))
+reply_seconds = metrics.Histogram('sync_server_reply_seconds',
+                                  'Event loop time of the replies that wait for the filesystem work', ('reply',))
+skipped_writes = metrics.Counter('sync_server_skipped_writes_total', 'Changes that needed no write, by reason',
+                                 ('reason',))
+conflicts = metrics.Counter('sync_server_conflicts_total', 'Stale writes of clients, by how they were resolved',
+                            ('resolution',))
+metrics.Gauge('sync_server_queued_commands', 'Commands waiting for the filesystem threads', (), count_queued_commands)
+paused_reads = metrics.Counter('sync_server_paused_reads_total',
+                               'Times we stopped reading from client until it receives what we queued for it')
+resyncs = metrics.Counter('sync_server_resyncs_total', 'Clients that fell too far behind the journal and resync')
+errors = metrics.Counter('sync_server_errors_total',
+                         'Filesystem work and event loop calls that raised error, by operation', ('operation',))
+metrics.Gauge('sync_server_connected_clients', 'Connected clients', (), count_connected_clients)
+metrics.Gauge('sync_server_queued_send_bytes', 'Bytes waiting to be sent to connected clients', (),
+              count_queued_bytes)
+
+
+ClientDisconnectedException = protocol.ClientDisconnectedException
+IncompleteFrameException = protocol.IncompleteFrameException
+
+
+# Content of one version of a file that we send to clients. Stored files are always replaced and never written in
+# place, so the opened file keeps this version even if the path is modified, moved or deleted after it.
+# The file is closed when no queued packet refers to it anymore.
+class FileBody:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+
+# Open blob, or the one that is already open
+def open_blob_body(path):
+    file_body = blob_bodies.get(path)
+    if file_body is None:
+        file_body = blob_bodies[path] = FileBody(path)
+    return file_body
+
+
+# Queued file body of one client. The kernel sends it straight from the file when it can (sendfile), otherwise we
+# send it piece by piece through send_buffer. Each sender has its own offset, so senders share the opened file.
+class FileSender:
+    def __init__(self, file_body):
+        self.file_body = file_body
+        self.offset = 0
+
+    # Send as much as the socket accepts, return True when the whole body sent
+    def send(self, client_socket):
+        if hasattr(os, 'sendfile'):
+            return self.send_from_file(client_socket)
+        while self.offset < self.file_body.size:
+            view = memoryview(send_buffer)[:min(SEND_CHUNK_SIZE, self.file_body.size - self.offset)]
+            with disk_seconds.time('read_body'):
+                self.file_body.file.seek(self.offset)
+                size = self.file_body.file.readinto(view)
+            # If only part of the piece sent, we read the rest again next time the socket is writable
+            with network_seconds.time('send'):
+                sent = client_socket.send(view[:size])
+            sent_bytes.inc(amount=sent)
+            self.offset += sent
+            if sent < size:
+                return False
+
+        return True
+
+    def send_from_file(self, client_socket):
+        while self.offset < self.file_body.size:
+            size = self.file_body.size - self.offset
+            with network_seconds.time('sendfile'):
+                sent = os.sendfile(client_socket.fileno(), self.file_body.file.fileno(), self.offset, size)
+            # Stored files are never truncated, but if the file got shorter anyway the frame can't be completed
+            if sent == 0:
+                raise ClientDisconnectedException()
+            sent_bytes.inc(amount=sent)
+            self.offset += sent
+            if sent < size:
+                return False
+
+        return True
+
+
+# Create temp file in the blob store with the mode of new files, return its descriptor and path
+def make_temp_file(suffix=''):
+    fd, temp_path = tempfile.mkstemp(dir=blob_store.BLOBS_DIRECTORY, suffix=suffix)
+    os.chmod(temp_path, FILE_MODE)
+    return fd, temp_path
+
+
+# Receives file body from client into temp file in the blob store, the stored file is replaced only when the whole
+# body arrived. Compressed body is decompressed as it arrives, and kept compressed in another temp file too.
+class FileReceiver:
+    def __init__(self, identifier, path, file_size, command, base_version, origin, codec=compression.RAW):
+        fd, self.temp_path = make_temp_file(TEMP_FILE_SUFFIX)
+        self.file = os.fdopen(fd, 'wb')
+        self.identifier = identifier
+        self.path = path
+        self.file_size = file_size
+        self.remaining = file_size
+        self.command = command
+        # Version the client based the content on, and the client
+        self.base_version = base_version
+        self.origin = origin
+        self.codec = codec
+        self.decompressor = compression.Decompressor(codec)
+        self.encoded_file = None
+        if codec != compression.RAW:
+            fd, self.encoded_temp_path = make_temp_file()
+            self.encoded_file = os.fdopen(fd, 'wb')
+        # Hash of the content is calculated while it arrives, for the blob store
+        self.sha256 = hashlib.sha256()
+
+    # Write the part of data that belongs to the body, return how many bytes used
+    def write(self, data):
+        size = min(len(data), self.remaining)
+        if self.encoded_file:
+            self.encoded_file.write(data[:size])
+        self.write_content(self.decompressor.decompress(data[:size]))
+        self.remaining -= size
+        return size
+
+    def write_content(self, content):
+        self.file.write(content)
+        self.sha256.update(content)
+
+    # Whole body arrived
+    def close(self):
+        self.write_content(self.decompressor.flush())
+        self.file.close()
+        if self.encoded_file:
+            self.encoded_file.close()
+
+    def abort(self):
+        self.file.close()
+        if os.path.isfile(self.temp_path):
+            os.remove(self.temp_path)
+        if self.encoded_file:
+            self.encoded_file.close()
+            os.remove(self.encoded_temp_path)
+
+
+class ClientConnection:
+    def __init__(self, client_socket, client_address):
+        self.socket = client_socket
+        self.address = client_address
+        # Bytes received from client that not handled yet (can contain partial frame)
+        self.recv_buffer = bytearray()
+        # File body we receive now, the next received bytes belong to it
+        self.file_receiver = None
+        # Data waiting for the socket to be writable: memoryview, FileSender or iterator that produce packets
+        self.send_queue = collections.deque()
+        # Bytes of send_queue not sent yet (queued_size), commands of the client that wait for the filesystem threads,
+        # and whether we stopped reading from client because of them
+        self.queued_bytes = 0
+        self.waiting_commands = 0
+        self.paused = False
+        self.close_after_send = False
+        self.closed = False
+        # Changes of this client are marked with origin in the journal, so it doesn't get them back. Client that
+        # opened session is marked with its session, so it doesn't get them back after it reconnects too.
+        self.origin = '%s:%d' % client_address[:2]
+        self.session = None
+        self.identifier = None
+        # Sequence number of the last journal change the client got
+        self.cursor = None
+        # Packets for this client only (not in the journal) that wait for its next updates
+        self.pending_packets = []
+        # Bit mask of the codecs we agreed on with the client, if it is not 0 each file body starts with its codec
+        self.codecs = 0
+
+    def send(self, data):
+        if self.closed or not data:
+            return
+        self.send_queue.append(memoryview(data))
+        self.queued_bytes += len(data)
+        update_selector_events(self)
+
+    # Packet is tuple of header and body: FileBody, bytes of body that is already in memory, or None if the packet has
+    # no body
+    def send_packet(self, packet):
+        header, body = packet
+        self.send(header)
+        if body and not self.closed:
+            item = FileSender(body) if isinstance(body, FileBody) else memoryview(body)
+            self.send_queue.append(item)
+            self.queued_bytes += queued_size(item)
+            update_selector_events(self)
+
+    # Packets of iterator are produced only when the previous ones sent, so they don't wait in memory
+    def send_packets_later(self, packets):
+        if self.closed:
+            return
+        self.send_queue.append(packets)
+        self.queued_bytes += queued_size(packets)
+        update_selector_events(self)
+
+
+# Bytes of queued item not sent yet. Iterator counts as one piece of SEND_CHUNK_SIZE until its packets are taken, so
+# a client that sends requests and doesn't receive the replies gets to the window too.
+def queued_size(item):
+    if isinstance(item, memoryview):
+        return len(item)
+    if isinstance(item, FileSender):
+        return item.file_body.size - item.offset
+    return SEND_CHUNK_SIZE
+
+
+# Generate identifier that belongs to this worker, so the acceptor sends its next connections here too
+def generate_identifier():
+    while True:
+        identifier = ''.join(random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits,
+                                            k=IDENTIFIER_SIZE))
+        if shard_of(identifier) == shard_index:
+            return identifier
 
-# Dictionary that save changes of each client by his ID
-file_changes_dict = {}
-# Array of client sockets and address
-client_sockets = []
 
+# Index of the worker process that owns identifier
+def shard_of(identifier):
+    return zlib.crc32(identifier.encode('utf-8')) % shard_count
 
-class ClientDisconnectedException(BaseException):
-    def __init__(self):
-        super().__init__(self, "Client Disconnected")
 
+def is_identifier_directory(name):
+    return len(name) == IDENTIFIER_SIZE and name.isalnum() and os.path.isdir(name)
 
-def generate_identifier():
-    return ''.join(random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=128))
 
+# Called from the filesystem threads, function is called by the event loop with args
+def call_in_loop(function, *args):
+    loop_calls.put((function, args))
+    try:
+        wake_sender.send(b'\0')
+    except BlockingIOError:
+        # The loop has wake bytes to read anyway
+        pass
 
-def add_packet_to_update_dict(packet, identifier, client_address):
-    identifier_dict = file_changes_dict[identifier]
-    for address in identifier_dict:
-        if client_address == address:
-            continue
-        identifier_dict[address].append(packet)
+
+def run_loop_calls():
+    try:
+        while wake_receiver.recv(RECV_SIZE):
+            pass
+    except BlockingIOError:
+        pass
+    while not loop_calls.empty():
+        function, args = loop_calls.get()
+        try:
+            function(*args)
+        except Exception as error:
+            report_error(function.__name__, error)
+
+
+# Queue command of identifier: work is called in a filesystem thread after the previous commands of identifier, and
+# then done is called in the event loop with its result. Command without work (None) only waits for the previous
+# commands, and its done is called without arguments. The command counts in the waiting commands of connection.
+def run_in_identifier_order(identifier, work, done=None, connection=None):
+    if connection:
+        connection.waiting_commands += 1
+    tasks = identifier_tasks.setdefault(identifier, collections.deque())
+    tasks.append((work, done, connection))
+    if len(tasks) == 1:
+        start_tasks(identifier)
+
+
+# Start the waiting commands of identifier. The commands with work at the head of the queue are sent to one thread
+# together, so a batch of small changes doesn't wait for the event loop between them.
+def start_tasks(identifier):
+    tasks = identifier_tasks[identifier]
+    while tasks and tasks[0][0] is None:
+        _, done, connection = tasks[0]
+        if done:
+            call_done(done, connection)
+        tasks.popleft()
+        finish_command(connection)
+    if not tasks:
+        del identifier_tasks[identifier]
+        return
+
+    works = []
+    for work, _, _ in tasks:
+        if work is None:
+            break
+        works.append(work)
+    future = fs_pool.submit(run_works, works)
+    future.add_done_callback(lambda future: call_in_loop(finish_tasks, identifier, future))
+
+
+# Return (result, error) of each work, error of one command doesn't stop the commands after it
+def run_works(works):
+    results = []
+    for work in works:
+        with disk_seconds.time(work_name(work)):
+            try:
+                results.append((work(), None))
+            except Exception as error:
+                results.append((None, error))
+    return results
+
+
+def work_name(work):
+    if work.func is apply_change:
+        return work.args[2].__name__
+    return work.func.__name__
+
+
+def finish_tasks(identifier, future):
+    tasks = identifier_tasks[identifier]
+    for result, error in future.result():
+        work, done, connection = tasks[0]
+        if error:
+            report_failed_work(work, error, done, connection)
+        elif done:
+            call_done(done, connection, result)
+        tasks.popleft()
+        finish_command(connection)
+    start_tasks(identifier)
+
+
+# Call the reply of command in the event loop. Error of the reply closes only the client of the command.
+def call_done(done, connection, *args):
+    try:
+        with reply_seconds.time(done.func.__name__):
+            done(*args)
+    except (ClientDisconnectedException, ConnectionResetError, BrokenPipeError):
+        if connection:
+            close_client(connection)
+    except Exception as error:
+        report_error(done.func.__name__, error)
+        if connection:
+            close_client(connection)
+
+
+def report_error(name, error):
+    errors.inc(name)
+    print('%s failed: %r' % (name, error), file=sys.stderr)
+
+
+# Work failed (disk full, permission denied...), the server keeps serving. Client that waits for the reply of the
+# command never gets it, so it is disconnected and compares its files with the server when it reconnects. Client
+# whose change failed already remembers the change as synced, so it is told to compare its files with the manifest.
+def report_failed_work(work, error, done, connection):
+    report_error(work_name(work), error)
+    if done and connection:
+        close_client(connection)
+    elif connection and work.func is apply_change:
+        resync_origin(work.args[0], connection)
+
+
+# Send RESYNC_COMMAND to the connection of the session that connection belongs to (bulk transfer connection joins the
+# session of its client), or to connection itself
+def resync_origin(identifier, connection):
+    for client_connection in list(identifier_clients.get(identifier, {}).values()):
+        if client_connection.session and client_connection.session == connection.origin:
+            connection = client_connection
+            break
+    resync_client(connection, journal.last_seq(identifier))
+
+
+# Command of connection was applied. If we stopped reading from the client, it may be under the limits again, which is
+# checked after the tasks of identifier started, since it handles the commands we already received.
+def finish_command(connection):
+    if connection:
+        connection.waiting_commands -= 1
+        if connection.paused:
+            call_in_loop(resume_reading, connection)
+
+
+# Apply change of the client origin in a filesystem thread, function returns the journal change or None if nothing
+# changed
+def apply_change(identifier, origin, function, *args):
+    entry = function(*args)
+    if entry:
+        add_entry_to_journal(entry, identifier, origin)
+
+
+def queue_change(identifier, connection, function, *args):
+    run_in_identifier_order(identifier, functools.partial(apply_change, identifier, connection.origin, function, *args),
+                            connection=connection)
+
+
+# Add change of the client origin to the journal, subscribed clients get it immediately and others pull it with
+# UPDATES_COMMAND. Called from the filesystem threads.
+def add_entry_to_journal(entry, identifier, origin):
+    journal.append(identifier, origin, entry, journal_floor(identifier) or 0)
+    call_in_loop(pump_subscribed_clients, identifier)
 
 
-def recv(client_socket, recv_size):
-    recv_data = b''
-    while len(recv_data) < recv_size:
-        recv_data += client_socket.recv(recv_size - len(recv_data))
+# Version of the change we apply now, the changes of identifier are applied one at a time so it is the sequence number
+# its journal change gets
+def next_version(identifier):
+    return journal.last_seq(identifier) + 1
 
-    return recv_data
 
+# Write of origin based on base_version is stale if another client wrote the file after that version. The writes of
+# the same client don't conflict with each other, it sends the next one without waiting for the version of the previous.
+def is_stale_write(identifier, relative_path, base_version, origin):
+    version = blob_store.get_file_version(identifier, relative_path)
+    return version is not None and version[0] > base_version and version[1] != origin
 
-def send_file_to_client(identifier, path, client_socket):
+
+# Stale write is kept in a conflict copy next to the file, from temp_path or from the blob we already have, and the
+# file keeps the content of the other client. The copy is new to the client that wrote it too, so its change is added
+# to the journal without origin and all clients get it.
+def add_conflict_copy(identifier, relative_path, digest, origin, temp_path=None):
+    conflicts.inc('conflict_copy')
+    relative_path = protocol.conflict_path(relative_path, next_version(identifier))
+    if temp_path:
+        store_file(identifier, os.path.join(identifier, relative_path), temp_path, digest, origin)
+    else:
+        with blob_store.blob_lock:
+            blob_store.link_file(identifier, relative_path, digest, next_version(identifier), origin)
+    add_entry_to_journal(journal.Entry(CREATE_COMMAND, 0, relative_path, digest=digest), identifier, None)
+
+
+def pump_subscribed_clients(identifier):
+    last_seq = journal.last_seq(identifier)
+    for client_connection in list(identifier_clients.get(identifier, {}).values()):
+        if last_seq - client_connection.cursor > MAX_CLIENT_LAG:
+            resync_client(client_connection, last_seq)
+        elif client_connection.address in push_clients:
+            pump_journal(client_connection)
+
+
+# Client is too far behind to keep the changes it missed for it (subscribed client that doesn't receive, or client
+# that pulls updates too rarely). It skips to the end of the journal and gets RESYNC_COMMAND instead, after which it
+# compares its files with the manifest, so a slow client doesn't keep the journal growing for everyone.
+def resync_client(connection, last_seq):
+    resyncs.inc()
+    connection.cursor = last_seq
+    connection.pending_packets = []
+    if connection.session:
+        save_session(connection.identifier, connection.session, last_seq)
+    send_update_to_client(connection, connection.identifier, (protocol.build_path_frame(RESYNC_COMMAND, 0, ''), None))
+
+
+# Smallest cursor of the connected clients and of the sessions of identifier, the journal changes up to it are not
+# needed anymore. Sessions more than MAX_CLIENT_LAG changes behind are left out, they resync when they resume. Return
+# None if identifier has no clients.
+def journal_floor(identifier):
+    cursors = [connection.cursor for connection in list(identifier_clients.get(identifier, {}).values())]
+    session_cursor = journal.sessions_floor(identifier, journal.last_seq(identifier) - MAX_CLIENT_LAG)
+    if session_cursor is not None:
+        cursors.append(session_cursor)
+    return min(cursors) if cursors else None
+
+
+# Truncation writes the index and removes the blobs only the removed changes used, so it runs in a filesystem thread
+# with the commands of identifier
+def truncate_journal(identifier):
+    if identifier not in truncating_identifiers:
+        truncating_identifiers.add(identifier)
+        run_in_identifier_order(identifier, functools.partial(truncate_journal_now, identifier))
+
+
+def truncate_journal_now(identifier):
+    truncating_identifiers.discard(identifier)
+    floor = journal_floor(identifier)
+    if floor is not None:
+        journal.truncate(identifier, floor)
+
+
+# Save the cursor of session in a filesystem thread, after the commands of identifier that are already queued
+def save_session(identifier, session, cursor, done=None, connection=None):
+    run_in_identifier_order(identifier, functools.partial(journal.save_session, identifier, session, cursor), done,
+                            connection)
+
+
+# Size of file body we send to client, after the codec of the body if the client uses compression
+def build_body_header(connection, codec, size):
+    header = codec.to_bytes(1, 'little') if connection.codecs else b''
+    return header + size.to_bytes(8, 'little')
+
+
+# Return codec of the compressed copy of blob that client can decompress, or None if we don't have one
+def find_encoded_blob(digest, connection):
+    for codec in compression.CODEC_PREFERENCE:
+        if digest and connection.codecs & compression.codec_bit(codec) \
+                and os.path.isfile(blob_store.encoded_blob_path(digest, codec)):
+            return codec
+    return None
+
+
+def has_encoded_blob(digest, connection):
+    return find_encoded_blob(digest, connection) is not None
+
+
+# Return (FileBody, codec) of the compressed copy of blob that client can decompress, or None if we don't have one
+def open_encoded_blob(digest, connection):
+    codec = find_encoded_blob(digest, connection)
+    if codec is None:
+        return None
+    return open_blob_body(blob_store.encoded_blob_path(digest, codec)), codec
+
+
+# Build packets of journal changes for connection, without the changes whose blob is gone
+def build_entry_packets(entries, connection):
+    packets = (build_entry_packet(entry, connection) for entry in entries)
+    return [packet for packet in packets if packet]
+
+
+# Build packet of journal change for connection, the file data is sent from its blob (compressed as the client that
+# uploaded it sent it, if the connection can decompress it). Return None if the blob was released after we read the
+# change: compaction removed the change because a newer change of the path replaced it, so the client gets that one.
+def build_entry_packet(entry, connection):
+    header = protocol.build_path_frame(entry.command, entry.is_directory, entry.path)
+    if entry.command == MOVE_COMMAND:
+        return header + protocol.build_path(entry.dst_path), None
+    if entry.digest is None:
+        return header, None
+    header += protocol.VERSION.pack(entry.version)
+    if entry.command == DELTA_COMMAND:
+        return header + protocol.UINT32.pack(len(entry.payload)) + entry.payload, None
+
+    try:
+        file_body, codec = open_encoded_blob(entry.digest, connection) \
+            or (open_blob_body(blob_store.blob_path(entry.digest)), compression.RAW)
+    except FileNotFoundError:
+        return None
+    return header + build_body_header(connection, codec, file_body.size), file_body
+
+
+# Build packet of file/directory with command for connection, the file data is sent from the file itself (or from
+# compressed copy of its content)
+def build_file_packet(command, identifier, path, connection):
     send_path = os.path.relpath(path, identifier)
-    packet = CREATE_COMMAND.to_bytes(1, 'little')
-    is_directory = os.path.isdir(path).to_bytes(1, 'little')
-    packet += is_directory
-    packet += len(send_path).to_bytes(4, 'little')
-    packet += send_path.encode('utf-8')
-    if os.path.isdir(path):
-        client_socket.sendall(packet)
-        return
+    is_directory = os.path.isdir(path)
+    header = protocol.build_path_frame(command, is_directory, send_path)
+    if is_directory:
+        return header, None
 
-    with open(path, 'rb') as f:
-        file_data = f.read()
+    file_body, codec = open_encoded_blob(blob_store.get_file_digest(identifier, send_path), connection) \
+        or (FileBody(path), compression.RAW)
+    header += protocol.VERSION.pack(get_version(identifier, send_path)) \
+        + build_body_header(connection, codec, file_body.size)
+    return header, file_body
 
-    packet += len(file_data).to_bytes(4, 'little')
-    packet += file_data
 
-    client_socket.sendall(packet)
+# Version of the file we send, 0 if the index doesn't know it
+def get_version(identifier, relative_path):
+    version = blob_store.get_file_version(identifier, relative_path)
+    return version[0] if version else 0
 
 
 # Indicates that we reach all of files
-def send_empty_file_to_client(client_socket):
+def send_empty_file_to_client(connection):
     packet = int(0).to_bytes(1, 'little')
-    client_socket.sendall(packet)
+    connection.send(packet)
 
 
-def send_all_directory_to_client(path, identifier, client_socket):
-    for root, subdirs, files in os.walk(path):
-        for file in files:
-            send_file_to_client(identifier, os.path.join(root, file), client_socket)
-        for subdir in subdirs:
-            if not os.listdir(os.path.join(root, subdir)):
-                send_file_to_client(identifier, os.path.join(root, subdir), client_socket)
+# Return paths of all files and empty directories under path, called in a filesystem thread. Each directory is read
+# once (os.scandir), a directory is empty if nothing was found in it.
+def list_directory(path):
+    paths = []
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as scanned:
+                entries = list(scanned)
+        except FileNotFoundError:
+            continue
+        if not entries and directory != path:
+            paths.append(directory)
+        for entry in entries:
+            if entry.is_dir():
+                pending.append(entry.path)
+            # Skip files that are being replaced right now
+            elif not entry.name.endswith(TEMP_FILE_SUFFIX):
+                paths.append(entry.path)
+    return paths
+
+
+# Return relative paths of the empty directories of identifier, called in a filesystem thread
+def find_empty_directories(identifier):
+    return [os.path.relpath(path, identifier) for path in list_directory(identifier) if os.path.isdir(path)]
+
+
+# Yield packets of the files and empty directories in paths, files deleted since we listed them are skipped
+def iter_directory_packets(paths, identifier, connection):
+    for path in paths:
+        try:
+            yield build_file_packet(CREATE_COMMAND, identifier, path, connection)
+        except FileNotFoundError:
+            continue
+
+
+def build_manifest_entry(is_directory, relative_path, size, mtime_ns, version, digest):
+    return protocol.UINT8.pack(1) + protocol.build_entry(is_directory, relative_path) \
+        + protocol.MANIFEST_SIZES.pack(size, mtime_ns, version) + digest
+
+
+# Yield the manifest of identifier page by page: path, size, mtime, version and hash of every file from the index
+# (without reading the files), and the empty directories
+def iter_manifest_packets(identifier, empty_directories):
+    for rows in blob_store.iter_file_pages(identifier):
+        yield b''.join(build_manifest_entry(0, path, size, mtime_ns, version, bytes.fromhex(digest))
+                       for path, size, mtime_ns, version, digest in rows), None
+    for path in empty_directories:
+        yield build_manifest_entry(1, path, 0, 0, 0, bytes(blob_store.DIGEST_SIZE)), None
+
+
+# Return content of small file, or None if the file is big (or not a file anymore) and should be sent from the file
+def read_small_file(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(PREFETCH_FILE_SIZE + 1)
+    except (FileNotFoundError, IsADirectoryError, PermissionError):
+        return None
+    return data if len(data) <= PREFETCH_FILE_SIZE else None
+
+
+# CREATE packets of the files in relative_paths (missing files are skipped), queued like iterator of packets. The
+# next PREFETCH_WINDOW files are read by the prefetch threads while the previous ones are still on the wire. Iterating
+# it yields only the files that were already read: while the next file is read, the packets after it wait in the
+# queue and the read wakes up the event loop when it's done, so the loop never waits for the disk.
+class BulkSender:
+    def __init__(self, identifier, relative_paths, connection):
+        self.identifier = identifier
+        self.paths = iter(relative_paths)
+        self.connection = connection
+        self.prefetched = collections.deque()
+        self.prefetch()
+
+    def prefetch(self):
+        while len(self.prefetched) < PREFETCH_WINDOW:
+            relative_path = next(self.paths, None)
+            if relative_path is None:
+                break
+            path = os.path.join(self.identifier, relative_path)
+            future = prefetch_pool.submit(read_small_file, path)
+            future.add_done_callback(lambda future: call_in_loop(resume_reading, self.connection))
+            self.prefetched.append((path, future))
+
+    # Next file is still read
+    def waiting(self):
+        return bool(self.prefetched) and not self.prefetched[0][1].done()
+
+    def finished(self):
+        return not self.prefetched
+
+    def __iter__(self):
+        while self.prefetched and not self.waiting():
+            path, future = self.prefetched.popleft()
+            self.prefetch()
+            packet = build_bulk_packet(self.identifier, path, future.result(), self.connection)
+            if packet:
+                yield packet
+
+
+# Return CREATE packet of file, from data if the prefetch threads read it, or None if the file is missing
+def build_bulk_packet(identifier, path, data, connection):
+    relative_path = os.path.relpath(path, identifier)
+    # Content that we have compressed is sent from the compressed copy
+    if data is None or has_encoded_blob(blob_store.get_file_digest(identifier, relative_path), connection):
+        try:
+            if os.path.isfile(path):
+                return build_file_packet(CREATE_COMMAND, identifier, path, connection)
+        except FileNotFoundError:
+            pass
+        return None
+    header = protocol.build_path_frame(CREATE_COMMAND, 0, relative_path) \
+        + protocol.VERSION.pack(get_version(identifier, relative_path))
+    return header + build_body_header(connection, compression.RAW, len(data)), data
+
+
+# Client asks for many files at once (on one of its bulk transfer connections), we send them and then empty message
+def bulk_fetch_command(reader, identifier, connection):
+    request_id, count = reader.unpack(protocol.BULK_FETCH_HEADER)
+    relative_paths = []
+    for _ in range(count):
+        path = reader.read_path()
+        path = path.replace("/", os.sep)
+        path = path.replace('\\', os.sep)
+        relative_paths.append(path)
+
+    # Files are read by the prefetch threads, we only wait for the commands of identifier before it
+    run_in_identifier_order(identifier, None,
+                            functools.partial(send_bulk_files, identifier, relative_paths, connection, request_id),
+                            connection)
+
+
+def send_bulk_files(identifier, relative_paths, connection, request_id):
+    connection.send(protocol.REQUEST_ID.pack(request_id))
+    connection.send_packets_later(BulkSender(identifier, relative_paths, connection))
+    send_empty_file_to_client(connection)
+
+
+# Bulk transfer connection of client joins its session, so the changes it sends are not sent back to the client
+def join_command(reader, connection):
+    connection.origin = reader.read(SESSION_ID_SIZE).decode('utf-8')
+
+
+# Client compares the manifest with its files, and then transfers only the files that differ
+def send_manifest_to_client(identifier, connection, request_id, empty_directories):
+    connection.send(protocol.REQUEST_ID.pack(request_id))
+    connection.send_packets_later(iter_manifest_packets(identifier, empty_directories))
+
+    # Send empty message to indicates we sent all entries
+    send_empty_file_to_client(connection)
+
+
+def send_all_directory_to_client(identifier, connection, request_id, paths):
+    connection.send(protocol.REQUEST_ID.pack(request_id))
+    connection.send_packets_later(iter_directory_packets(paths, identifier, connection))
 
     # Send empty message to indicates we sent all files
-    send_empty_file_to_client(client_socket)
+    send_empty_file_to_client(connection)
 
 
-def create_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    path_size = int.from_bytes(client_socket.recv(4), 'little')
-    path = os.path.join(identifier, client_socket.recv(path_size).decode('utf-8'))
+# Codec of file body, client that sends codec we did not agree on is closed
+def read_codec(reader, connection):
+    if not connection.codecs:
+        return compression.RAW
+    codec = reader.read_int(1)
+    if codec != compression.RAW and not connection.codecs & compression.codec_bit(codec):
+        report_error('read_codec', ValueError('Codec %d was not agreed on' % codec))
+        raise ClientDisconnectedException()
+    return codec
+
+
+def create_command(reader, identifier, connection):
+    is_directory, sent_path = reader.read_path_frame()
+    path = os.path.join(identifier, sent_path)
     path = path.replace("/", os.sep)
     path = path.replace('\\', os.sep)
 
-    packet = CREATE_COMMAND.to_bytes(1, 'little')
-    packet += is_directory.to_bytes(1, 'little')
-    packet += path_size.to_bytes(4, 'little')
-    packet += os.path.relpath(path, identifier).encode('utf-8')
-
     if is_directory:
-        # If already created so return with empty update packet
-        if os.path.isdir(path):
-            return b''
-        os.makedirs(path, exist_ok=True)
-        return packet
-
-    file_size = int.from_bytes(client_socket.recv(4), 'little')
-    file_data = recv(client_socket, file_size)
+        queue_change(identifier, connection, create_directory, identifier, path)
+        return
 
-    # If already exists the same file we return with empty update packet
-    if os.path.isfile(path):
-        with open(path, 'rb') as f:
-            current_data = f.read()
-            if current_data == file_data:
-                return b''
+    # The file body is received into temp file, and handled in finish_file_upload
+    base_version = reader.unpack(protocol.VERSION)[0]
+    codec = read_codec(reader, connection)
+    file_size = reader.read_int(8)
+    connection.file_receiver = FileReceiver(identifier, path, file_size, CREATE_COMMAND, base_version,
+                                            connection.origin, codec)
 
-    os.makedirs(os.path.dirname(path), exist_ok=True)
 
-    with open(path, 'wb+') as f:
-        f.write(file_data)
-    packet += file_size.to_bytes(4, 'little')
-    packet += file_data
-    return packet
+def create_directory(identifier, path):
+    # If already created so return with empty update packet
+    if os.path.isdir(path):
+        skipped_writes.inc('existing_directory')
+        return None
+    os.makedirs(path, exist_ok=True)
+    return journal.Entry(CREATE_COMMAND, 1, os.path.relpath(path, identifier))
 
 
 def delete_recursive(path):
@@ -128,69 +898,136 @@ def delete_recursive(path):
         os.rmdir(path)
 
 
-def delete_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_path = client_socket.recv(path_size).decode('utf-8')
+def delete_command(reader, identifier, connection):
+    is_directory, sent_path = reader.read_path_frame()
     path = os.path.join(identifier, sent_path)
     path = path.replace("/", os.sep)
     path = path.replace('\\', os.sep)
+    base_version = reader.unpack(protocol.VERSION)[0]
+
+    queue_change(identifier, connection, delete_path, identifier, path, is_directory, base_version, connection)
 
+
+def delete_path(identifier, path, is_directory, base_version, connection):
     # If file/directory does not exists, return with empty update packet
     if not os.path.isfile(path) and not os.path.isdir(path):
-        return b''
+        skipped_writes.inc('missing_path')
+        return None
+
+    # Client deleted file that another client changed after the client saw it, we keep the file and the client gets it
+    # back
+    if not is_directory \
+            and is_stale_write(identifier, os.path.relpath(path, identifier), base_version, connection.origin):
+        conflicts.inc('rejected_delete')
+        call_in_loop(restore_file_to_client, connection, identifier, path)
+        return None
 
     if not os.path.isdir(path):
         os.remove(path)
     else:
         delete_recursive(path)
+    blob_store.remove_path(identifier, os.path.relpath(path, identifier))
 
-    return DELETE_COMMAND.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little') + path_size.to_bytes(4, 'little') \
-           + sent_path.encode('utf-8')
+    return journal.Entry(DELETE_COMMAND, is_directory, os.path.relpath(path, identifier))
 
 
-def modify_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_path = client_socket.recv(path_size).decode('utf-8')
+def modify_command(reader, identifier, connection):
+    sent_path = reader.read_path_frame().path
     path = os.path.join(identifier, sent_path)
     path = path.replace("/", os.sep)
     path = path.replace('\\', os.sep)
-    file_size = int.from_bytes(client_socket.recv(4), 'little')
-    file_data = recv(client_socket, file_size)
+    base_version = reader.unpack(protocol.VERSION)[0]
+    codec = read_codec(reader, connection)
+    file_size = reader.read_int(8)
+
+    # The file body is received into temp file, and handled in finish_file_upload
+    connection.file_receiver = FileReceiver(identifier, path, file_size, MODIFY_COMMAND, base_version,
+                                            connection.origin, codec)
+
+
+# Write the part of data that belongs to the file body we receive, return how many bytes used. Client that sent body
+# that is not valid compressed data is closed, which removes the temp files.
+def receive_file_body(connection, data):
+    try:
+        return connection.file_receiver.write(data)
+    except compression.DECOMPRESS_ERRORS as error:
+        report_error('receive_file_body', error)
+        raise ClientDisconnectedException()
 
-    os.makedirs(os.path.dirname(path), exist_ok=True)
 
-    # If already exists the same file, we return with empty update packet
-    if os.path.isfile(path):
-        with open(path, 'rb') as f:
-            current_data = f.read()
-            if current_data == file_data:
-                return b''
+# Whole file body of create/modify arrived, the stored file is replaced with it in a filesystem thread
+def finish_file_upload(file_receiver, connection):
+    try:
+        file_receiver.close()
+    except compression.DECOMPRESS_ERRORS as error:
+        report_error('finish_file_upload', error)
+        file_receiver.abort()
+        raise ClientDisconnectedException()
+    queue_change(file_receiver.identifier, connection, store_upload, file_receiver)
+
+
+# Replace the stored file with the uploaded content and return the change for the other clients
+def store_upload(file_receiver):
+    identifier = file_receiver.identifier
+    path = file_receiver.path
+    digest = file_receiver.sha256.hexdigest()
+    if is_conflict(identifier, path, file_receiver.temp_path, digest, file_receiver.base_version,
+                   file_receiver.origin):
+        add_conflict_copy(identifier, os.path.relpath(path, identifier), digest, file_receiver.origin,
+                          file_receiver.temp_path)
+        stored = False
+    else:
+        # If already exists the same file we don't need update packet
+        stored = store_file(identifier, path, file_receiver.temp_path, digest, file_receiver.origin)
+    if file_receiver.encoded_file:
+        # The other clients get the content compressed as this client sent it
+        blob_store.store_encoded_blob(file_receiver.encoded_temp_path, digest, file_receiver.codec)
+    if not stored:
+        return None
+
+    return journal.Entry(file_receiver.command, 0, os.path.relpath(path, identifier), digest=digest)
+
+
+# New content in temp_path conflicts with the stored file if the write is stale and the contents differ
+def is_conflict(identifier, path, temp_path, digest, base_version, origin):
+    relative_path = os.path.relpath(path, identifier)
+    return is_stale_write(identifier, relative_path, base_version, origin) \
+        and not blob_store.is_identical(identifier, relative_path, os.path.getsize(temp_path), digest)
+
 
-    with open(path, 'wb+') as f:
-        f.write(file_data)
+# Store new content of path from temp_path in the blob store, return False if the file already has this content
+def store_file(identifier, path, temp_path, digest, origin=None):
+    relative_path = os.path.relpath(path, identifier)
+    # The index answers without reading the stored file
+    if os.path.isfile(path) and blob_store.is_identical(identifier, relative_path, os.path.getsize(temp_path), digest):
+        os.remove(temp_path)
+        skipped_writes.inc('identical_content')
+        return False
 
-    return MODIFY_COMMAND.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little') + path_size.to_bytes(4, 'little') \
-           + sent_path.encode('utf-8') + file_size.to_bytes(4, 'little') + file_data
+    with blob_store.blob_lock:
+        blob_store.store_blob(temp_path, digest)
+        blob_store.link_file(identifier, relative_path, digest, next_version(identifier), origin)
+    return True
 
 
-def move_command(client_socket, identifier):
-    is_directory = int.from_bytes(client_socket.recv(1), 'little')
-    src_path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_src_path = client_socket.recv(src_path_size).decode('utf-8')
+def move_command(reader, identifier, connection):
+    is_directory, sent_src_path = reader.read_path_frame()
     src_path = os.path.join(identifier, sent_src_path)
     src_path = src_path.replace("/", os.sep)
     src_path = src_path.replace('\\', os.sep)
-    dst_path_size = int.from_bytes(client_socket.recv(4), 'little')
-    sent_dst_path = client_socket.recv(dst_path_size).decode('utf-8')
+    sent_dst_path = reader.read_path()
     dst_path = os.path.join(identifier, sent_dst_path)
     dst_path = dst_path.replace("/", os.sep)
     dst_path = dst_path.replace('\\', os.sep)
 
+    queue_change(identifier, connection, move_path, identifier, src_path, dst_path, is_directory)
+
+
+def move_path(identifier, src_path, dst_path, is_directory):
     # If file/directory does not exists, return with empty update packet
     if not os.path.isfile(src_path) and not os.path.isdir(src_path):
-        return b''
+        skipped_writes.inc('missing_path')
+        return None
 
     # Remove destination file if exists
     if not is_directory and os.path.isfile(dst_path):
@@ -204,101 +1041,551 @@ def move_command(client_socket, identifier):
             os.rmdir(src_path)
     else:
         os.rename(src_path, dst_path)
+        blob_store.move_path(identifier, os.path.relpath(src_path, identifier), os.path.relpath(dst_path, identifier))
+
+    return journal.Entry(MOVE_COMMAND, is_directory, os.path.relpath(src_path, identifier),
+                         os.path.relpath(dst_path, identifier))
+
+
+# Return chunk index of the current content of path, contents are immutable blobs so each is indexed only once while
+# it is in the cache. File the index doesn't know has no digest, so it is indexed every time.
+def get_chunk_index(identifier, path):
+    digest = blob_store.get_file_digest(identifier, os.path.relpath(path, identifier))
+    if digest is None:
+        return chunking.chunk_file(path)
+    with chunk_indexes_lock:
+        if digest in chunk_indexes:
+            chunk_indexes.move_to_end(digest)
+            return chunk_indexes[digest]
 
-    return MOVE_COMMAND.to_bytes(1, 'little') + is_directory.to_bytes(1, 'little') + src_path_size.to_bytes(4, 'little') \
-           + sent_src_path.encode('utf-8') + dst_path_size.to_bytes(4, 'little') + sent_dst_path.encode('utf-8')
+    chunk_index = chunking.chunk_file(path)
+    remember_chunk_index(digest, chunk_index)
+    return chunk_index
 
 
-def handle_command(identifier, command, client_socket, client_address):
-    packet = b''
+def remember_chunk_index(digest, chunk_index):
+    with chunk_indexes_lock:
+        chunk_indexes[digest] = chunk_index
+        chunk_indexes.move_to_end(digest)
+        if len(chunk_indexes) > CHUNK_INDEX_CACHE_SIZE:
+            chunk_indexes.popitem(last=False)
+
+
+def delta_command(reader, identifier, connection):
+    is_directory, sent_path = reader.read_path_frame()
+    path = os.path.join(identifier, sent_path)
+    path = path.replace("/", os.sep)
+    path = path.replace('\\', os.sep)
+    base_version = reader.unpack(protocol.VERSION)[0]
+    delta_size = reader.read_int(4)
+    delta = reader.read(delta_size)
+
+    queue_change(identifier, connection, apply_delta, identifier, path, sent_path, is_directory, base_version, delta,
+                 connection)
+
+
+def apply_delta(identifier, path, sent_path, is_directory, base_version, delta, connection):
+    # If we don't have the file that the delta based on, ask the client for the whole file
+    if not os.path.isfile(path):
+        call_in_loop(request_file_from_client, connection, identifier, sent_path)
+        return None
+
+    old_index = get_chunk_index(identifier, path)
+    fd, temp_path = make_temp_file(TEMP_FILE_SUFFIX)
+    os.close(fd)
+    new_index = chunking.apply_delta(path, old_index, delta, temp_path)
+    if new_index is None:
+        os.remove(temp_path)
+        call_in_loop(request_file_from_client, connection, identifier, sent_path)
+        return None
+
+    digest = blob_store.hash_file(temp_path)
+    remember_chunk_index(digest, new_index)
+    # The delta has the whole content of the client (the chunks we have are referred by their digest), so stale delta
+    # is kept in conflict copy as the other writes
+    if is_conflict(identifier, path, temp_path, digest, base_version, connection.origin):
+        add_conflict_copy(identifier, os.path.relpath(path, identifier), digest, connection.origin, temp_path)
+        return None
+    # If the content is the same, we return with empty update packet
+    if not store_file(identifier, path, temp_path, digest, connection.origin):
+        return None
+
+    # Other clients get the same delta
+    return journal.Entry(DELTA_COMMAND, is_directory, os.path.relpath(path, identifier), digest=digest, payload=delta)
+
+
+# Client couldn't apply delta on its copy of the file, so we send it the whole file
+def fetch_command(reader, identifier, connection):
+    path = os.path.join(identifier, reader.read_path_frame().path)
+    path = path.replace("/", os.sep)
+    path = path.replace('\\', os.sep)
+
+    run_in_identifier_order(identifier, functools.partial(os.path.isfile, path),
+                            functools.partial(send_fetched_file, identifier, path, connection), connection)
+
+
+# The commands after the fetch in the same batch of filesystem work may have removed the file already, then the client
+# gets their changes instead
+def send_fetched_file(identifier, path, connection, is_file):
+    try:
+        if is_file:
+            send_update_to_client(connection, identifier,
+                                  build_file_packet(MODIFY_COMMAND, identifier, path, connection))
+    except FileNotFoundError:
+        pass
+
+
+# Client deleted file that another client changed after the client saw it, so the client gets the file back (unless
+# it was removed since then)
+def restore_file_to_client(connection, identifier, path):
+    try:
+        if os.path.isfile(path):
+            send_update_to_client(connection, identifier,
+                                  build_file_packet(CREATE_COMMAND, identifier, path, connection))
+    except FileNotFoundError:
+        pass
+
+
+# Client sent only the hash of the file content, if we already have this content we don't need to receive it
+def have_command(reader, identifier, connection):
+    sent_path = reader.read_path_frame().path
+    path = os.path.join(identifier, sent_path)
+    path = path.replace("/", os.sep)
+    path = path.replace('\\', os.sep)
+    base_version = reader.unpack(protocol.VERSION)[0]
+    digest = reader.read(blob_store.DIGEST_SIZE).hex()
+
+    queue_change(identifier, connection, link_blob, identifier, path, sent_path, base_version, digest, connection)
+
+
+def link_blob(identifier, path, sent_path, base_version, digest, connection):
+    relative_path = os.path.relpath(path, identifier)
+    with blob_store.blob_lock:
+        if not blob_store.has_blob(digest):
+            call_in_loop(request_file_from_client, connection, identifier, sent_path)
+            return None
+        if os.path.isfile(path) and blob_store.get_file_digest(identifier, relative_path) == digest:
+            skipped_writes.inc('identical_content')
+            return None
+        # The client doesn't upload content we already have
+        skipped_writes.inc('known_content')
+        if is_stale_write(identifier, relative_path, base_version, connection.origin):
+            add_conflict_copy(identifier, relative_path, digest, connection.origin)
+            return None
+        blob_store.link_file(identifier, relative_path, digest, next_version(identifier), connection.origin)
+
+    return journal.Entry(MODIFY_COMMAND, 0, relative_path, digest=digest)
+
+
+# Ask client to send whole file instead of delta
+def request_file_from_client(connection, identifier, sent_path):
+    send_update_to_client(connection, identifier, (protocol.build_path_frame(FETCH_COMMAND, 0, sent_path), None))
+
+
+# Many small changes in one frame: size of the batch and then the records, each is command and its usual frame. The
+# batch is handled only when it fully arrived, so the file bodies in it are written straight from the receive buffer.
+def batch_command(reader, identifier, connection):
+    batch_size = reader.read_int(4)
+    batch_end = reader.offset + batch_size
+    if batch_end > len(reader.buffer):
+        raise IncompleteFrameException()
+
+    while reader.offset < batch_end:
+        handle_command(identifier, reader.read_int(1), reader, connection)
+        if connection.file_receiver:
+            with memoryview(reader.buffer) as view:
+                reader.offset += receive_file_body(connection, view[reader.offset:batch_end])
+            file_receiver = connection.file_receiver
+            connection.file_receiver = None
+            finish_file_upload(file_receiver, connection)
+
+
+def handle_command(identifier, command, reader, connection):
+    start = time.perf_counter()
+    dispatch_command(identifier, command, reader, connection)
+    # Counted only when the whole frame arrived, frame that is received again after IncompleteFrameException is not
+    # counted twice
+    name = COMMAND_NAMES.get(command, 'unknown')
+    frames.inc(name)
+    command_seconds.observe(time.perf_counter() - start, name)
+
+
+# Parse command and queue it, the commands that touch the files of identifier are applied in the filesystem threads
+# and the replies that depend on them wait for the commands before them
+def dispatch_command(identifier, command, reader, connection):
     if command == CREATE_COMMAND:
-        packet = create_command(client_socket, identifier)
+        create_command(reader, identifier, connection)
     elif command == DELETE_COMMAND:
-        packet = delete_command(client_socket, identifier)
+        delete_command(reader, identifier, connection)
     elif command == MODIFY_COMMAND:
-        packet = modify_command(client_socket, identifier)
+        modify_command(reader, identifier, connection)
     elif command == MOVE_COMMAND:
-        packet = move_command(client_socket, identifier)
+        move_command(reader, identifier, connection)
     elif command == PULL_COMMAND:
-        send_all_directory_to_client(identifier, identifier, client_socket)
+        request_id = reader.unpack(protocol.REQUEST_ID)[0]
+        run_in_identifier_order(identifier, functools.partial(list_directory, identifier),
+                                functools.partial(send_all_directory_to_client, identifier, connection, request_id),
+                                connection)
+    elif command == MANIFEST_COMMAND:
+        request_id = reader.unpack(protocol.REQUEST_ID)[0]
+        run_in_identifier_order(identifier, functools.partial(find_empty_directories, identifier),
+                                functools.partial(send_manifest_to_client, identifier, connection, request_id),
+                                connection)
+    elif command == BULK_FETCH_COMMAND:
+        bulk_fetch_command(reader, identifier, connection)
+    elif command == JOIN_COMMAND:
+        join_command(reader, connection)
+    elif command == BATCH_COMMAND:
+        batch_command(reader, identifier, connection)
     elif command == UPDATES_COMMAND:
-        update_client(client_socket, identifier, client_address)
-
-    if packet:
-        add_packet_to_update_dict(packet, identifier, client_address)
-
-
-def add_client_to_file_dict(identifier, client_address):
-    if identifier not in file_changes_dict:
-        file_changes_dict[identifier] = {client_address: []}
+        request_id = reader.unpack(protocol.REQUEST_ID)[0]
+        run_in_identifier_order(identifier, None, functools.partial(update_client, connection, identifier, request_id),
+                                connection)
+    elif command == SUBSCRIBE_COMMAND:
+        run_in_identifier_order(identifier, None, functools.partial(subscribe_client, connection, identifier),
+                                connection)
+    elif command == DELTA_COMMAND:
+        delta_command(reader, identifier, connection)
+    elif command == FETCH_COMMAND:
+        fetch_command(reader, identifier, connection)
+    elif command == HAVE_COMMAND:
+        have_command(reader, identifier, connection)
+    elif command == SESSION_COMMAND:
+        session_command(reader, identifier, connection)
+    elif command == ACK_COMMAND:
+        ack_command(reader, identifier, connection)
+
+
+# Client that connects gets the changes from now on, the state before it gets with PULL_COMMAND
+def add_client_to_identifier(identifier, connection):
+    if identifier not in identifier_clients:
+        identifier_clients[identifier] = {}
+    if connection.address not in identifier_clients[identifier]:
+        identifier_clients[identifier][connection.address] = connection
+        connection.identifier = identifier
+        connection.cursor = journal.last_seq(identifier)
+
+
+# Client opens session with the last journal change it applied. If we still have all the changes after it, the client
+# gets only them, otherwise (or if it missed more than MAX_CLIENT_LAG changes) it gets the changes from now on and has
+# to pull the whole directory.
+def session_command(reader, identifier, connection):
+    request_id = reader.unpack(protocol.REQUEST_ID)[0]
+    session = reader.read(SESSION_ID_SIZE).decode('utf-8')
+    cursor = reader.read_int(8)
+
+    resumed = journal.get_session_cursor(identifier, session) is not None and journal.can_resume(identifier, cursor) \
+        and journal.last_seq(identifier) - cursor <= MAX_CLIENT_LAG
+    if not resumed:
+        cursor = journal.last_seq(identifier)
+    connection.session = session
+    connection.origin = session
+    connection.cursor = cursor
+    # Client gets the reply when its session is saved, so the cursor survives server restart once it has it
+    save_session(identifier, session, cursor,
+                 functools.partial(send_session_reply, connection, request_id, resumed, cursor), connection)
+
+
+def send_session_reply(connection, request_id, resumed, cursor, _):
+    connection.send(protocol.REQUEST_ID.pack(request_id) + protocol.SESSION_REPLY.pack(int(resumed), cursor))
+
+
+# Client applied the journal changes up to cursor, we don't need to keep them for its session anymore
+def ack_command(reader, identifier, connection):
+    cursor = reader.read_int(8)
+    if connection.session:
+        save_session(identifier, connection.session, cursor, connection=connection)
+        truncate_journal(identifier)
+
+
+# Send the request the packets answer (or PUSH_REQUEST_ID), packets count and the journal cursor after them, and then
+# the packets themselves
+def send_packets_to_client(connection, packets, request_id=protocol.PUSH_REQUEST_ID):
+    connection.send(protocol.REQUEST_ID.pack(request_id)
+                    + protocol.UPDATES_HEADER.pack(len(packets), connection.cursor))
+
+    for packet in packets:
+        connection.send_packet(packet)
+
+
+# Send update packet only to this client, right away if it subscribed or with its next updates otherwise
+def send_update_to_client(connection, identifier, packet):
+    if connection.address in push_clients:
+        send_packets_to_client(connection, [packet])
     else:
-        identifier_dict = file_changes_dict[identifier]
-        if client_address not in identifier_dict:
-            identifier_dict[client_address] = []
-
+        connection.pending_packets.append(packet)
 
-# Send all update packets to client
-def update_client(client_socket, identifier, client_address):
-    packets_to_send = file_changes_dict[identifier][client_address]
-    client_socket.sendall(len(packets_to_send).to_bytes(4, 'little'))
 
-    for packet_to_send in packets_to_send:
-        client_socket.sendall(packet_to_send)
+# Send the waiting packets and the next batch of journal changes to client
+def update_client(connection, identifier, request_id):
+    entries, connection.cursor = journal.read_entries(identifier, connection.cursor, connection.origin)
+    packets_to_send = connection.pending_packets + build_entry_packets(entries, connection)
+    connection.pending_packets = []
+    send_packets_to_client(connection, packets_to_send, request_id)
+    truncate_journal(identifier)
 
-    packets_to_send.clear()
 
+# Send journal changes to subscribed client, one batch at a time: the next batch is read only when the client got
+# the previous one, so a slow client keeps its changes on disk and not in memory
+def pump_journal(connection):
+    while not connection.send_queue and not connection.closed:
+        entries, cursor = journal.read_entries(connection.identifier, connection.cursor, connection.origin)
+        if cursor == connection.cursor:
+            break
+        connection.cursor = cursor
+        # Batch of only its own changes is sent empty, so the client still gets the new cursor
+        send_packets_to_client(connection, build_entry_packets(entries, connection))
+    truncate_journal(connection.identifier)
+
+
+# From now on send updates to client as soon as they happen, starting with the updates that already waiting
+def subscribe_client(connection, identifier):
+    push_clients[connection.address] = connection
+    if connection.pending_packets:
+        send_packets_to_client(connection, connection.pending_packets)
+        connection.pending_packets = []
+    pump_journal(connection)
+
+
+# Handle one client frame from reader, raise IncompleteFrameException if the frame is not fully received
+def handle_client(reader, connection):
+    # The client sends its identifier once to bind the connection to it, and then only commands
+    if connection.identifier:
+        handle_command(connection.identifier, reader.read_int(1), reader, connection)
+        return
 
-def handle_client(client_socket, client_address):
-    is_identifier = client_socket.recv(1)
-    # If is_identifier is empty array so the client disconnected
-    if not is_identifier:
-        raise ClientDisconnectedException()
+    is_identifier = reader.read_int(1)
+    # Client tells the codecs it has, and we answer with the codecs both of us have
+    if is_identifier == CAPABILITIES_MESSAGE:
+        connection.codecs = reader.read_int(1) & compression.SUPPORTED_CODECS
+        connection.send(connection.codecs.to_bytes(1, 'little'))
+        return
 
-    is_identifier = int.from_bytes(is_identifier, 'little')
-    # If not received identifier we generate one and send it to client, otherwise handle client command
+    # If not received identifier we generate one and send it to client, which then binds the connection to it
     if is_identifier == 0:
         identifier = generate_identifier()
         print(identifier)
         os.makedirs(identifier, exist_ok=True)
-        client_socket.sendall(identifier.encode('utf-8'))
+        connection.send(identifier.encode('utf-8'))
+        return
+
+    identifier = reader.read(IDENTIFIER_SIZE).decode('utf-8')
+    # If client identify with invalid identifier we send him error code (-1) and close after it sent
+    if not is_identifier_directory(identifier):
+        connection.send(int(-1).to_bytes(1, 'little', signed=True))
+        connection.close_after_send = True
+        update_selector_events(connection)
+        return
+
+    add_client_to_identifier(identifier, connection)
+
+
+# Read available data from client and handle the frames
+def read_from_client(connection):
+    with network_seconds.time('recv'):
+        size = connection.socket.recv_into(receive_buffer)
+    # If nothing was received the client disconnected
+    if not size:
+        raise ClientDisconnectedException()
+    received_bytes.inc(amount=size)
+    with memoryview(receive_buffer)[:size] as data:
+        # Rest of a partial frame waits in the buffer of the connection, the new data completes it there
+        if connection.recv_buffer:
+            connection.recv_buffer += data
+            handle_frames(connection)
+        else:
+            handle_frames(connection, data)
+
+
+# Handle all the complete frames in the receive buffer of connection, or in data that was just received if the buffer
+# has nothing before it. What is not handled stays in the buffer of connection.
+def handle_frames(connection, data=None):
+    buffer = connection.recv_buffer if data is None else data
+    reader = protocol.FrameReader(buffer)
+    while not connection.close_after_send:
+        # Bytes of file body go straight to the file we receive, even over the limits: the client may read what we
+        # sent only after it sent the whole body
+        if connection.file_receiver:
+            with memoryview(buffer) as view:
+                reader.offset += receive_file_body(connection, view[reader.offset:])
+            if connection.file_receiver.remaining:
+                break
+            file_receiver = connection.file_receiver
+            connection.file_receiver = None
+            finish_file_upload(file_receiver, connection)
+            continue
+
+        # Frames the client sent after it got over the limits wait in the buffer until we handle them again
+        if reader.offset == len(buffer) or is_over_limits(connection):
+            break
+        frame_start = reader.offset
+        try:
+            handle_client(reader, connection)
+        except IncompleteFrameException:
+            # Wait for the rest of the frame
+            reader.offset = frame_start
+            break
+
+    if data is None:
+        del connection.recv_buffer[:reader.offset]
     else:
-        identifier = client_socket.recv(128).decode('utf-8')
-        command = int.from_bytes(client_socket.recv(1), 'little')
-        # If client identify with invalid identifier we send him error code (-1)
-        if not os.path.isdir(identifier):
-            client_socket.sendall(int(-1).to_bytes(1, 'little', signed=True))
-            client_socket.close()
-            raise ClientDisconnectedException()
-        handle_command(identifier, command, client_socket, client_address)
+        connection.recv_buffer += data[reader.offset:]
+    update_selector_events(connection)
+
+
+# Take the next packets of iterator, as the items to queue before it: packets with the body in memory are taken up to
+# SEND_GATHER_COUNT buffers, and up to the first packet with body in file. The iterator is the last item, if it has
+# more packets (BulkSender stops at the file that is still read, and stays in the queue until it sent all).
+def take_packets(packets):
+    items = []
+    for header, body in packets:
+        items.append(memoryview(header))
+        if isinstance(body, FileBody):
+            items.append(FileSender(body))
+            break
+        if body:
+            items.append(memoryview(body))
+        if len(items) >= SEND_GATHER_COUNT:
+            break
+    else:
+        if not isinstance(packets, BulkSender) or packets.finished():
+            return items
+    items.append(packets)
+    return items
+
 
-    # Add client to dict of update changes
-    add_client_to_file_dict(identifier, client_address)
+# Queued item we can send now, which is everything but BulkSender that waits for its next file
+def is_sendable(item):
+    return not isinstance(item, BulkSender) or not item.waiting()
 
 
-def handle_all_clients():
-    removed_sockets = []
-    global client_sockets
-    for client_socket, client_address in client_sockets:
-        while True:
+# Send queued data as much as the socket accepts without blocking
+def write_to_client(connection):
+    while connection.send_queue:
+        data = connection.send_queue[0]
+        if isinstance(data, FileSender):
+            offset = data.offset
             try:
-                handle_client(client_socket, client_address)
-            except socket.timeout:
+                sent_all = data.send(connection.socket)
+            except BlockingIOError:
+                sent_all = False
+            connection.queued_bytes -= data.offset - offset
+            if not sent_all:
                 break
-            except (ClientDisconnectedException, ConnectionResetError):
-                removed_sockets.append((client_socket, client_address))
+            connection.send_queue.popleft()
+            continue
+
+        if not isinstance(data, memoryview):
+            # Read of the next bulk file wakes us up when it's done
+            if not is_sendable(data):
                 break
+            connection.send_queue.popleft()
+            items = take_packets(data)
+            connection.queued_bytes += sum(queued_size(item) for item in items) - queued_size(data)
+            connection.send_queue.extendleft(reversed(items))
+            continue
 
-    # Remove all clients that disconnected
-    client_sockets = list(set(client_sockets) - set(removed_sockets))
-    for remove_socket in removed_sockets:
-        remove_client_from_dict(remove_socket[1])
+        # Headers and bodies in memory that wait one after the other are sent together, without joining them
+        views = []
+        for item in itertools.islice(connection.send_queue, SEND_GATHER_COUNT):
+            if not isinstance(item, memoryview):
+                break
+            views.append(item)
+        try:
+            with network_seconds.time('send'):
+                if len(views) > 1 and hasattr(connection.socket, 'sendmsg'):
+                    sent = connection.socket.sendmsg(views)
+                else:
+                    sent = connection.socket.send(data)
+        except BlockingIOError:
+            break
+        sent_bytes.inc(amount=sent)
+        connection.queued_bytes -= sent
+        # Remove what was sent, if only part of a buffer was sent the socket is full
+        for view in views:
+            if sent < len(view):
+                connection.send_queue[0] = view[sent:]
+                break
+            sent -= len(view)
+            connection.send_queue.popleft()
+        else:
+            continue
+        break
 
+    if not connection.send_queue and connection.close_after_send:
+        raise ClientDisconnectedException()
+    # Subscribed client got everything we queued, so it can get the next journal changes
+    if not connection.send_queue and connection.address in push_clients:
+        pump_journal(connection)
+    resume_reading(connection)
 
-def remove_client_from_dict(client_address):
-    for identifier in file_changes_dict:
-        if client_address in file_changes_dict[identifier]:
-            del file_changes_dict[identifier][client_address]
-            break
+
+# Client has more than SEND_WINDOW bytes waiting for it, or more than WAITING_COMMANDS commands waiting to be applied
+def is_over_limits(connection):
+    return bool(connection.send_queue) and connection.queued_bytes > SEND_WINDOW \
+        or connection.waiting_commands > WAITING_COMMANDS
+
+
+# Listen to write events only while there is data to send, and stop reading from client that going to be closed or
+# that is over the limits. File body we receive now is read to its end anyway, only the frames after it wait.
+def update_selector_events(connection):
+    if connection.closed:
+        return
+    paused = is_over_limits(connection)
+    if paused and not connection.paused:
+        paused_reads.inc()
+    connection.paused = paused
+    events = 0 if connection.close_after_send or (paused and not connection.file_receiver) else selectors.EVENT_READ
+    if connection.send_queue and is_sendable(connection.send_queue[0]):
+        events |= selectors.EVENT_WRITE
+    registered = connection.socket in selector.get_map()
+    if events == 0:
+        if connection.close_after_send:
+            raise ClientDisconnectedException()
+        # Paused client we have nothing to send waits only for its commands
+        if registered:
+            selector.unregister(connection.socket)
+    elif registered:
+        selector.modify(connection.socket, events, connection)
+    else:
+        selector.register(connection.socket, events, connection)
+
+
+# Update the events of connection, and if we read from client again, handle the frames that waited in its buffer
+def resume_reading(connection):
+    paused = connection.paused
+    try:
+        update_selector_events(connection)
+        if paused and not connection.paused:
+            handle_frames(connection)
+    except (ClientDisconnectedException, ConnectionResetError, BrokenPipeError):
+        close_client(connection)
+
+
+def accept_client(server):
+    client_socket, client_address = server.accept()
+    client_socket.setblocking(False)
+    connection = ClientConnection(client_socket, client_address)
+    selector.register(client_socket, selectors.EVENT_READ, connection)
+
+
+def close_client(connection):
+    if connection.closed:
+        return
+    connection.closed = True
+    if connection.socket in selector.get_map():
+        selector.unregister(connection.socket)
+    connection.socket.close()
+    if connection.file_receiver:
+        connection.file_receiver.abort()
+    push_clients.pop(connection.address, None)
+    remove_client_from_identifier(connection)
+
+
+def remove_client_from_identifier(connection):
+    if connection.identifier:
+        identifier_clients[connection.identifier].pop(connection.address, None)
+        truncate_journal(connection.identifier)
 
 
 def check_port(n):
@@ -311,38 +1598,211 @@ def check_port(n):
         return 0
 
 
-port = sys.argv[1]
-if check_port(port) == 0:
-    exit()
+def run_server(port, workers=1):
+    identifiers = [name for name in os.listdir('.') if is_identifier_directory(name)]
+    # Journals first, so the blobs their changes refer to are kept
+    journal.load_journals(workers, identifiers)
+    blob_store.load_store(identifiers)
 
-port = int(port)
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(('', port))
-server.settimeout(0.2)
-server.listen()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Sessions of clients survive restart, so the server can be restarted right away on the same port
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('', port))
+    server.listen()
+    server.setblocking(False)
+
+    if workers == 1:
+        serve(server, None)
+    else:
+        run_acceptor(server, start_workers(server, workers))
+
+
+# Event loop of the server (or of one worker process, that gets its clients from the acceptor over handoff socket)
+def serve(server, handoff):
+    global selector, wake_receiver, wake_sender
+    start_metrics()
+    journal.open_journal(shard_index, shard_count)
+    selector = selectors.DefaultSelector()
+    wake_receiver, wake_sender = socket.socketpair()
+    wake_receiver.setblocking(False)
+    wake_sender.setblocking(False)
+    selector.register(wake_receiver, selectors.EVENT_READ)
+    if server:
+        selector.register(server, selectors.EVENT_READ)
+    if handoff:
+        selector.register(handoff, selectors.EVENT_READ)
 
-try:
     while True:
-        try:
-            # Wait for connection of new client for 0.2 seconds
-            client_socket, client_address = server.accept()
-            client_socket.settimeout(2)
-            client_sockets.append((client_socket, client_address))
-        except socket.timeout:
-            # If not accept new client, we iterate all existing clients and handle their commands
-            handle_all_clients()
-            continue
+        # Wait until one of the sockets is ready, so idle or slow client never block the others
+        for key, mask in selector.select():
+            # Filesystem threads finished commands
+            if key.fileobj is wake_receiver:
+                run_loop_calls()
+                continue
+            if key.fileobj is server:
+                accept_client(server)
+                continue
 
-        while True:
             try:
-                # If new client accepted, handle him until non response timeout of 2 seconds
-                handle_client(client_socket, client_address)
-            except socket.timeout:
-                break
-            except (ClientDisconnectedException, ConnectionResetError):
+                if key.fileobj is handoff:
+                    connection = receive_client(handoff)
+                    if connection:
+                        handle_frames(connection)
+                    continue
+                connection = key.data
+                if mask & selectors.EVENT_READ:
+                    read_from_client(connection)
+                if mask & selectors.EVENT_WRITE and not connection.closed:
+                    write_to_client(connection)
+            except (ClientDisconnectedException, ConnectionResetError, BrokenPipeError):
                 # If client disconnected we remove him for our lists
-                client_sockets.remove((client_socket, client_address))
-                remove_client_from_dict(client_address)
-                break
-except KeyboardInterrupt:
-    pass
+                close_client(connection)
+
+
+# Serve the metrics of this process, each worker process on its own port and file
+def start_metrics():
+    if metrics_port:
+        metrics.start_http_server(metrics_port + shard_index)
+    if metrics_file:
+        metrics.start_dump(metrics_file if shard_count == 1 else '%s.%d' % (metrics_file, shard_index))
+
+
+# Fork the worker processes, each with its end of a handoff socket. Return the acceptor ends of the handoff sockets.
+def start_workers(server, count):
+    global shard_count, shard_index
+    shard_count = count
+    # Workers open their own connections to the index and the journals
+    blob_store.close_index()
+    journal.close_journals()
+    handoffs = []
+    for index in range(count):
+        acceptor_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        if os.fork() == 0:
+            server.close()
+            acceptor_end.close()
+            for handoff in handoffs:
+                handoff.close()
+            shard_index = index
+            # Workers share the blob store, so blob references are changed under a lock of all processes
+            blob_store.blob_lock.share_between_processes()
+            try:
+                serve(None, worker_end)
+            except KeyboardInterrupt:
+                pass
+            os._exit(0)
+        worker_end.close()
+        handoffs.append(acceptor_end)
+    return handoffs
+
+
+# Worker gets client connection from the acceptor: the socket, the codecs the acceptor agreed on with the client and
+# the beginning of the first frame, that the acceptor already read. Return the connection, or None if the client
+# disconnected meanwhile.
+def receive_client(handoff):
+    data, fds, _, _ = socket.recv_fds(handoff, 2 + IDENTIFIER_SIZE, 1)
+    # Acceptor exited
+    if not data:
+        sys.exit()
+    client_socket = socket.socket(fileno=fds[0])
+    client_socket.setblocking(False)
+    try:
+        client_address = client_socket.getpeername()
+    except OSError:
+        client_socket.close()
+        return None
+    connection = ClientConnection(client_socket, client_address)
+    connection.codecs = data[0]
+    connection.recv_buffer += data[1:]
+    selector.register(client_socket, selectors.EVENT_READ, connection)
+    return connection
+
+
+# Connection the acceptor reads until it knows which worker it belongs to
+class PendingConnection:
+    def __init__(self, client_socket):
+        self.socket = client_socket
+        self.buffer = bytearray()
+        self.codecs = 0
+
+    # Bytes we still need: is_identifier, and the identifier if the client has one. We never read more than that, so
+    # the rest of the frame stays in the socket for the worker.
+    def needed(self):
+        if not self.buffer:
+            return 1
+        if self.buffer[0] == CAPABILITIES_MESSAGE:
+            return 2 - len(self.buffer)
+        if self.buffer[0] == 0:
+            return 0
+        return 1 + IDENTIFIER_SIZE - len(self.buffer)
+
+
+# Read from pending connection, return True when we know its worker
+def read_pending(pending):
+    data = pending.socket.recv(pending.needed())
+    if not data:
+        raise ClientDisconnectedException()
+    pending.buffer += data
+    # The acceptor answers the codecs message itself, and tells the worker what it agreed on
+    if pending.buffer[0] == CAPABILITIES_MESSAGE:
+        if len(pending.buffer) == 2:
+            pending.codecs = pending.buffer[1] & compression.SUPPORTED_CODECS
+            pending.socket.send(pending.codecs.to_bytes(1, 'little'))
+            pending.buffer.clear()
+        return False
+    return pending.needed() == 0
+
+
+# Pass the connection to the worker that owns its identifier. Client without identifier goes to any worker, which
+# generates an identifier of its own.
+def hand_off(pending, handoffs):
+    if pending.buffer[0] == 0:
+        handoff = random.choice(handoffs)
+    else:
+        handoff = handoffs[shard_of(pending.buffer[1:].decode('utf-8', 'replace'))]
+    socket.send_fds(handoff, [pending.codecs.to_bytes(1, 'little') + bytes(pending.buffer)], [pending.socket.fileno()])
+    pending.socket.close()
+
+
+# Front of the sharded server: accepts clients, reads only their identifier and hands them to the workers, which do
+# all the rest
+def run_acceptor(server, handoffs):
+    acceptor_selector = selectors.DefaultSelector()
+    acceptor_selector.register(server, selectors.EVENT_READ)
+    while True:
+        for key, _ in acceptor_selector.select():
+            if key.fileobj is server:
+                client_socket, _ = server.accept()
+                client_socket.setblocking(False)
+                acceptor_selector.register(client_socket, selectors.EVENT_READ, PendingConnection(client_socket))
+                continue
+
+            pending = key.data
+            try:
+                if read_pending(pending):
+                    acceptor_selector.unregister(pending.socket)
+                    hand_off(pending, handoffs)
+            except (ClientDisconnectedException, ConnectionResetError, BrokenPipeError):
+                acceptor_selector.unregister(pending.socket)
+                pending.socket.close()
+
+
+if __name__ == "__main__":
+    # --workers=N runs N worker processes, each serving part of the identifiers. --metrics-port=PORT serves the
+    # metrics on http://127.0.0.1:PORT/metrics and --metrics-file=PATH writes them to file every few seconds.
+    workers = 1
+    for arg in sys.argv:
+        if arg.startswith('--workers='):
+            workers = int(arg[len('--workers='):])
+        elif arg.startswith('--metrics-port='):
+            metrics_port = int(arg[len('--metrics-port='):])
+        elif arg.startswith('--metrics-file='):
+            metrics_file = arg[len('--metrics-file='):]
+    args = [arg for arg in sys.argv if not arg.startswith(('--workers=', '--metrics-port=', '--metrics-file='))]
+    port = args[1]
+    if check_port(port) == 0 or workers < 1:
+        exit()
+
+    try:
+        run_server(int(port), workers)
+    except KeyboardInterrupt:
+        pass
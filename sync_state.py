@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import threading
+
+# State of the client that survives restart, in database next to the synced directory (not in it, so watchdog doesn't
+# see it). It keeps size, mtime, inode and hash of every file as we last synced it with the server, which is both the
+# hash cache of the local manifest and the base we compare with to know which side changed, the server version our
+# writes of each file are based on, and our session with the server. Watchdog thread and the thread that handles
+# updates both change it, so only one uses it at a time.
+STATE_FILE_SUFFIX = '.sync-state.db'
+
+base_path = None
+state = None
+# State of older version has no server versions, the client gets them from the manifest of the server
+versions_missing = False
+state_lock = threading.Lock()
+
+
+def open_state(path):
+    global base_path, state, versions_missing
+    base_path = path
+    state_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + STATE_FILE_SUFFIX)
+    state = sqlite3.connect(state_path, isolation_level=None, check_same_thread=False)
+    state.execute('PRAGMA journal_mode=WAL')
+    state.execute('PRAGMA synchronous=NORMAL')
+    state.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL,'
+                  ' mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL, inode INTEGER NOT NULL DEFAULT 0,'
+                  ' version INTEGER NOT NULL DEFAULT 0)')
+    # State of older version has no inodes and versions, they are 0 until the files are synced again
+    columns = [column[1] for column in state.execute('PRAGMA table_info(files)')]
+    if 'inode' not in columns:
+        state.execute('ALTER TABLE files ADD COLUMN inode INTEGER NOT NULL DEFAULT 0')
+    if 'version' not in columns:
+        state.execute('ALTER TABLE files ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        versions_missing = True
+    # One row with the identifier we synced the files with, our session and the last server change we applied
+    state.execute('CREATE TABLE IF NOT EXISTS session (identifier TEXT NOT NULL, session TEXT NOT NULL,'
+                  ' cursor INTEGER NOT NULL)')
+
+
+def relative_path(path):
+    return os.path.relpath(path, base_path)
+
+
+# Return (identifier, session, cursor), or None if we don't have a session
+def get_session():
+    with state_lock:
+        return state.execute('SELECT identifier, session, cursor FROM session').fetchone()
+
+
+def save_session(identifier, session, cursor):
+    with state_lock:
+        state.execute('BEGIN')
+        state.execute('DELETE FROM session')
+        state.execute('INSERT INTO session VALUES (?, ?, ?)', (identifier, session, cursor))
+        state.execute('COMMIT')
+
+
+# Save cursor of the session, if we have one
+def save_cursor(cursor):
+    with state_lock:
+        state.execute('UPDATE session SET cursor = ?', (cursor,))
+
+
+def clear_session():
+    with state_lock:
+        state.execute('DELETE FROM session')
+
+
+# Return {relative path: (size, mtime_ns, hash, inode)} of the files as we synced them
+def get_files():
+    with state_lock:
+        return {path: (size, mtime_ns, digest, inode) for path, size, mtime_ns, digest, inode
+                in state.execute('SELECT path, size, mtime_ns, digest, inode FROM files')}
+
+
+# Return {relative path: server version our writes are based on} of the files as we synced them
+def get_versions():
+    with state_lock:
+        return dict(state.execute('SELECT path, version FROM files'))
+
+
+# files is {relative path: (size, mtime_ns, hash, inode, version)}
+def replace_files(files):
+    with state_lock:
+        state.execute('BEGIN')
+        state.execute('DELETE FROM files')
+        state.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                          ((path,) + tuple(file) for path, file in files.items()))
+        state.execute('COMMIT')
+
+
+# Return (size, mtime_ns, hash, inode) of path as we synced it, or None
+def get_file(path):
+    with state_lock:
+        return state.execute('SELECT size, mtime_ns, digest, inode FROM files WHERE path = ?',
+                             (relative_path(path),)).fetchone()
+
+
+# We synced this content (stat and hex digest) of path with the server. version is of content we got from the server,
+# content we sent keeps the version it was based on.
+def set_file(path, stat, digest, version=None):
+    row = (relative_path(path), stat.st_size, stat.st_mtime_ns, digest, stat.st_ino)
+    with state_lock:
+        if version is None:
+            state.execute('INSERT INTO files (path, size, mtime_ns, digest, inode) VALUES (?, ?, ?, ?, ?)'
+                          ' ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns,'
+                          ' digest = excluded.digest, inode = excluded.inode', row)
+        else:
+            state.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', row + (version,))
+
+
+# Return the server version of path our writes are based on, 0 if we never got it from the server
+def get_version(path):
+    with state_lock:
+        row = state.execute('SELECT version FROM files WHERE path = ?', (relative_path(path),)).fetchone()
+    return row[0] if row else 0
+
+
+def set_version(path, version):
+    with state_lock:
+        state.execute('UPDATE files SET version = ? WHERE path = ?', (version, relative_path(path)))
+
+
+# Range of path and everything under it, every path under it is between path + separator and path + the character
+# after the separator
+UNDER_CONDITION = 'path = ? OR (path >= ? AND path < ?)'
+
+
+def under_parameters(path):
+    return path, path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+# Return True if we synced path or anything under it
+def has_path(path):
+    with state_lock:
+        return state.execute('SELECT 1 FROM files WHERE ' + UNDER_CONDITION + ' LIMIT 1',
+                             under_parameters(relative_path(path))).fetchone() is not None
+
+
+def remove_path(path):
+    with state_lock:
+        state.execute('DELETE FROM files WHERE ' + UNDER_CONDITION, under_parameters(relative_path(path)))
+
+
+def move_path(src_path, dst_path):
+    src_path = relative_path(src_path)
+    dst_path = relative_path(dst_path)
+    with state_lock:
+        state.execute('BEGIN')
+        moved = state.execute('SELECT path, size, mtime_ns, digest, inode, version FROM files WHERE ' + UNDER_CONDITION,
+                              under_parameters(src_path)).fetchall()
+        state.execute('DELETE FROM files WHERE ' + UNDER_CONDITION, under_parameters(src_path))
+        state.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                          ((dst_path + row[0][len(src_path):],) + row[1:] for row in moved))
+        state.execute('COMMIT')
@@ -0,0 +1,70 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import chunking
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.random = random.Random(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    # Make delta of new content against the old file and apply it, return (delta, rebuilt content, rebuilt index)
+    def round_trip(self, old_content, new_content):
+        old_path = self.write('old', old_content)
+        old_index = chunking.chunk_file(old_path)
+        delta, new_index = chunking.make_delta(self.write('new', new_content), old_index)
+        rebuilt_path = os.path.join(self.directory, 'rebuilt')
+        rebuilt_index = chunking.apply_delta(old_path, old_index, delta, rebuilt_path)
+        with open(rebuilt_path, 'rb') as f:
+            rebuilt = f.read()
+        self.assertEqual(rebuilt_index, new_index)
+        return delta, rebuilt, rebuilt_index
+
+    def test_insert_in_the_middle_sends_only_chunks_around_it(self):
+        old_content = self.random.randbytes(1024 * 1024)
+        new_content = old_content[:500000] + b'inserted' + old_content[500000:]
+        delta, rebuilt, _ = self.round_trip(old_content, new_content)
+        self.assertEqual(rebuilt, new_content)
+        self.assertLess(len(delta), 4 * chunking.MAX_CHUNK_SIZE)
+
+    def test_unchanged_content_is_only_copies(self):
+        content = self.random.randbytes(300 * 1024)
+        delta, rebuilt, rebuilt_index = self.round_trip(content, content)
+        self.assertEqual(rebuilt, content)
+        self.assertEqual(len(delta), len(rebuilt_index) * (1 + chunking.DIGEST_SIZE))
+
+    def test_new_content_is_literal(self):
+        delta, rebuilt, _ = self.round_trip(b'', b'new content')
+        self.assertEqual(rebuilt, b'new content')
+        self.assertEqual(delta[0], chunking.LITERAL_CHUNK)
+
+    def test_chunk_boundaries_are_within_limits(self):
+        content = self.random.randbytes(1024 * 1024)
+        chunk_index = chunking.chunk_file(self.write('f', content))
+        self.assertEqual(sum(length for _, _, length in chunk_index), len(content))
+        self.assertTrue(all(length <= chunking.MAX_CHUNK_SIZE for _, _, length in chunk_index))
+        self.assertTrue(all(length >= chunking.MIN_CHUNK_SIZE for _, _, length in chunk_index[:-1]))
+
+    def test_apply_fails_if_old_file_changed_since_indexed(self):
+        content = self.random.randbytes(300 * 1024)
+        old_path = self.write('old', content)
+        old_index = chunking.chunk_file(old_path)
+        delta, _ = chunking.make_delta(self.write('new', content + b'more'), old_index)
+        self.write('old', bytes(len(content)))
+        self.assertIsNone(chunking.apply_delta(old_path, old_index, delta, os.path.join(self.directory, 'rebuilt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import threading
+import unittest
+import client
+from client import Change, CREATE_COMMAND, DELETE_COMMAND, MODIFY_COMMAND, MOVE_COMMAND
+
+# Files of the manifests: local and synced are (size, mtime_ns, hash, inode), server is (size, mtime_ns, hash, version)
+OLD = (3, 1, 'old', 1)
+NEW = (3, 2, 'new', 1)
+OTHER = (5, 3, 'other', 2)
+
+
+class ChooseSyncActionTest(unittest.TestCase):
+    def choose(self, local=None, server=None, synced=None, synced_version=None, known_sync=True):
+        def files(file):
+            return {'f': file} if file else {}
+        versions = {'f': synced_version} if synced_version is not None else {}
+        return client.choose_sync_action('f', files(local), files(server), files(synced) if known_sync else None,
+                                         versions if known_sync else None)
+
+    def test_same_content_needs_nothing(self):
+        self.assertIsNone(self.choose(local=OLD, server=OLD, synced=NEW))
+
+    def test_changed_only_here_is_pushed(self):
+        self.assertEqual(self.choose(local=NEW, server=OLD, synced=OLD), 'push')
+        self.assertEqual(self.choose(local=None, server=OLD, synced=OLD), 'delete server')
+
+    def test_changed_only_on_server_is_pulled(self):
+        self.assertEqual(self.choose(local=OLD, server=NEW[:3] + (5,), synced=OLD, synced_version=4), 'pull')
+        self.assertEqual(self.choose(local=OLD, server=None, synced=OLD, synced_version=4), 'delete local')
+
+    def test_changed_on_both_sides_is_conflict(self):
+        self.assertEqual(self.choose(local=NEW, server=OTHER, synced=OLD), 'conflict')
+
+    def test_without_sync_state_both_files_are_conflict(self):
+        self.assertEqual(self.choose(local=NEW, server=OTHER, known_sync=False), 'conflict')
+        self.assertEqual(self.choose(local=NEW, known_sync=False), 'push')
+        self.assertEqual(self.choose(server=OTHER, known_sync=False), 'pull')
+
+    # Our write that the server lost (it has no newer version than we synced) is pushed again instead of pulling the
+    # old content back
+    def test_lost_write_is_pushed_again(self):
+        self.assertEqual(self.choose(local=NEW, server=OLD[:3] + (4,), synced=NEW, synced_version=4), 'push')
+        self.assertEqual(self.choose(local=NEW, server=None, synced=NEW, synced_version=0), 'push')
+        self.assertEqual(self.choose(local=NEW, server=None, synced=NEW, synced_version=4), 'delete local')
+
+
+class ChangeQueueTest(unittest.TestCase):
+    def setUp(self):
+        # The changes are never sent by the queue thread, we look at the merged changes
+        self.queue = client.ChangeQueue(None, 3600)
+
+    def path(self, *names):
+        return os.path.join(os.sep + 'synced', *names)
+
+    def test_create_and_modify_is_one_create(self):
+        self.queue.merge_created(self.path('f'), False)
+        self.queue.merge_modified(self.path('f'))
+        self.assertEqual(self.queue.changes, [Change(CREATE_COMMAND, self.path('f'), False)])
+
+    def test_modifies_are_one_modify(self):
+        self.queue.merge_modified(self.path('f'))
+        self.queue.merge_modified(self.path('f'))
+        self.assertEqual(self.queue.changes, [Change(MODIFY_COMMAND, self.path('f'), False)])
+
+    def test_create_and_delete_is_nothing(self):
+        self.queue.merge_created(self.path('f'), False)
+        self.queue.merge_modified(self.path('f'))
+        self.queue.merge_deleted(self.path('f'), False)
+        self.assertEqual(self.queue.changes, [])
+
+    def test_modify_and_delete_is_delete(self):
+        self.queue.merge_modified(self.path('f'))
+        self.queue.merge_deleted(self.path('f'), False)
+        self.assertEqual(self.queue.changes, [Change(DELETE_COMMAND, self.path('f'), False)])
+
+    def test_delete_of_directory_replaces_deletes_under_it(self):
+        self.queue.merge_deleted(self.path('d', 'f'), False)
+        self.queue.merge_deleted(self.path('d-sibling'), False)
+        self.queue.merge_deleted(self.path('d'), True)
+        self.assertEqual(self.queue.changes, [Change(DELETE_COMMAND, self.path('d-sibling'), False),
+                                              Change(DELETE_COMMAND, self.path('d'), True)])
+
+    def test_moves_of_the_same_file_are_one_move(self):
+        self.queue.merge_moved(self.path('a'), self.path('b'), False)
+        self.queue.merge_moved(self.path('b'), self.path('c'), False)
+        self.assertEqual(self.queue.changes, [Change(MOVE_COMMAND, self.path('a'), False, self.path('c'))])
+
+    def test_move_back_is_nothing(self):
+        self.queue.merge_moved(self.path('a'), self.path('b'), False)
+        self.queue.merge_moved(self.path('b'), self.path('a'), False)
+        self.assertEqual(self.queue.changes, [])
+
+    def test_created_file_moved_is_created_at_its_new_path(self):
+        self.queue.merge_created(self.path('a'), False)
+        self.queue.merge_moved(self.path('a'), self.path('b'), False)
+        self.assertEqual(self.queue.changes, [Change(CREATE_COMMAND, self.path('b'), False)])
+
+    def test_modified_file_moved_is_moved_and_then_sent(self):
+        self.queue.merge_modified(self.path('a'))
+        self.queue.merge_moved(self.path('a'), self.path('b'), False)
+        self.assertEqual(self.queue.changes, [Change(MOVE_COMMAND, self.path('a'), False, self.path('b')),
+                                              Change(MODIFY_COMMAND, self.path('b'), False)])
+
+    def test_moves_under_moved_directory_are_dropped(self):
+        self.queue.merge_moved(self.path('d'), self.path('e'), True)
+        self.queue.merge_moved(self.path('d', 'f'), self.path('e', 'f'), False)
+        self.assertEqual(self.queue.changes, [Change(MOVE_COMMAND, self.path('d'), True, self.path('e'))])
+
+    def test_changes_are_sent_after_the_quiet_window(self):
+        sent = []
+        all_sent = threading.Event()
+
+        def send_change(change):
+            sent.append(change)
+            if len(sent) == 2:
+                all_sent.set()
+        queue = client.ChangeQueue(send_change, 0.01)
+        queue.add(queue.merge_modified, self.path('a'))
+        queue.add(queue.merge_modified, self.path('a'))
+        queue.add(queue.merge_deleted, self.path('b'), False)
+        self.assertTrue(all_sent.wait(5))
+        self.assertEqual(sent, [Change(MODIFY_COMMAND, self.path('a'), False),
+                                Change(DELETE_COMMAND, self.path('b'), False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
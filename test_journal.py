@@ -0,0 +1,100 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import blob_store
+import journal
+from journal import Entry, CREATE_COMMAND, DELETE_COMMAND, MODIFY_COMMAND, MOVE_COMMAND, DELTA_COMMAND
+
+IDENTIFIER = 'identifier'
+
+
+# Journal of one worker in a temp directory, with the blob store its changes refer to
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.old_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        os.makedirs(IDENTIFIER)
+        journal.load_journals(1, [IDENTIFIER])
+        blob_store.load_store([IDENTIFIER])
+        journal.open_journal()
+
+    def tearDown(self):
+        journal.close_journals()
+        blob_store.close_index()
+        os.chdir(self.old_directory)
+        shutil.rmtree(self.directory)
+
+    # Put content into the blob store, return its digest
+    def store(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        os.makedirs(os.path.dirname(blob_store.blob_path(digest)), exist_ok=True)
+        with open(blob_store.blob_path(digest), 'wb') as f:
+            f.write(content)
+        return digest
+
+    def append(self, entry, floor=0, origin='a'):
+        return journal.append(IDENTIFIER, origin, entry, floor)
+
+    def read(self, cursor=0, origin='b'):
+        entries, _ = journal.read_entries(IDENTIFIER, cursor, origin)
+        return [(entry.command, entry.path) for entry in entries]
+
+    def test_newer_content_compacts_older_change_and_releases_its_blob(self):
+        old = self.store(b'old')
+        new = self.store(b'new')
+        self.append(Entry(CREATE_COMMAND, 0, 'f', digest=old))
+        self.append(Entry(MODIFY_COMMAND, 0, 'f', digest=new))
+        self.assertEqual(self.read(), [(MODIFY_COMMAND, 'f')])
+        self.assertFalse(blob_store.has_blob(old))
+        self.assertTrue(blob_store.has_blob(new))
+
+    def test_changes_clients_got_are_not_compacted(self):
+        first = self.append(Entry(MODIFY_COMMAND, 0, 'f', digest=self.store(b'1')))
+        self.append(Entry(MODIFY_COMMAND, 0, 'f', digest=self.store(b'2')), floor=first)
+        self.assertEqual(self.read(), [(MODIFY_COMMAND, 'f'), (MODIFY_COMMAND, 'f')])
+
+    def test_compaction_does_not_cross_move(self):
+        self.append(Entry(MODIFY_COMMAND, 0, 'f', digest=self.store(b'1')))
+        self.append(Entry(MOVE_COMMAND, 0, 'f', dst_path='g'))
+        self.append(Entry(MODIFY_COMMAND, 0, 'f', digest=self.store(b'2')))
+        self.assertEqual(self.read(), [(MODIFY_COMMAND, 'f'), (MOVE_COMMAND, 'f'), (MODIFY_COMMAND, 'f')])
+
+    def test_delete_of_directory_compacts_changes_under_it_only(self):
+        self.append(Entry(CREATE_COMMAND, 0, os.path.join('d', 'f'), digest=self.store(b'1')))
+        self.append(Entry(CREATE_COMMAND, 0, 'd-sibling', digest=self.store(b'2')))
+        self.append(Entry(DELETE_COMMAND, 1, 'd'))
+        self.assertEqual(self.read(), [(CREATE_COMMAND, 'd-sibling'), (DELETE_COMMAND, 'd')])
+
+    def test_delta_after_compacted_content_becomes_modify(self):
+        self.append(Entry(MODIFY_COMMAND, 0, 'f', digest=self.store(b'1')))
+        self.append(Entry(DELTA_COMMAND, 0, 'f', digest=self.store(b'2'), payload=b'delta'))
+        entries, _ = journal.read_entries(IDENTIFIER, 0, 'b')
+        self.assertEqual([(entry.command, entry.payload) for entry in entries], [(MODIFY_COMMAND, None)])
+
+    def test_delta_on_content_clients_got_stays_delta(self):
+        first = self.append(Entry(MODIFY_COMMAND, 0, 'f', digest=self.store(b'1')))
+        self.append(Entry(DELTA_COMMAND, 0, 'f', digest=self.store(b'2'), payload=b'delta'), floor=first)
+        entries, _ = journal.read_entries(IDENTIFIER, first, 'b')
+        self.assertEqual([(entry.command, entry.payload) for entry in entries], [(DELTA_COMMAND, b'delta')])
+
+    def test_read_skips_own_changes_but_moves_the_cursor(self):
+        self.append(Entry(CREATE_COMMAND, 1, 'd'), origin='a')
+        last = self.append(Entry(CREATE_COMMAND, 1, 'e'), origin='b')
+        entries, cursor = journal.read_entries(IDENTIFIER, 0, 'b')
+        self.assertEqual([entry.path for entry in entries], ['d'])
+        self.assertEqual(cursor, last)
+
+    def test_truncate_keeps_sessions_after_it_resumable(self):
+        first = self.append(Entry(CREATE_COMMAND, 1, 'd'))
+        self.append(Entry(CREATE_COMMAND, 1, 'e'))
+        journal.truncate(IDENTIFIER, first)
+        self.assertEqual(self.read(), [(CREATE_COMMAND, 'e')])
+        self.assertTrue(journal.can_resume(IDENTIFIER, first))
+        self.assertFalse(journal.can_resume(IDENTIFIER, first - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()